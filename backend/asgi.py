@@ -29,3 +29,8 @@ application = ProtocolTypeRouter({
         ])
     ),
 })
+
+if settings.SCHEDULER_ENABLED:
+    from backend.scheduler import with_scheduler  # noqa: E402
+
+    application = with_scheduler(application)
@@ -0,0 +1,36 @@
+"""
+DRF views with ``async def`` handlers.
+
+DRF's dispatch is synchronous. ``AsyncAPIView`` runs the same steps, but awaits
+the handler. Authentication, permissions and throttling may touch the database,
+so they run through ``sync_to_async``. Django detects the async handlers and
+serves the view on the event loop instead of a worker thread.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from rest_framework.views import APIView
+
+
+class AsyncAPIView(APIView):
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
@@ -0,0 +1,379 @@
+"""
+Process-local metrics aggregated across workers.
+
+Every metric keeps one cell per thread, so recording is a plain add on data
+that only the calling thread writes: there is no lock on the hot path. When a
+thread exits, its cells are folded into a per-metric retired total, so
+short-lived threads do not pile up cells. A daemon
+thread publishes the process totals to Redis every ``METRICS_FLUSH_SECONDS``.
+``/metrics`` sums the snapshots of all live processes and renders them in the
+Prometheus text format. With ``METRICS_AGGREGATION = 'local'`` nothing is sent
+to Redis and each process only reports itself.
+
+A worker that exits stops refreshing its snapshot, and the snapshot expires, so
+its counts drop out of the totals. Prometheus treats that as a counter reset.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from backend.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROCESSES_KEY = 'metrics:procs'
+
+
+class _ThreadToken:
+    """Held only by one thread's ``threading.local``, so it is collected when that thread exits."""
+
+    __slots__ = ('__weakref__',)
+
+
+class _Child:
+    """One label combination. ``size`` floats per thread cell."""
+
+    def __init__(self, size):
+        self.size = size
+        self.cells = []
+        self.retired = [0.0] * size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0.0] * self.size
+            token = self._local.token = _ThreadToken()
+            weakref.finalize(token, self._retire, cell)
+            with self._lock:
+                self.cells.append(cell)
+            _ensure_flusher()
+            return cell
+
+    def _retire(self, cell):
+        # The owning thread has exited: keep its values, drop its cell
+        with self._lock:
+            cells = [c for c in self.cells if c is not cell]
+            if len(cells) == len(self.cells):
+                return  # already dropped by reset()
+            self.retired = [a + b for a, b in zip(self.retired, cell)]
+            self.cells = cells
+
+    def total(self):
+        with self._lock:
+            return [sum(column) for column in zip(self.retired, *self.cells)]
+
+    def reset(self):
+        with self._lock:
+            self.cells = []
+            self.retired = [0.0] * self.size
+        self._local = threading.local()
+
+
+class CounterChild(_Child):
+    def __init__(self, metric):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+
+class GaugeChild(_Child):
+    """Summed across threads and processes, so it only supports relative changes."""
+
+    def __init__(self, metric):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def dec(self, amount=1):
+        self.cell()[0] -= amount
+
+
+class HistogramChild(_Child):
+    # Cell layout: one count per bucket (the last one is +Inf), then the sum
+    def __init__(self, metric):
+        super().__init__(len(metric.buckets) + 2)
+        self.buckets = metric.buckets
+
+    def observe(self, value):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    child_class = None
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values, **kwargs):
+        key = tuple(str(v) for v in values) or tuple(str(kwargs[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(key, self.child_class(self))
+        return child
+
+
+class Counter(Metric):
+    child_class = CounterChild
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    child_class = GaugeChild
+    type = 'gauge'
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+
+class Histogram(Metric):
+    child_class = HistogramChild
+    type = 'histogram'
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, cls, name, documentation, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def snapshot(self):
+        return {
+            name: {
+                'type': m.type,
+                'help': m.documentation,
+                'labels': list(m.labelnames),
+                'buckets': list(m.buckets) if m.type == 'histogram' else None,
+                'samples': {json.dumps(key): child.total() for key, child in list(m.children.items())},
+            }
+            for name, m in list(self.metrics.items())
+        }
+
+    def reset(self):
+        for metric in self.metrics.values():
+            for child in metric.children.values():
+                child.reset()
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+API_REQUEST_SECONDS = histogram('api_request_seconds', 'API request latency by view and status', ['view', 'status'])
+
+
+class InstrumentedViewMixin:
+    """Records every response of the view, including auth and validation errors, under ``metrics_name``."""
+
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            return self._observe_async(response, start)
+        return self._observe(response, start)
+
+    async def _observe_async(self, response, start):
+        return self._observe(await response, start)
+
+    def _observe(self, response, start):
+        API_REQUEST_SECONDS.labels(self.metrics_name, response.status_code).observe(time.perf_counter() - start)
+        return response
+
+
+# Cross-process aggregation
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _process_key():
+    return f'metrics:{socket.gethostname()}:{os.getpid()}'
+
+
+def _aggregated():
+    return getattr(settings, 'METRICS_AGGREGATION', 'redis') == 'redis'
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None or not _aggregated():
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+            _flusher.start()
+
+
+def flush():
+    interval = settings.METRICS_FLUSH_SECONDS
+    key = _process_key()
+    client = get_redis()
+    pipe = client.pipeline()
+    pipe.set(key, json.dumps(REGISTRY.snapshot()), ex=max(int(interval * 6), 30))
+    pipe.sadd(PROCESSES_KEY, key)
+    pipe.execute()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_SECONDS)
+        try:
+            flush()
+        except Exception:
+            logger.debug('Metrics flush failed', exc_info=True)
+
+
+def _after_fork():
+    # Forked workers (Celery prefork) start from zero under their own pid
+    global _flusher, _flusher_lock
+    _flusher = None
+    _flusher_lock = threading.Lock()
+    REGISTRY.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _merge(target, snapshot):
+    for name, family in snapshot.items():
+        merged = target.setdefault(name, {**family, 'samples': {}})
+        for key, values in family['samples'].items():
+            current = merged['samples'].get(key)
+            merged['samples'][key] = values if current is None else [a + b for a, b in zip(current, values)]
+
+
+def collect():
+    """Merged snapshot of every live process (just this one in local mode)."""
+    merged = {}
+    local = REGISTRY.snapshot()
+    if not _aggregated():
+        _merge(merged, local)
+        return merged
+    client = get_redis()
+    own = _process_key()
+    keys = [k.decode() if isinstance(k, bytes) else k for k in client.smembers(PROCESSES_KEY)]
+    others = [k for k in keys if k != own]
+    stale = []
+    for key, raw in zip(others, client.mget(others) if others else []):
+        if raw is None:
+            stale.append(key)
+        else:
+            _merge(merged, json.loads(raw))
+    if stale:
+        client.srem(PROCESSES_KEY, *stale)
+    _merge(merged, local)  # this process's live values rather than its last flush
+    return merged
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+def render(families):
+    lines = []
+    for name, family in sorted(families.items()):
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        labels = family['labels']
+        for key, values in sorted(family['samples'].items()):
+            label_values = json.loads(key)
+            if family['type'] != 'histogram':
+                lines.append(f'{name}{_format_labels(labels, label_values)} {_format_value(values[0])}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + [math.inf], values[:-1]):
+                cumulative += count
+                le = (('le', _format_value(bound)),)
+                lines.append(f'{name}_bucket{_format_labels(labels, label_values, le)} {_format_value(cumulative)}')
+            lines.append(f'{name}_sum{_format_labels(labels, label_values)} {_format_value(values[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels, label_values)} {_format_value(cumulative)}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return HttpResponse(status=401)
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,196 @@
+"""
+Token-bucket rate limiting shared by every process through Redis.
+
+Each bucket is a Redis hash holding the tokens left and when they were
+counted. A Lua script refills it from Redis's own clock and takes tokens
+atomically, so every process and host enforces the same limit.
+
+``RATE_LIMITS`` maps a scope (``LatestPricesView.throttle_scope``, a consumer
+action, ...) to a limit per tier such as ``'120/min'``, meaning a burst of
+120 refilled at 120 a minute. Anonymous clients are limited per IP, and
+signed-in users per account, with ``premium`` for users whose premium is
+active. A tier left out of a scope is not limited. The IP is the connecting address
+unless ``NUM_PROXIES`` trusted proxies are configured, so a client cannot pick
+a fresh bucket by sending its own ``X-Forwarded-For``.
+
+Every process also keeps the last count Redis gave it for each bucket and
+refills that copy itself. The Redis bucket has always had at least as many
+tokens taken, so an empty local copy means Redis would refuse too, and a
+client hammering an exhausted bucket is turned away without a round trip.
+If Redis is unreachable, requests are let through.
+"""
+import hashlib
+import logging
+import threading
+import time
+from functools import lru_cache
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from backend import metrics
+from backend.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LOCAL_MAX_KEYS = 50_000  # the local copies are dropped wholesale past this; they are only an optimisation
+PERIODS = {'s': 1, 'sec': 1, 'second': 1, 'm': 60, 'min': 60, 'minute': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+_TAKE = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(tokens), tostring(wait)}
+"""
+_TAKE_SHA = hashlib.sha1(_TAKE.encode()).hexdigest()
+
+DECISIONS = metrics.counter('ratelimit_decisions_total', 'Rate limit decisions by scope and outcome', ['scope', 'outcome'])
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """``'120/min'`` -> ``(capacity, tokens per second)``."""
+    count, _, period = rate.partition('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip().lower()]
+
+
+def tier_for(user):
+    if user is None or not user.is_authenticated:
+        return 'anon'
+    return 'premium' if user.has_active_premium() else 'user'
+
+
+def bucket_for(scope, user=None, ip=None):
+    """The bucket key and ``(capacity, rate)`` limiting this client in ``scope``, or None if it is not limited."""
+    if not settings.RATE_LIMIT_ENABLED:
+        return None
+    tier = tier_for(user)
+    rate = settings.RATE_LIMITS.get(scope, {}).get(tier)
+    if rate is None:
+        return None
+    ident = f'ip:{ip}' if tier == 'anon' else f'user:{user.pk}'
+    return f'ratelimit:{scope}:{ident}', parse_rate(rate)
+
+
+class RateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.local = {}  # key -> (tokens, monotonic time they were counted)
+
+    def local_wait(self, key, limit, cost=1):
+        """Seconds until the local copy has ``cost`` tokens; 0 means ask Redis."""
+        capacity, rate = limit
+        with self._lock:
+            state = self.local.get(key)
+        if state is None:
+            return 0.0
+        tokens = min(capacity, state[0] + (time.monotonic() - state[1]) * rate)
+        return 0.0 if tokens >= cost else (cost - tokens) / rate
+
+    def take(self, key, limit, cost=1):
+        """Take ``cost`` tokens in Redis; returns ``(allowed, seconds to wait)``."""
+        capacity, rate = limit
+        # Refilling the local copy from before the call keeps it an upper bound on Redis
+        started = time.monotonic()
+        client = get_redis()
+        args = (capacity, rate, cost)
+        try:
+            try:
+                allowed, tokens, wait = client.evalsha(_TAKE_SHA, 1, key, *args)
+            except redis.exceptions.NoScriptError:
+                allowed, tokens, wait = client.eval(_TAKE, 1, key, *args)
+        except redis.RedisError:
+            logger.debug('Rate limiter unavailable, allowing %s', key, exc_info=True)
+            return None, 0.0
+        with self._lock:
+            if len(self.local) >= LOCAL_MAX_KEYS:
+                self.local.clear()
+            self.local[key] = (float(tokens), started)
+        return bool(allowed), float(wait)
+
+
+_limiter = None
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
+
+
+def _decide(scope, allowed, wait, source):
+    if allowed is None:
+        DECISIONS.labels(scope, 'error').inc()
+        return True, 0.0
+    DECISIONS.labels(scope, 'allowed' if allowed else f'limited_{source}').inc()
+    return allowed, wait
+
+
+def check(scope, user=None, ip=None, cost=1):
+    """Take ``cost`` from this client's bucket for ``scope``; returns ``(allowed, seconds to wait)``."""
+    bucket = bucket_for(scope, user, ip)
+    if bucket is None:
+        return True, 0.0
+    limiter = get_limiter()
+    wait = limiter.local_wait(*bucket, cost)
+    if wait:
+        return _decide(scope, False, wait, 'local')
+    return _decide(scope, *limiter.take(*bucket, cost), 'redis')
+
+
+async def acheck(scope, user=None, ip=None, cost=1):
+    """``check`` that only leaves the event loop to call Redis."""
+    bucket = bucket_for(scope, user, ip)
+    if bucket is None:
+        return True, 0.0
+    limiter = get_limiter()
+    wait = limiter.local_wait(*bucket, cost)
+    if wait:
+        return _decide(scope, False, wait, 'local')
+    return _decide(scope, *await sync_to_async(limiter.take, thread_sensitive=False)(*bucket, cost), 'redis')
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Limits views that set ``throttle_scope`` to the ``RATE_LIMITS`` entry for that scope."""
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        if scope is None:
+            return True
+        allowed, self.retry_after = check(scope, request.user, self.get_ident(request))
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class RateLimitedConsumerMixin:
+    """For WebSocket consumers: ``await self.rate_limited(scope)`` before a limited action."""
+
+    async def rate_limited(self, scope, cost=1):
+        """True, after telling the client how long to wait, if the action is over its limit."""
+        client = self.scope.get('client') or (None,)
+        allowed, wait = await acheck(scope, getattr(self, 'user', None), client[0], cost)
+        if not allowed:
+            await self.send_json({'error': 'rate_limited', 'retry_after': round(wait, 3)})
+        return not allowed
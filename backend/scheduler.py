@@ -0,0 +1,178 @@
+"""
+In-process scheduler for single-node deployments.
+
+When ``SCHEDULER_ENABLED`` is set, the ASGI application runs the entries of
+``CELERY_BEAT_SCHEDULE`` itself on its event loop, executing each task in a
+worker thread, so no Celery worker or beat process is needed. Only one process
+runs the jobs: leadership is held through a local file lock or a Redis lease
+(``SCHEDULER_LOCK``).
+"""
+import asyncio
+import logging
+import os
+
+from celery.schedules import maybe_schedule
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class FileLeaderLock:
+    """Held by the first process to lock the file, until that process exits. POSIX only."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        if self.fd is not None:
+            return True
+        import fcntl  # not available on Windows, where SCHEDULER_LOCK=redis is needed
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            import fcntl
+
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class RedisLeaderLock:
+    """A Redis lease that the leader renews on every scheduler tick."""
+
+    def __init__(self, ttl, client=None):
+        from crypto.locks import Lease
+
+        self.lease = Lease('scheduler:leader', ttl=ttl, client=client)
+
+    def acquire(self):
+        if self.lease.held:
+            if self.lease.renew():
+                return True
+            self.lease.held = False
+        return self.lease.acquire()
+
+    def release(self):
+        self.lease.release()
+
+
+def build_leader_lock():
+    if settings.SCHEDULER_LOCK == 'redis':
+        return RedisLeaderLock(ttl=max(settings.SCHEDULER_TICK_SECONDS * 5, 10))
+    return FileLeaderLock(settings.SCHEDULER_LOCK_FILE)
+
+
+class Job:
+    def __init__(self, name, task_path, schedule, args=()):
+        self.name = name
+        self.task_path = task_path
+        self.schedule = maybe_schedule(schedule)
+        self.args = tuple(args)
+        self.last_run_at = timezone.now()
+        self.running = False
+
+    def is_due(self):
+        return not self.running and self.schedule.is_due(self.last_run_at).is_due
+
+    def run(self):
+        close_old_connections()
+        try:
+            return import_string(self.task_path)(*self.args)
+        finally:
+            close_old_connections()
+
+
+class InProcessScheduler:
+    def __init__(self, beat_schedule, lock, tick=1.0):
+        self.jobs = [
+            Job(name, entry['task'], entry['schedule'], entry.get('args', ()))
+            for name, entry in beat_schedule.items()
+        ]
+        self.lock = lock
+        self.tick = tick
+        self._task = None
+
+    def start(self):
+        """Start on the running event loop; calling it again is a no-op."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.lock.release)
+
+    async def _run(self):
+        while True:
+            try:
+                if await asyncio.to_thread(self.lock.acquire):
+                    for job in self.jobs:
+                        if job.is_due():
+                            job.last_run_at = timezone.now()
+                            asyncio.get_running_loop().create_task(self._execute(job))
+            except Exception:
+                logger.exception('In-process scheduler tick failed')
+            await asyncio.sleep(self.tick)
+
+    async def _execute(self, job):
+        job.running = True
+        try:
+            await asyncio.to_thread(job.run)
+        except Exception:
+            logger.exception('Scheduled job %s failed', job.name)
+        finally:
+            job.running = False
+
+
+class SchedulerApplication:
+    """
+    ASGI wrapper that starts the scheduler on lifespan startup, or on the first
+    connection for servers that do not send lifespan events.
+    """
+
+    def __init__(self, app, scheduler):
+        self.app = app
+        self.scheduler = scheduler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    self.scheduler.start()
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await self.scheduler.stop()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        self.scheduler.start()
+        await self.app(scope, receive, send)
+
+
+def with_scheduler(application):
+    if not settings.SCHEDULER_ENABLED:
+        return application
+    scheduler = InProcessScheduler(
+        settings.CELERY_BEAT_SCHEDULE,
+        build_leader_lock(),
+        tick=settings.SCHEDULER_TICK_SECONDS,
+    )
+    return SchedulerApplication(application, scheduler)
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 from datetime import timedelta
+from celery.schedules import crontab
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -93,6 +94,13 @@ ASGI_APPLICATION = 'backend.asgi.application'
 
 # Channels
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Shared cache (latest-price store, alert index version)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    },
+}
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -117,6 +125,7 @@ DATABASES = {
 
 # Authentication
 AUTH_USER_MODEL = 'users.User'
+AUTHENTICATION_BACKENDS = ['users.backends.UsernameOrEmailBackend']
 
 AUTH_PASSWORD_VALIDATORS = [
     { 'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator' },
@@ -130,6 +139,10 @@ PASSWORD_HASHERS = [
     'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
     'django.contrib.auth.hashers.PBKDF2PasswordHasher',
 ]
+# Async auth views hash on a bounded pool and answer 503 once it is this backed up; see users/hashing.py
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 2)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '32'))
+PASSWORD_HASH_RETRY_AFTER = 1  # seconds, sent as Retry-After with the 503
 
 # DRF & JWT
 REST_FRAMEWORK = {
@@ -139,6 +152,21 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 50,
+    # Views opt in by setting throttle_scope; limits are in RATE_LIMITS
+    'DEFAULT_THROTTLE_CLASSES': ('backend.ratelimit.TokenBucketThrottle',),
+    # Reverse proxies in front of the app; X-Forwarded-For is only trusted up to this many hops,
+    # and with 0 anonymous clients are identified by REMOTE_ADDR alone
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', '0')),
+}
+# Token buckets in Redis, per IP for anonymous clients and per account otherwise; see backend/ratelimit.py
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'True') == 'True'
+RATE_LIMITS = {
+    'latest_prices': {'user': '120/min', 'premium': '600/min'},
+    'asset_search': {'user': '300/min', 'premium': '600/min'},
+    'login': {'anon': '10/min'},
+    'verify_email': {'anon': '5/min'},
+    'password': {'anon': '5/min', 'user': '10/min', 'premium': '10/min'},
+    'ws_subscribe': {'user': '60/min', 'premium': '300/min'},
 }
 
 SIMPLE_JWT = {
@@ -150,6 +178,13 @@ SIMPLE_JWT = {
     'SIGNING_KEY': SECRET_KEY,
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
+# Price and premium-status views authenticate from signed entitlement claims
+# instead of loading the user row; see users/tokens.py
+AUTH_STATELESS_CLAIMS = os.getenv('AUTH_STATELESS_CLAIMS', 'False') == 'True'
+# Blacklisted JTIs are mirrored per process from Redis; see users/blacklist.py
+TOKEN_BLACKLIST_SYNC_SECONDS = 2.0
+TOKEN_BLACKLIST_BLOOM = os.getenv('TOKEN_BLACKLIST_BLOOM', 'False') == 'True'
+TOKEN_BLACKLIST_BLOOM_CAPACITY = 1_000_000
 
 # Celery
 CELERY_BROKER_URL = REDIS_URL
@@ -158,19 +193,99 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_BEAT_SCHEDULE = {
-    'fetch-crypto-prices-every-minute': {
-        'task': 'crypto.tasks.fetch_and_broadcast_prices',
-        'schedule': 60.0,
-    }
+    # Runs at the hot-tier interval; each run only fetches assets that are due
+    'poll-crypto-prices': {
+        'task': 'crypto.tasks.poll_prices',
+        'schedule': float(os.getenv('CRYPTO_POLL_HOT_SECONDS', '15')),
+    },
+    'snapshot-portfolios-nightly': {
+        'task': 'users.tasks.snapshot_portfolios',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    'prune-expired-tokens-hourly': {
+        'task': 'users.tasks.prune_expired_tokens',
+        'schedule': crontab(minute=17),
+    },
+    'expire-lapsed-premium': {
+        'task': 'users.tasks.expire_lapsed_premium',
+        'schedule': crontab(minute='*/5'),
+    },
+    'sweep-expired-codes': {
+        'task': 'users.tasks.sweep_expired_codes',
+        'schedule': crontab(minute='*/15'),
+    },
+    # Safety net for lost drain tasks; the only drain when Celery runs eagerly
+    'drain-email-outbox': {
+        'task': 'users.tasks.send_queued_emails',
+        'schedule': 5.0,
+    },
 }
 
-# APScheduler (optional fallback)
-SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'True') == 'True'
+# In-process scheduler (single-node deployments without a Celery worker/beat).
+# Runs CELERY_BEAT_SCHEDULE inside the ASGI process.
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'False') == 'True'
+SCHEDULER_LOCK = os.getenv('SCHEDULER_LOCK', 'file')  # 'file' or 'redis'
+SCHEDULER_LOCK_FILE = os.getenv('SCHEDULER_LOCK_FILE', str(BASE_DIR / '.scheduler.lock'))
+SCHEDULER_TICK_SECONDS = 1.0
+# Run tasks queued with .delay() in the calling thread instead of on a worker.
+# Defaults to SCHEDULER_ENABLED, since a node running the in-process scheduler
+# usually has no worker either; set it explicitly to decouple the two.
+CELERY_TASK_ALWAYS_EAGER = os.getenv('CELERY_TASK_ALWAYS_EAGER', str(SCHEDULER_ENABLED)) == 'True'
+
+# Metrics (/metrics). 'redis' sums the snapshots every process flushes to Redis;
+# 'local' reports only the process that serves the scrape.
+METRICS_AGGREGATION = os.getenv('METRICS_AGGREGATION', 'redis')
+METRICS_FLUSH_SECONDS = 5
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # when set, scrapes need "Authorization: Bearer <token>"
+
+# Tick tracing: '' (off), 'log' or a file path for JSON-lines spans; see crypto/tracing.py
+TICK_TRACE_EXPORT = os.getenv('TICK_TRACE_EXPORT', '')
+TICK_TRACE_DELIVERY_SAMPLE = float(os.getenv('TICK_TRACE_DELIVERY_SAMPLE', '0.01'))
 
 # Crypto API
 CRYPTO_API_URL = os.getenv('CRYPTO_API_URL', 'https://api.coingecko.com/api/v3')
 CRYPTO_API_KEY = os.getenv('CRYPTO_API_KEY', '')
 
+# Market data providers, in priority order. A provider that has not answered
+# after `hedge_after` seconds is hedged with the next one; answers are merged
+# per field with `merge_policy` ('primary', 'median', 'max' or 'min').
+CRYPTO_PROVIDERS = {
+    'providers': [
+        {'class': 'crypto.providers.CoinGeckoProvider', 'timeout': 5},
+    ],
+    'hedge_after': 2.0,
+    'failure_threshold': 3,
+    'reset_timeout': 30.0,
+    'merge_policy': {
+        'current_price': 'median',
+        'total_volume': 'max',
+    },
+}
+
+# Tiered polling (seconds between fetches per tier)
+CRYPTO_POLL_INTERVALS = {
+    'hot': int(os.getenv('CRYPTO_POLL_HOT_SECONDS', '15')),
+    'warm': int(os.getenv('CRYPTO_POLL_WARM_SECONDS', '60')),
+    'cold': int(os.getenv('CRYPTO_POLL_COLD_SECONDS', '300')),
+}
+# An asset joins a tier when it meets any one of the tier's thresholds
+CRYPTO_TIER_RULES = {
+    'hot': {'subscribers': 25, 'volatility': 10.0, 'volume_usd': 1_000_000_000},
+    'warm': {'subscribers': 1, 'volatility': 5.0, 'volume_usd': 50_000_000},
+}
+CRYPTO_TIER_REFRESH_SECONDS = 300
+# Due assets are split into this many hash shards, each fetched by its own
+# Celery task under a Redis lease, then published together as one tick
+CRYPTO_INGEST_SHARDS = int(os.getenv('CRYPTO_INGEST_SHARDS', '1'))
+CRYPTO_INGEST_LEASE_SECONDS = 120
+CRYPTO_API_CALLS_PER_MINUTE = int(os.getenv('CRYPTO_API_CALLS_PER_MINUTE', '30'))
+# A price is stale after this many missed polls of its tier
+CRYPTO_STALE_AFTER_INTERVALS = 3
+# Used when a price has no tier information (e.g. loaded from the database)
+CRYPTO_STALE_AFTER_SECONDS = 900
+CRYPTO_BACKOFF_BASE_SECONDS = 30
+CRYPTO_BACKOFF_MAX_SECONDS = 600
+
 # Internationalization
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = os.getenv('TIME_ZONE', 'UTC')
@@ -191,9 +306,17 @@ EMAIL_HOST_USER = config('MAIL_USER', default='')
 EMAIL_HOST_PASSWORD = config('MAIL_PASSWORD', default='')
 EMAIL_USE_TLS = False  # Disable STARTTLS 
 EMAIL_USE_SSL = True   # Force TLS/SSL for port 465
+EMAIL_TIMEOUT = 10
 DEFAULT_FROM_EMAIL = config('MAIL_FROM_ADDRESS', default='no-reply@example.com')
 MAIL_FROM = f"{config('MAIL_FROM_NAME', default='Django App')} <{config('MAIL_FROM_ADDRESS', default='no-reply@example.com')}>"
 
+# Outbound email queue (users/mail.py)
+MAIL_BATCH_SIZE = 50
+MAIL_BATCH_DELAY = 1  # seconds a drain waits so messages queued together go out together
+MAIL_MAX_ATTEMPTS = 5
+MAIL_DEDUP_SECONDS = 60 * 60
+MAIL_CONNECTION_IDLE_SECONDS = 30  # most servers drop idle SMTP sessions within a minute
+
 # Swagger / OpenAPI
 SPECTACULAR_SETTINGS = {
     'TITLE': 'Crypto Backend API',
@@ -205,6 +328,7 @@ SPECTACULAR_SETTINGS = {
         {'name': 'Password Management', 'description': 'Password reset, change, and forgot password functionality'},
         {'name': 'User Profile', 'description': 'User profile management and information'},
         {'name': 'Premium', 'description': 'Premium subscription management and status'},
+        {'name': 'Portfolio', 'description': 'Holdings and portfolio valuation'},
         {'name': 'Crypto', 'description': 'Cryptocurrency prices and market data'},
         {'name': 'Testing', 'description': 'Testing and utility endpoints'},
     ],
@@ -0,0 +1,174 @@
+import asyncio
+import gc
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import fakeredis
+from django.test import SimpleTestCase, override_settings
+
+from . import metrics, scheduler
+
+calls = []
+
+
+def record(*args):
+    calls.append(args)
+
+
+def fail():
+    raise RuntimeError('job failed')
+
+
+class HeldLock:
+    def __init__(self, held=True):
+        self.held = held
+        self.released = False
+
+    def acquire(self):
+        return self.held
+
+    def release(self):
+        self.released = True
+
+
+def run_scheduler(sched, seconds=0.2):
+    async def main():
+        sched.start()
+        await asyncio.sleep(seconds)
+        await sched.stop()
+    asyncio.run(main())
+
+
+class LeaderLockTests(SimpleTestCase):
+    def test_file_lock_has_one_holder(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'scheduler.lock')
+            first, second = scheduler.FileLeaderLock(path), scheduler.FileLeaderLock(path)
+            self.assertTrue(first.acquire())
+            self.assertTrue(first.acquire())
+            self.assertFalse(second.acquire())
+            first.release()
+            self.assertTrue(second.acquire())
+            second.release()
+
+    def test_redis_lock_is_renewed_by_its_holder(self):
+        client = fakeredis.FakeRedis()
+        first, second = scheduler.RedisLeaderLock(10, client=client), scheduler.RedisLeaderLock(10, client=client)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(first.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+
+    def test_redis_lock_lost_to_another_holder_is_not_kept(self):
+        client = fakeredis.FakeRedis()
+        first, second = scheduler.RedisLeaderLock(10, client=client), scheduler.RedisLeaderLock(10, client=client)
+        self.assertTrue(first.acquire())
+        client.delete(first.lease.key)  # expired
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.acquire())
+        self.assertFalse(first.lease.held)
+
+
+class InProcessSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        calls.clear()
+
+    def schedule(self, task='backend.tests.record', every=0.01, **entry):
+        return {'job': {'task': task, 'schedule': every, **entry}}
+
+    def test_leader_runs_due_jobs_with_their_args(self):
+        lock = HeldLock()
+        run_scheduler(scheduler.InProcessScheduler(self.schedule(args=(1, 2)), lock, tick=0.02))
+        self.assertGreater(len(calls), 1)
+        self.assertEqual(set(calls), {(1, 2)})
+        self.assertTrue(lock.released)
+
+    def test_follower_runs_nothing(self):
+        run_scheduler(scheduler.InProcessScheduler(self.schedule(), HeldLock(held=False), tick=0.02))
+        self.assertEqual(calls, [])
+
+    def test_a_running_job_is_not_started_again(self):
+        release = threading.Event()
+        runs = []
+
+        def slow():
+            runs.append(1)
+            release.wait(1)
+
+        with mock.patch('backend.tests.record', slow):
+            sched = scheduler.InProcessScheduler(self.schedule(), HeldLock(), tick=0.01)
+
+            async def main():
+                sched.start()
+                await asyncio.sleep(0.1)
+                self.assertEqual(len(runs), 1)
+                release.set()
+                await sched.stop()
+            asyncio.run(main())
+
+    def test_failing_job_does_not_stop_the_loop(self):
+        sched = scheduler.InProcessScheduler(
+            {**self.schedule('backend.tests.fail'), 'other': {'task': 'backend.tests.record', 'schedule': 0.01}},
+            HeldLock(), tick=0.02,
+        )
+        with self.assertLogs('backend.scheduler', 'ERROR'):
+            run_scheduler(sched)
+        self.assertGreater(len(calls), 1)
+
+    def test_lock_errors_are_retried_on_the_next_tick(self):
+        lock = HeldLock()
+        lock.acquire = mock.Mock(side_effect=[ConnectionError('redis down')] + [True] * 100)
+        with self.assertLogs('backend.scheduler', 'ERROR'):
+            run_scheduler(scheduler.InProcessScheduler(self.schedule(), lock, tick=0.02), seconds=0.1)
+        self.assertTrue(calls)
+
+
+class SchedulerApplicationTests(SimpleTestCase):
+    def test_lifespan_starts_and_stops_the_scheduler(self):
+        sched = mock.Mock(stop=mock.AsyncMock())
+        app = scheduler.SchedulerApplication(mock.AsyncMock(), sched)
+        messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+        sent = []
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(app({'type': 'lifespan'}, receive, send))
+        sched.start.assert_called_once()
+        sched.stop.assert_awaited_once()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        app.app.assert_not_called()
+
+    def test_first_request_starts_the_scheduler_without_lifespan(self):
+        sched = mock.Mock()
+        app = scheduler.SchedulerApplication(mock.AsyncMock(), sched)
+        asyncio.run(app({'type': 'http'}, None, None))
+        sched.start.assert_called_once()
+        app.app.assert_awaited_once()
+
+    @override_settings(SCHEDULER_ENABLED=False)
+    def test_disabled_scheduler_leaves_the_application_alone(self):
+        application = object()
+        self.assertIs(scheduler.with_scheduler(application), application)
+
+
+class MetricCellTests(SimpleTestCase):
+    def test_cells_of_exited_threads_are_folded_into_the_total(self):
+        counter = metrics.Counter('test_thread_cells', 'Test counter')
+        counter.inc()
+        workers = [threading.Thread(target=counter.inc, args=(2,)) for _ in range(5)]
+        for worker in workers:
+            worker.start()
+            worker.join()
+        gc.collect()
+        child = counter.labels()
+        self.assertEqual(len(child.cells), 1)  # only this thread's
+        self.assertEqual(child.total(), [11.0])
+        child.reset()
+        self.assertEqual(child.total(), [0.0])
@@ -0,0 +1,68 @@
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def bench_latest_prices(bench, market, api_client):
+    url = reverse('crypto-latest-prices')
+
+    def request():
+        assert api_client.get(url).status_code == 200
+
+    bench('latest_prices', request, max_queries=1)
+
+
+def bench_latest_prices_converted(bench, market, api_client):
+    url = reverse('crypto-latest-prices')
+
+    def request():
+        assert api_client.get(url, {'vs': 'eur'}).status_code == 200
+
+    bench('latest_prices_eur', request, max_queries=1)
+
+
+def bench_latest_prices_claims(bench, market, claims_client):
+    url = reverse('crypto-latest-prices')
+
+    def request():
+        assert claims_client.get(url).status_code == 200
+
+    bench('latest_prices_claims', request, max_queries=0)
+
+
+def bench_symbols(bench, market, api_client):
+    url = reverse('crypto-symbols')
+
+    def request():
+        assert api_client.get(url).status_code == 200
+
+    bench('symbols', request, max_queries=1)
+
+
+def bench_asset_search(bench, market, claims_client):
+    url = reverse('crypto-search')
+
+    def request():
+        assert claims_client.get(url, {'q': 'coin 1'}).status_code == 200
+
+    bench('asset_search', request, max_queries=0)
+
+
+def bench_login(bench, client, user):
+    url = reverse('login')
+
+    def request():
+        response = client.post(url, {'username_or_email': 'bench', 'password': 'bench-password'}, content_type='application/json')
+        assert response.status_code == 200
+
+    bench('login', request, max_queries=2)
+
+
+def bench_token_refresh(bench, client, user):
+    url = reverse('token-refresh')
+    refresh = str(RefreshToken.for_user(user))
+
+    def request():
+        assert client.post(url, {'refresh': refresh}, content_type='application/json').status_code == 200
+
+    # The blacklist check falls back to the database here since the suite runs without Redis
+    bench('token_refresh', request, max_queries=1)
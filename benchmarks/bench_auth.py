@@ -0,0 +1,94 @@
+"""
+Login under load, with the real Argon2 hasher.
+
+``login_burst`` times ``LOGIN_CONCURRENCY`` simultaneous logins through the
+ASGI request path and reports the throughput. It runs at most ``MAX_ROUNDS``
+bursts. ``latest_prices_under_logins`` times price requests while that many
+logins run in a loop next to them. Compare it with ``latest_prices`` to see
+what heavy login traffic costs other requests.
+"""
+import asyncio
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+
+LOGIN_CONCURRENCY = 8
+MAX_ROUNDS = 10  # Argon2 makes every round slow
+
+
+@pytest.fixture
+def argon2_user(user, settings):
+    from users import hashing
+
+    settings.PASSWORD_HASHERS = ['django.contrib.auth.hashers.Argon2PasswordHasher']
+    settings.PASSWORD_HASH_MAX_QUEUE = LOGIN_CONCURRENCY  # measure hashing, not shedding
+    hashing._pool = None
+    user.set_password('bench-password')
+    user.save(update_fields=['password'])
+    yield user
+    hashing._pool = None
+
+
+async def login(client):
+    response = await client.post(
+        reverse('login'),
+        {'username_or_email': 'bench', 'password': 'bench-password'},
+        content_type='application/json',
+    )
+    return response.status_code
+
+
+async def login_bursts(rounds):
+    client = AsyncClient()
+    samples = []
+    for _ in range(rounds + 1):
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(login(client) for _ in range(LOGIN_CONCURRENCY)))
+        samples.append(time.perf_counter() - start)
+        assert set(statuses) == {200}, statuses
+    return samples[1:]  # the first burst warms up the pool
+
+
+async def prices_under_logins(rounds, token):
+    client = AsyncClient()
+    url = reverse('crypto-latest-prices')
+    auth = {'Authorization': f'Bearer {token}'}
+    stop = asyncio.Event()
+    statuses = []
+
+    async def login_loop():
+        while not stop.is_set():
+            statuses.append(await login(client))
+
+    workers = [asyncio.create_task(login_loop()) for _ in range(LOGIN_CONCURRENCY)]
+    await asyncio.sleep(0.2)
+    samples = []
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            assert (await client.get(url, headers=auth)).status_code == 200
+            samples.append(time.perf_counter() - start)
+    finally:
+        stop.set()
+        await asyncio.gather(*workers)
+    return samples, statuses
+
+
+def bench_login_burst(bench, argon2_user):
+    samples = async_to_sync(login_bursts)(min(bench.rounds, MAX_ROUNDS))
+    result = bench.record('login_burst', samples, concurrency=LOGIN_CONCURRENCY)
+    result['logins_per_second'] = round(LOGIN_CONCURRENCY / (result['p50_ms'] / 1000), 1)
+
+
+def bench_latest_prices_under_logins(bench, market, argon2_user):
+    samples, statuses = async_to_sync(prices_under_logins)(bench.rounds, AccessToken.for_user(argon2_user))
+    bench.record(
+        'latest_prices_under_logins', samples,
+        concurrency=LOGIN_CONCURRENCY,
+        logins=statuses.count(200),
+        shed=statuses.count(503),
+    )
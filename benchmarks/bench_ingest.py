@@ -0,0 +1,27 @@
+from unittest import mock
+
+from crypto.providers import MarketDataProvider, ProviderPool
+from crypto.tasks import fetch_and_broadcast_prices
+
+
+class FakeProvider(MarketDataProvider):
+    name = 'fake'
+
+    def fetch_markets(self, external_ids):
+        return [
+            {
+                'id': ext_id, 'symbol': f'C{ext_id.rsplit("-", 1)[1].zfill(3)}', 'name': ext_id,
+                'current_price': 100.0, 'price_change_percentage_24h': 1.0, 'market_cap': 1e9,
+                'total_volume': 1e7, 'circulating_supply': 1e6, 'total_supply': 2e6, 'ath': 120.0, 'atl': 1.0,
+            }
+            for ext_id in external_ids
+        ]
+
+    def fetch_fx_rates(self):
+        return {'usd': 1.0, 'eur': 0.9}
+
+
+def bench_ingest_tick(bench, market):
+    pool = ProviderPool([FakeProvider()])
+    with mock.patch('crypto.tasks.get_provider_pool', return_value=pool):
+        bench('ingest_tick', fetch_and_broadcast_prices, max_queries=3)
@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from rest_framework_simplejwt.tokens import AccessToken
+
+from crypto.consumers import CryptoPriceConsumer
+
+SUBSCRIBERS = 200
+
+
+async def fan_out(rounds, token):
+    application = CryptoPriceConsumer.as_asgi()
+    layer = get_channel_layer()
+    clients = []
+    for _ in range(SUBSCRIBERS):
+        client = WebsocketCommunicator(application, f'/ws/crypto/?token={token}')
+        connected, _ = await client.connect()
+        assert connected
+        await client.send_json_to({'action': 'subscribe', 'symbols': ['C000']})
+        await client.receive_json_from()  # subscribed
+        await client.receive_json_from()  # snapshot
+        clients.append(client)
+
+    samples = []
+    try:
+        for i in range(rounds):
+            start = time.perf_counter()
+            await layer.group_send('crypto_C000', {'type': 'price.update', 'data': {'symbol': 'C000', 'price_usd': i}})
+            messages = await asyncio.gather(*(c.receive_json_from(timeout=5) for c in clients))
+            samples.append(time.perf_counter() - start)
+            assert all(m['data']['price_usd'] == i for m in messages)
+    finally:
+        await asyncio.gather(*(c.disconnect() for c in clients))
+    return samples
+
+
+def bench_websocket_fan_out(bench, transactional_db, market, user):
+    token = str(AccessToken.for_user(user))
+    samples = async_to_sync(fan_out)(bench.rounds, token)
+    bench.record('websocket_fan_out', samples, subscribers=SUBSCRIBERS)
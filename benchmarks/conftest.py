@@ -0,0 +1,87 @@
+"""Benchmark fixtures; the ``bench`` helper and command-line options live in ``benchmarks.plugin``."""
+import json
+
+import pytest
+
+from .plugin import Bench
+
+
+@pytest.fixture(scope='session')
+def benchmark_baseline(pytestconfig):
+    path = pytestconfig.getoption('--benchmark-compare')
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)['benchmarks']
+
+
+@pytest.fixture
+def bench(pytestconfig, benchmark_baseline):
+    return Bench(pytestconfig, pytestconfig._benchmark_results, benchmark_baseline)
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    from django.core.cache import cache
+
+    from crypto import registry, search, store
+
+    cache.clear()
+    store._local.update(snapshot=None, checked_at=0.0)
+    registry.reset()
+    search._local.update(registry=None, index=None)
+    yield
+    cache.clear()
+    store._local.update(snapshot=None, checked_at=0.0)
+    registry.reset()
+
+
+ASSET_COUNT = 200
+
+
+@pytest.fixture
+def market(db):
+    """``ASSET_COUNT`` assets with one price each, published to the latest-price store."""
+    from crypto.models import CryptoAsset, CryptoPrice
+    from crypto.store import load_payloads_from_db, publish_snapshot
+
+    CryptoAsset.objects.bulk_create([
+        CryptoAsset(symbol=f'C{i:03d}', name=f'Coin {i}', external_id=f'coin-{i}') for i in range(ASSET_COUNT)
+    ])
+    assets = list(CryptoAsset.objects.order_by('id'))
+    CryptoPrice.objects.bulk_create([
+        CryptoPrice(asset=a, price_usd=100 + i, change_24h_percent=1.5, market_cap_usd=1e9, volume_24h_usd=1e7)
+        for i, a in enumerate(assets)
+    ])
+    publish_snapshot(load_payloads_from_db(), fx={'usd': 1.0, 'eur': 0.9})
+    return assets
+
+
+@pytest.fixture
+def user(db):
+    from django.contrib.auth import get_user_model
+
+    return get_user_model().objects.create_user('bench', 'bench@example.com', 'bench-password')
+
+
+@pytest.fixture
+def api_client(user):
+    from rest_framework.test import APIClient
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+    return client
+
+
+@pytest.fixture
+def claims_client(user, settings):
+    """Client whose access token carries entitlement claims, with ``AUTH_STATELESS_CLAIMS`` on."""
+    from rest_framework.test import APIClient
+
+    from users.tokens import EntitledRefreshToken
+
+    settings.AUTH_STATELESS_CLAIMS = True
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {EntitledRefreshToken.for_user(user).access_token}')
+    return client
@@ -0,0 +1,101 @@
+"""
+pytest plugin for the benchmark suite (loaded from pytest.ini).
+
+``bench(name, func, max_queries=...)`` times ``func`` over ``--benchmark-rounds``
+runs after a warm-up and fails the test when any run issues more SQL queries
+than its budget. The results of the whole session are written as JSON to
+``--benchmark-json``. When ``--benchmark-compare`` points at an earlier results
+file, a benchmark whose ``--benchmark-stat`` (the median by default, which is
+far less noisy than the tail) grew by more than ``--benchmark-tolerance`` also
+fails.
+"""
+import json
+import platform
+import statistics
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmark')
+    group.addoption('--benchmark-rounds', type=int, default=30, help='Timed runs per benchmark')
+    group.addoption('--benchmark-json', default='benchmarks/results.json', help='Where to write the results')
+    group.addoption('--benchmark-compare', default=None, help='Baseline results file to compare against')
+    group.addoption('--benchmark-stat', default='p50_ms', choices=['mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'],
+                    help='Statistic compared with the baseline')
+    group.addoption('--benchmark-tolerance', type=float, default=0.5, help='Allowed regression (0.5 = 50%%)')
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    ms = [s * 1000 for s in samples]
+    return {
+        'rounds': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p50_ms': round(percentile(ms, 50), 3),
+        'p95_ms': round(percentile(ms, 95), 3),
+        'p99_ms': round(percentile(ms, 99), 3),
+        'max_ms': round(max(ms), 3),
+    }
+
+
+class Bench:
+    # Sub-millisecond timings are mostly noise; never fail on less than this much growth
+    MIN_REGRESSION_MS = 1.0
+
+    def __init__(self, config, results, baseline):
+        self.rounds = config.getoption('--benchmark-rounds')
+        self.stat = config.getoption('--benchmark-stat')
+        self.tolerance = config.getoption('--benchmark-tolerance')
+        self.results = results
+        self.baseline = baseline
+
+    def __call__(self, name, func, max_queries, warmup=3):
+        for _ in range(warmup):
+            func()
+        samples = []
+        queries = 0
+        for _ in range(self.rounds):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - start)
+            queries = max(queries, len(ctx.captured_queries))
+        return self.record(name, samples, queries=queries, max_queries=max_queries)
+
+    def record(self, name, samples, queries=None, max_queries=None, **extra):
+        result = summarize(samples)
+        result.update(queries=queries, max_queries=max_queries, **extra)
+        self.results[name] = result
+        if max_queries is not None:
+            assert queries <= max_queries, f'{name}: {queries} queries, budget is {max_queries}'
+        previous = self.baseline.get(name)
+        if previous:
+            before, now = previous[self.stat], result[self.stat]
+            limit = max(before * (1 + self.tolerance), before + self.MIN_REGRESSION_MS)
+            assert now <= limit, f'{name}: {self.stat} {now}ms regressed past {limit:.3f}ms (baseline {before}ms)'
+        return result
+
+
+def pytest_configure(config):
+    config._benchmark_results = {}
+
+
+def pytest_sessionfinish(session, exitstatus):
+    results = getattr(session.config, '_benchmark_results', None)
+    if not results:
+        return
+    path = session.config.getoption('--benchmark-json')
+    with open(path, 'w') as f:
+        json.dump({
+            'machine': {'python': platform.python_version(), 'platform': platform.platform()},
+            'rounds': session.config.getoption('--benchmark-rounds'),
+            'benchmarks': results,
+        }, f, indent=2, sort_keys=True)
@@ -0,0 +1,21 @@
+"""
+Settings for the benchmark suite: in-memory channel layer and cache, eager
+Celery, no rate limits, and a fast password hasher so login numbers measure
+the request path rather than the key-derivation cost. Set ``BENCHMARK_DB=sqlite`` to run without
+a PostgreSQL server.
+"""
+import os
+
+from backend.settings import *  # noqa: F401,F403
+
+if os.getenv('BENCHMARK_DB') == 'sqlite':
+    DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+
+CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+CELERY_TASK_ALWAYS_EAGER = True
+SCHEDULER_ENABLED = False
+METRICS_AGGREGATION = 'local'
+RATE_LIMIT_ENABLED = False
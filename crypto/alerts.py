@@ -0,0 +1,201 @@
+"""
+Price alert evaluation.
+
+Active alerts are held in per-symbol sorted threshold arrays so that a price
+move from ``old`` to ``new`` finds every crossed alert with two bisections
+(O(log n + k)) instead of scanning all alerts on every tick.
+
+Saving or deleting an alert appends the change to a log in Redis under a new
+version (see ``crypto.signals``). Each process replays the entries after its
+own version into its index, one bisection per changed alert. A process loads
+every active alert from the database only on its first tick, or when it has
+fallen further behind than the log keeps.
+
+A tick's moves are measured from the prices last published to the shared
+store, read before the tick is published, so every process measures from the
+same prices. An alert is only reported by the process whose ``UPDATE``
+deactivated it.
+"""
+import json
+import logging
+from bisect import bisect_left, bisect_right
+
+from django.db import connection
+from django.utils import timezone
+
+from backend.redis_client import get_redis
+from .models import PriceAlert
+
+logger = logging.getLogger(__name__)
+
+ALERTS_VERSION_KEY = 'crypto:alerts:version'
+ALERTS_CHANGES_KEY = 'crypto:alerts:changes'
+CHANGES_KEPT = 10000
+
+# Bumps the version and logs the change under it in one step, so readers never see a gap
+_RECORD = """
+local version = redis.call('incr', KEYS[1])
+redis.call('zadd', KEYS[2], version, version .. ':' .. ARGV[1])
+redis.call('zremrangebyrank', KEYS[2], 0, -1 - tonumber(ARGV[2]))
+return version
+"""
+
+
+def alert_entry(alert):
+    """The index entry for ``alert``: ``(user_id, channel, symbol, direction, threshold)``."""
+    return (alert.user_id, alert.channel, alert.asset.symbol, alert.direction, float(alert.threshold))
+
+
+def record_alert_change(alert_id, entry=None):
+    """Log that an alert now has ``entry``, or is gone or inactive if ``entry`` is None."""
+    try:
+        get_redis().eval(_RECORD, 2, ALERTS_VERSION_KEY, ALERTS_CHANGES_KEY,
+                         json.dumps([alert_id, entry]), CHANGES_KEPT)
+    except Exception:
+        # Processes that miss it catch up when they next rebuild
+        logger.warning('Could not log a change to alert %s', alert_id, exc_info=True)
+
+
+class AlertIndex:
+    """Per-process index of active alerts, keyed by symbol and direction."""
+
+    def __init__(self):
+        self._version = None
+        # (symbol, direction) -> ([thresholds], [alert ids]), both sorted by threshold
+        self._thresholds = {}
+        # alert id -> (user_id, channel, symbol, direction, threshold)
+        self._alerts = {}
+        # symbol -> last price seen by this process, for ticks evaluated without previous prices
+        self._last_prices = {}
+
+    def sync(self):
+        try:
+            client = get_redis()
+            version = int(client.get(ALERTS_VERSION_KEY) or 0)
+            if version == self._version:
+                return
+            changes = [] if self._version is None else client.zrangebyscore(
+                ALERTS_CHANGES_KEY, f'({self._version}', version)
+        except Exception:
+            logger.warning('Alert change log unavailable', exc_info=True)
+            if self._version is None:
+                # Built at no version, so the first sync after Redis is back rebuilds again
+                self.rebuild()
+                self._version = -1
+            return
+        if self._version is None or len(changes) != version - self._version:
+            # First tick, or entries this process needs were trimmed (or Redis lost them).
+            # Changes logged while this runs are replayed next time; replaying one is harmless.
+            self.rebuild()
+        else:
+            for change in changes:
+                alert_id, entry = json.loads(change.split(b':', 1)[1])
+                self.apply(alert_id, entry)
+        self._version = version
+
+    def rebuild(self):
+        rows = (
+            PriceAlert.objects.filter(is_active=True)
+            .values_list('id', 'user_id', 'channel', 'asset__symbol', 'direction', 'threshold')
+            .order_by('threshold')
+        )
+        thresholds = {}
+        alerts = {}
+        for alert_id, user_id, channel, symbol, direction, threshold in rows.iterator(chunk_size=5000):
+            value = float(threshold)
+            keys, ids = thresholds.setdefault((symbol, direction), ([], []))
+            keys.append(value)
+            ids.append(alert_id)
+            alerts[alert_id] = (user_id, channel, symbol, direction, value)
+        self._thresholds = thresholds
+        self._alerts = alerts
+
+    def apply(self, alert_id, entry):
+        """Replace alert ``alert_id`` with ``entry``, or drop it if ``entry`` is None."""
+        self.discard(alert_id)
+        if entry is None:
+            return
+        user_id, channel, symbol, direction, threshold = entry
+        keys, ids = self._thresholds.setdefault((symbol, direction), ([], []))
+        at = bisect_right(keys, threshold)
+        keys.insert(at, threshold)
+        ids.insert(at, alert_id)
+        self._alerts[alert_id] = (user_id, channel, symbol, direction, threshold)
+
+    def discard(self, alert_id):
+        entry = self._alerts.pop(alert_id, None)
+        if entry is None:
+            return
+        _, _, symbol, direction, threshold = entry
+        keys, ids = self._thresholds[(symbol, direction)]
+        at = ids.index(alert_id, bisect_left(keys, threshold))
+        del keys[at]
+        del ids[at]
+
+    def crossed(self, symbol, old_price, new_price):
+        """Pop and return ids of alerts crossed by a move from old_price to new_price."""
+        if old_price is None or new_price == old_price:
+            return []
+        if new_price > old_price:
+            entry = self._thresholds.get((symbol, PriceAlert.DIRECTION_ABOVE))
+            if not entry:
+                return []
+            keys, ids = entry
+            lo, hi = bisect_right(keys, old_price), bisect_right(keys, new_price)
+        else:
+            entry = self._thresholds.get((symbol, PriceAlert.DIRECTION_BELOW))
+            if not entry:
+                return []
+            keys, ids = entry
+            lo, hi = bisect_left(keys, new_price), bisect_left(keys, old_price)
+        fired = ids[lo:hi]
+        del keys[lo:hi]
+        del ids[lo:hi]
+        return fired
+
+    def evaluate(self, prices, previous=None):
+        """
+        Evaluate a tick of ``{symbol: price}`` moving from ``previous`` prices
+        and return the fired alerts as
+        ``(alert_id, user_id, channel, symbol, direction, threshold)`` tuples.
+        """
+        self.sync()
+        previous = previous or {}
+        fired = []
+        for symbol, price in prices.items():
+            old_price = previous.get(symbol, self._last_prices.get(symbol))
+            self._last_prices[symbol] = price
+            for alert_id in self.crossed(symbol, old_price, price):
+                fired.append((alert_id,) + self._alerts.pop(alert_id))
+        return fired
+
+
+alert_index = AlertIndex()
+
+
+def evaluate_alerts(prices, previous=None):
+    """Mark every alert crossed by this tick as triggered; returns those this call deactivated."""
+    fired = alert_index.evaluate(prices, previous)
+    if not fired:
+        return []
+    table = connection.ops.quote_name(PriceAlert._meta.db_table)
+    placeholders = ', '.join(['%s'] * len(fired))
+    with connection.cursor() as cursor:
+        # Another worker may have fired the same alerts; only the UPDATE that deactivated one reports it
+        cursor.execute(
+            f'UPDATE {table} SET is_active = %s, triggered_at = %s '
+            f'WHERE is_active = %s AND id IN ({placeholders}) RETURNING id',
+            [False, timezone.now(), True, *(f[0] for f in fired)],
+        )
+        claimed = {row[0] for row in cursor.fetchall()}
+    return [f for f in fired if f[0] in claimed]
+
+
+def alert_payload(alert_id, symbol, direction, threshold, price):
+    return {
+        'id': alert_id,
+        'symbol': symbol,
+        'direction': direction,
+        'threshold': threshold,
+        'price_usd': price,
+    }
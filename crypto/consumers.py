@@ -1,4 +1,6 @@
+import asyncio
 import json
+import time
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from urllib.parse import parse_qs
 from rest_framework_simplejwt.tokens import UntypedToken
@@ -7,31 +9,69 @@ from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.utils import timezone
 import jwt
+from asgiref.sync import sync_to_async
+from backend.ratelimit import RateLimitedConsumerMixin
+from users.blacklist import is_blacklisted
+from users.portfolio import load_positions, portfolio_summary
+from users.watchlist import get_watchlist_symbols
+from .metrics import WS_CONNECTIONS, WS_CONNECTS, WS_MESSAGES_SENT, WS_SEND_SECONDS, WS_SUBSCRIPTIONS
+from .store import BASE_CURRENCY, convert_payload, get_snapshot, peek_snapshot
+from .tracing import export_delivery
+from .tasks import PORTFOLIO_GROUP
 
 User = get_user_model()
 
+# Each changes channel-layer group membership, so they share one rate limit
+SUBSCRIPTION_ACTIONS = ('subscribe', 'unsubscribe', 'subscribe_portfolio', 'unsubscribe_portfolio')
+
+
+class CryptoPriceConsumer(RateLimitedConsumerMixin, AsyncJsonWebsocketConsumer):
+    accepted = False
+
+    async def reject(self, code, reason):
+        WS_CONNECTS.labels(reason).inc()
+        await self.close(code=code)
 
-class CryptoPriceConsumer(AsyncJsonWebsocketConsumer):
     async def connect(self):
         # Expect token via query ?token=<JWT>
         query = parse_qs(self.scope['query_string'].decode())
         raw_token = (query.get('token') or [None])[0]
+        self.vs = (query.get('vs') or [BASE_CURRENCY])[0].lower()
+        # ?trace=1 adds the tick's stage timestamps to every price message
+        self.trace = (query.get('trace') or ['0'])[0] in ('1', 'true')
         if not raw_token:
-            await self.close(code=4001)
+            await self.reject(4001, 'no_token')
             return
         try:
             UntypedToken(raw_token)
             payload = jwt.decode(raw_token, settings.SECRET_KEY, algorithms=['HS256'])
+            if payload.get('jti') and await sync_to_async(is_blacklisted)(payload['jti']):
+                await self.reject(4002, 'blacklisted_token')
+                return
             self.user_id = payload.get('user_id') or payload.get('user')
             self.user = await self.get_user(self.user_id)
             if not self.user:
-                await self.close(code=4003)
+                await self.reject(4003, 'unknown_user')
                 return
         except (InvalidToken, TokenError, jwt.PyJWTError):
-            await self.close(code=4002)
+            await self.reject(4002, 'invalid_token')
+            return
+        if self.vs not in (await sync_to_async(get_snapshot)()).fx:
+            await self.reject(4004, 'unsupported_currency')
             return
         self.symbols = set()
+        self.portfolio = None
+        self.user_group = f'user_{self.user.pk}'
+        watchlist = await sync_to_async(get_watchlist_symbols)(self.user.pk)
+        await self.group_add_many([self.user_group])
+        await self.subscribe(watchlist)
         await self.accept()
+        self.accepted = True
+        WS_CONNECTS.labels('accepted').inc()
+        WS_CONNECTIONS.inc()
+        if self.symbols:
+            await self.send_json({'status': 'subscribed', 'symbols': sorted(self.symbols)})
+            await self.send_current_prices(self.symbols)
 
     @staticmethod
     async def get_user(user_id):
@@ -43,27 +83,127 @@ class CryptoPriceConsumer(AsyncJsonWebsocketConsumer):
     async def receive_json(self, content, **kwargs):
         action = content.get('action')
         symbols = content.get('symbols') or []
+        if action in SUBSCRIPTION_ACTIONS and await self.rate_limited('ws_subscribe'):
+            return
         if action == 'subscribe':
-            for s in symbols:
-                sym = s.upper()
-                if sym not in self.symbols:
-                    self.symbols.add(sym)
-                    await self.channel_layer.group_add(f'crypto_{sym}', self.channel_name)
+            await self.subscribe(symbols)
             await self.send_json({'status': 'subscribed', 'symbols': sorted(self.symbols)})
+            await self.send_current_prices(symbols)
         elif action == 'unsubscribe':
-            for s in symbols:
-                sym = s.upper()
-                if sym in self.symbols:
-                    self.symbols.remove(sym)
-                    await self.channel_layer.group_discard(f'crypto_{sym}', self.channel_name)
+            await self.unsubscribe(symbols)
             await self.send_json({'status': 'unsubscribed', 'symbols': sorted(self.symbols)})
+        elif action == 'subscribe_portfolio':
+            await self.load_portfolio()
+            await self.channel_layer.group_add(PORTFOLIO_GROUP, self.channel_name)
+            await self.send_portfolio(await sync_to_async(get_snapshot)())
+        elif action == 'unsubscribe_portfolio':
+            self.portfolio = None
+            await self.channel_layer.group_discard(PORTFOLIO_GROUP, self.channel_name)
+            await self.send_json({'status': 'portfolio_unsubscribed'})
         else:
             await self.send_json({'error': 'unknown_action'})
 
     async def disconnect(self, close_code):
-        for sym in list(self.symbols):
-            await self.channel_layer.group_discard(f'crypto_{sym}', self.channel_name)
+        if self.accepted:
+            WS_CONNECTIONS.dec()
+            self.accepted = False
+        groups = [f'crypto_{sym}' for sym in getattr(self, 'symbols', ())]
+        if getattr(self, 'user_group', None):
+            groups.append(self.user_group)
+        if getattr(self, 'portfolio', None) is not None:
+            groups.append(PORTFOLIO_GROUP)
+        await self.group_discard_many(groups)
+
+    async def send_json(self, content, close=False):
+        start = time.perf_counter()
+        await super().send_json(content, close)
+        WS_SEND_SECONDS.observe(time.perf_counter() - start)
+        WS_MESSAGES_SENT.labels(content.get('type') or content.get('status') or 'error').inc()
+
+    async def group_add_many(self, groups):
+        # Issue every membership change concurrently instead of one round-trip at a time
+        await asyncio.gather(*(self.channel_layer.group_add(g, self.channel_name) for g in groups))
+
+    async def group_discard_many(self, groups):
+        await asyncio.gather(*(self.channel_layer.group_discard(g, self.channel_name) for g in groups))
+
+    async def subscribe(self, symbols):
+        new = {s.upper() for s in symbols} - self.symbols
+        self.symbols |= new
+        WS_SUBSCRIPTIONS.inc(len(new))
+        await self.group_add_many([f'crypto_{sym}' for sym in new])
+
+    async def unsubscribe(self, symbols):
+        gone = {s.upper() for s in symbols} & self.symbols
+        self.symbols -= gone
+        await self.group_discard_many([f'crypto_{sym}' for sym in gone])
+
+    async def watchlist_changed(self, event):
+        await self.subscribe(event.get('added') or [])
+        await self.unsubscribe(event.get('removed') or [])
+        await self.send_json({'status': 'subscribed', 'symbols': sorted(self.symbols)})
 
     async def price_update(self, event):
+        received = time.time()
         data = event.get('data')
-        await self.send_json({'type': 'price', 'data': data}) 
\ No newline at end of file
+        trace = event.get('trace')
+        if self.vs != BASE_CURRENCY:
+            data = await self.converted_update(event.get('version'), data)
+        message = {'type': 'price', 'data': data}
+        if self.trace and trace:
+            message['trace'] = {**trace, 'received': received}
+        await self.send_json(message)
+        if trace:
+            export_delivery(trace, data.get('symbol'), received, time.time())
+
+    async def converted_update(self, version, data):
+        snapshot = peek_snapshot(version) or await sync_to_async(get_snapshot)()
+        payloads = await self.payloads_for(snapshot)
+        symbol = data.get('symbol')
+        if snapshot.version == version and symbol in payloads:
+            # Converted once per tick and currency for every socket in this process
+            return {**payloads[symbol], 'age_seconds': data['age_seconds'], 'stale': data['stale']}
+        # A tick this process's store has not caught up with yet
+        return convert_payload(data, self.vs, snapshot.fx[self.vs])
+
+    async def payloads_for(self, snapshot):
+        try:
+            return snapshot.payloads_for(self.vs)
+        except KeyError:
+            # A later FX table dropped this currency; keep the socket open in USD
+            self.vs = BASE_CURRENCY
+            await self.send_json({'error': 'unsupported_currency', 'vs': BASE_CURRENCY})
+            return snapshot.payloads
+
+    async def price_stale(self, event):
+        await self.send_json({'type': 'stale', 'data': event.get('data')})
+
+    async def send_current_prices(self, symbols):
+        """Send the last known prices, with freshness, so clients never start from nothing."""
+        snapshot = peek_snapshot() or await sync_to_async(get_snapshot)()
+        payloads = await self.payloads_for(snapshot)
+        selected = [payloads[s] for s in sorted({s.upper() for s in symbols}) if s in payloads]
+        if selected:
+            await self.send_json({'type': 'snapshot', 'data': snapshot.with_freshness(selected)})
+
+    async def alert_triggered(self, event):
+        await self.send_json({'type': 'alert', 'data': event.get('data')})
+
+    async def load_portfolio(self):
+        self.portfolio = await sync_to_async(load_positions)(self.user)
+
+    async def send_portfolio(self, snapshot):
+        summary = portfolio_summary(self.portfolio, snapshot)
+        summary.pop('positions')
+        await self.send_json({'type': 'portfolio', 'data': summary})
+
+    async def portfolio_tick(self, event):
+        if self.portfolio is None:
+            return
+        # Only the first socket in this process to see a new tick reads the store
+        snapshot = peek_snapshot(event.get('version')) or await sync_to_async(get_snapshot)()
+        await self.send_portfolio(snapshot)
+
+    async def portfolio_changed(self, event):
+        if self.portfolio is not None:
+            await self.load_portfolio()
@@ -0,0 +1,50 @@
+"""
+Redis leases.
+
+A lease is a key set with NX and a TTL that holds a random token. Only the
+holder can release or renew it, so a run that outlives its TTL cannot delete
+a lease that another run has since taken.
+"""
+import uuid
+
+from backend.redis_client import get_redis
+
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class Lease:
+    def __init__(self, name, ttl, client=None):
+        self.key = f'lease:{name}'
+        self.ttl_ms = int(ttl * 1000)
+        self.token = uuid.uuid4().hex
+        self.client = client or get_redis()
+        self.held = False
+
+    def acquire(self):
+        self.held = bool(self.client.set(self.key, self.token, nx=True, px=self.ttl_ms))
+        return self.held
+
+    def renew(self):
+        return bool(self.client.eval(_RENEW, 1, self.key, self.token, self.ttl_ms))
+
+    def release(self):
+        if self.held:
+            self.client.eval(_RELEASE, 1, self.key, self.token)
+            self.held = False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,177 @@
+"""
+Bulk-load historical prices into ``CryptoPrice``.
+
+Input rows need ``symbol``, ``timestamp`` (ISO 8601 or Unix seconds/milliseconds)
+and ``price_usd``; ``change_24h_percent``, ``market_cap_usd``, ``volume_24h_usd``,
+``circulating_supply``, ``total_supply``, ``ath`` and ``atl`` are optional.
+Rows are streamed, loaded with PostgreSQL ``COPY`` into a temporary table one
+chunk at a time, and inserted without duplicating an existing
+``(asset, last_updated)`` pair.
+"""
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime, timezone as dt_timezone
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from crypto.models import CryptoAsset, CryptoPrice
+from crypto.store import load_payloads_from_db, publish_snapshot
+
+OPTIONAL_COLUMNS = (
+    'market_cap_usd', 'volume_24h_usd', 'circulating_supply', 'total_supply', 'ath', 'atl',
+)
+COPY_COLUMNS = ('asset_id', 'last_updated', 'price_usd', 'change_24h_percent') + OPTIONAL_COLUMNS
+
+
+def read_csv(path):
+    with open(path, newline='') as f:
+        yield from csv.DictReader(f)
+
+
+def read_ndjson(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_parquet(path, batch_size=65536):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise CommandError('Reading Parquet requires pyarrow (pip install pyarrow)')
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        yield from batch.to_pylist()
+
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson, 'jsonl': read_ndjson, 'parquet': read_parquet}
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=dt_timezone.utc)
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        parsed = datetime.fromisoformat(text.replace('Z', '+00:00'))
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt_timezone.utc)
+    if number > 1e11:  # milliseconds
+        number /= 1000
+    return datetime.fromtimestamp(number, tz=dt_timezone.utc)
+
+
+def _blank_to_none(value):
+    return None if value is None or value == '' else value
+
+
+class Command(BaseCommand):
+    help = 'Backfill CryptoPrice history from CSV, NDJSON or Parquet files using COPY'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Input file')
+        parser.add_argument('--format', choices=sorted(READERS), help='Input format (default: from the file extension)')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Rows per COPY/commit')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: <path>.checkpoint)')
+        parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint')
+        parser.add_argument('--rebuild-latest', action='store_true', help='Republish the latest-price store when done')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('backfill_prices requires PostgreSQL (COPY)')
+        path = options['path']
+        fmt = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if fmt not in READERS:
+            raise CommandError(f'Unknown input format: {fmt!r}')
+        checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        done = 0 if options['restart'] else self.load_checkpoint(checkpoint)
+
+        asset_ids = dict(CryptoAsset.objects.values_list('symbol', 'id'))
+        rows = islice(READERS[fmt](path), done, None)
+        if done:
+            self.stdout.write(f'Resuming after {done} rows')
+
+        inserted = skipped = 0
+        started = time.monotonic()
+        while True:
+            chunk = list(islice(rows, options['chunk_size']))
+            if not chunk:
+                break
+            buffer, unknown = self.encode_chunk(chunk, asset_ids)
+            with transaction.atomic():
+                inserted += self.copy_chunk(buffer)
+            skipped += unknown
+            done += len(chunk)
+            self.save_checkpoint(checkpoint, done)
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f'{done} rows read, {inserted} inserted, {skipped} unknown symbols '
+                f'({done / elapsed if elapsed else 0:.0f} rows/s)'
+            )
+
+        if options['rebuild_latest']:
+            publish_snapshot(load_payloads_from_db())
+            self.stdout.write('Latest-price store rebuilt')
+        self.stdout.write(self.style.SUCCESS(f'Backfill complete: {inserted} rows inserted'))
+
+    @staticmethod
+    def load_checkpoint(path):
+        try:
+            with open(path) as f:
+                return int(json.load(f).get('rows_done', 0))
+        except (OSError, ValueError):
+            return 0
+
+    @staticmethod
+    def save_checkpoint(path, rows_done):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'rows_done': rows_done}, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def encode_chunk(chunk, asset_ids):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        unknown = 0
+        for row in chunk:
+            asset_id = asset_ids.get(str(row.get('symbol') or '').strip().upper())
+            if asset_id is None:
+                unknown += 1
+                continue
+            writer.writerow([
+                asset_id,
+                parse_timestamp(row['timestamp']).isoformat(),
+                row['price_usd'],
+                _blank_to_none(row.get('change_24h_percent')) or 0,
+                *(_blank_to_none(row.get(column)) for column in OPTIONAL_COLUMNS),
+            ])
+        buffer.seek(0)
+        return buffer, unknown
+
+    @staticmethod
+    def copy_chunk(buffer):
+        table = CryptoPrice._meta.db_table
+        columns = ', '.join(COPY_COLUMNS)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE backfill_prices ON COMMIT DROP AS '
+                f'SELECT {columns} FROM {table} WITH NO DATA'
+            )
+            cursor.copy_expert(f'COPY backfill_prices ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+            # Drop duplicates inside the chunk and rows that already exist
+            cursor.execute(f"""
+                INSERT INTO {table} ({columns})
+                SELECT DISTINCT ON (b.asset_id, b.last_updated) {', '.join(f'b.{c}' for c in COPY_COLUMNS)}
+                FROM backfill_prices b
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {table} p
+                    WHERE p.asset_id = b.asset_id AND p.last_updated = b.last_updated
+                )
+            """)
+            return cursor.rowcount
@@ -0,0 +1,208 @@
+"""
+Generate a synthetic dataset for capacity testing.
+
+Creates ``--assets`` assets with market caps following a power law, a
+random-walk price series of ``--points`` rows per asset, and ``--users`` users
+with a mix of active, expired and no premium plus watchlists skewed towards the
+largest assets. Everything is derived from ``--seed``, so two runs with the same
+arguments produce the same data.
+"""
+import io
+import time
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from crypto.models import CryptoAsset, CryptoPrice
+from crypto.registry import bump_assets_version
+from users.models import WatchlistItem
+
+SYMBOL_PREFIX = 'SYN'
+EXTERNAL_ID_PREFIX = 'synthetic-'
+USERNAME_PREFIX = 'synthetic_'
+PRICE_COLUMNS = (
+    'asset_id', 'last_updated', 'price_usd', 'change_24h_percent', 'market_cap_usd',
+    'volume_24h_usd', 'circulating_supply', 'total_supply', 'ath', 'atl',
+)
+# One CSV line of PRICE_COLUMNS
+PRICE_ROW_FORMAT = '%d,%s,%.8f,%.4f,%.2f,%.2f,%s,%s,%.8f,%.8f\n'
+
+
+def asset_profiles(rng, count):
+    """Starting price, circulating supply, daily volatility and volume ratio per asset, largest first."""
+    ranks = np.arange(1, count + 1)
+    market_caps = 1e12 / ranks ** 1.2
+    prices = np.exp(rng.normal(1.0, 2.5, count)).clip(1e-4, 1e5)
+    supplies = market_caps / prices
+    volatility = rng.uniform(0.02, 0.12, count)
+    volume_ratio = rng.lognormal(-3.0, 0.7, count)
+    return prices, supplies, volatility, volume_ratio
+
+
+def random_walk(seed, first, start, volatility, points, steps_per_day):
+    """
+    Geometric random walks of ``points`` steps, one row per asset. Each asset has
+    its own generator, so a series does not depend on how assets are chunked.
+    """
+    shocks = np.stack([
+        np.random.default_rng([seed, 1, first + i]).standard_normal(points) for i in range(len(start))
+    ])
+    step_sigma = (volatility / np.sqrt(steps_per_day))[:, None]
+    returns = shocks * step_sigma
+    returns[:, 0] = 0.0
+    return (start[:, None] * np.exp(np.cumsum(returns, axis=1))).clip(1e-8, 1e12)
+
+
+def encode_prices(asset_ids, timestamps, prices, supplies, volume_ratio, steps_per_day):
+    lag = min(steps_per_day, prices.shape[1] - 1)
+    previous = np.concatenate([np.repeat(prices[:, :1], lag, axis=1), prices[:, :-lag]], axis=1) if lag else prices
+    change = (prices / previous - 1.0) * 100
+    market_cap = prices * supplies[:, None]
+    volume = market_cap * volume_ratio[:, None]
+    ath = np.maximum.accumulate(prices, axis=1)
+    atl = np.minimum.accumulate(prices, axis=1)
+
+    points = prices.shape[1]
+    # Formatted once per asset rather than twice per row
+    supply = np.repeat(np.array([f'{v:.8f}' for v in supplies.tolist()], dtype=object), points).tolist()
+    columns = [
+        np.repeat(np.asarray(asset_ids), points).tolist(), list(timestamps) * len(prices),
+        prices.ravel().tolist(), change.ravel().tolist(), market_cap.ravel().tolist(), volume.ravel().tolist(),
+        supply, supply, ath.ravel().tolist(), atl.ravel().tolist(),
+    ]
+    buffer = io.StringIO()
+    buffer.writelines(map(PRICE_ROW_FORMAT.__mod__, zip(*columns)))
+    buffer.seek(0)
+    return buffer
+
+
+class Command(BaseCommand):
+    help = 'Generate deterministic synthetic assets, price history, users and watchlists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--assets', type=int, default=2000)
+        parser.add_argument('--points', type=int, default=1440, help='Price rows per asset')
+        parser.add_argument('--interval', type=int, default=300, help='Seconds between price rows')
+        parser.add_argument('--end', default='2025-01-01T00:00:00+00:00', help='Timestamp of the last price row')
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--premium-ratio', type=float, default=0.2, help='Share of users with active premium')
+        parser.add_argument('--expired-ratio', type=float, default=0.05, help='Share of users with expired premium')
+        parser.add_argument('--watchlist-max', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--chunk-size', type=int, default=500000, help='Price rows per COPY')
+        parser.add_argument('--reset', action='store_true', help='Delete previously generated data first')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('generate_scale_data requires PostgreSQL (COPY)')
+        end = parse_datetime(options['end'])
+        if end is None:
+            raise CommandError(f"Invalid --end timestamp: {options['end']!r}")
+        seed = options['seed']
+        User = get_user_model()
+
+        if options['reset']:
+            with transaction.atomic():
+                User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+                CryptoAsset.objects.filter(external_id__startswith=EXTERNAL_ID_PREFIX).delete()
+        elif CryptoAsset.objects.filter(external_id__startswith=EXTERNAL_ID_PREFIX).exists():
+            raise CommandError('Synthetic data already exists; pass --reset to regenerate it')
+
+        count = options['assets']
+        prices, supplies, volatility, volume_ratio = asset_profiles(np.random.default_rng([seed, 0]), count)
+        CryptoAsset.objects.bulk_create(
+            [
+                CryptoAsset(symbol=f'{SYMBOL_PREFIX}{i:05d}', name=f'Synthetic {i}', external_id=f'{EXTERNAL_ID_PREFIX}{i}')
+                for i in range(count)
+            ],
+            batch_size=1000,
+        )
+        bump_assets_version()  # bulk_create sends no signals
+        asset_ids = np.array([
+            pk for _, pk in sorted(
+                (int(ext[len(EXTERNAL_ID_PREFIX):]), pk)
+                for ext, pk in CryptoAsset.objects.filter(external_id__startswith=EXTERNAL_ID_PREFIX)
+                .values_list('external_id', 'id')
+            )
+        ])
+        self.stdout.write(f'Created {count} assets')
+
+        self.generate_prices(asset_ids, prices, supplies, volatility, volume_ratio, end, seed, options)
+        self.generate_users(asset_ids, seed, options)
+        self.stdout.write(self.style.SUCCESS('Synthetic data generated'))
+
+    def generate_prices(self, asset_ids, prices, supplies, volatility, volume_ratio, end, seed, options):
+        points, interval = options['points'], options['interval']
+        steps_per_day = max(1, 86400 // interval)
+        end_s = np.datetime64(int(end.timestamp()), 's')
+        offsets = (np.arange(points - 1, -1, -1) * interval).astype('timedelta64[s]')
+        timestamps = [f'{ts}+00:00' for ts in np.datetime_as_string(end_s - offsets, unit='s')]
+
+        per_block = max(1, options['chunk_size'] // points)
+        table = CryptoPrice._meta.db_table
+        copy_sql = f"COPY {table} ({', '.join(PRICE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+        total = len(asset_ids) * points
+        written = 0
+        started = time.monotonic()
+        for start in range(0, len(asset_ids), per_block):
+            stop = start + per_block
+            series = random_walk(seed, start, prices[start:stop], volatility[start:stop], points, steps_per_day)
+            buffer = encode_prices(
+                asset_ids[start:stop].tolist(), timestamps, series,
+                supplies[start:stop], volume_ratio[start:stop], steps_per_day,
+            )
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.copy_expert(copy_sql, buffer)
+            written += series.size
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'{written}/{total} price rows ({written / elapsed if elapsed else 0:.0f} rows/s)')
+
+    def generate_users(self, asset_ids, seed, options):
+        User = get_user_model()
+        rng = np.random.default_rng([seed, 2])
+        count = options['users']
+        now = timezone.now()
+        password = make_password('synthetic')
+
+        tier = rng.random(count)
+        active = tier < options['premium_ratio']
+        expired = ~active & (tier < options['premium_ratio'] + options['expired_ratio'])
+        days = rng.integers(1, 365, count)
+
+        users = []
+        for i in range(count):
+            premium_expires_at = None
+            if active[i]:
+                premium_expires_at = now + timezone.timedelta(days=int(days[i]))
+            elif expired[i]:
+                premium_expires_at = now - timezone.timedelta(days=int(days[i]))
+            users.append(User(
+                username=f'{USERNAME_PREFIX}{i}',
+                email=f'{USERNAME_PREFIX}{i}@example.com',
+                password=password,
+                is_premium=bool(active[i] or expired[i]),
+                premium_expires_at=premium_expires_at,
+            ))
+        User.objects.bulk_create(users, batch_size=5000)
+        user_ids = dict(User.objects.filter(username__startswith=USERNAME_PREFIX).values_list('username', 'id'))
+        self.stdout.write(f'Created {count} users ({int(active.sum())} premium, {int(expired.sum())} expired)')
+
+        # Popularity follows market cap rank, so the largest assets end up in the hot tier
+        weights = 1.0 / np.arange(1, len(asset_ids) + 1)
+        weights /= weights.sum()
+        sizes = rng.integers(0, min(options['watchlist_max'], len(asset_ids)) + 1, count)
+        items = []
+        for i, size in enumerate(sizes.tolist()):
+            user_id = user_ids[f'{USERNAME_PREFIX}{i}']
+            for asset_id in asset_ids[rng.choice(len(asset_ids), size=size, replace=False, p=weights)].tolist():
+                items.append(WatchlistItem(user_id=user_id, asset_id=asset_id))
+            if len(items) >= 10000:
+                WatchlistItem.objects.bulk_create(items, batch_size=10000)
+                items = []
+        WatchlistItem.objects.bulk_create(items, batch_size=10000)
+        self.stdout.write(f'Created {int(sizes.sum())} watchlist entries')
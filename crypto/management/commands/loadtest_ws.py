@@ -0,0 +1,310 @@
+"""
+Load test for ``CryptoPriceConsumer``.
+
+Opens ``--clients`` authenticated sockets, each subscribed to a mix of symbols
+drawn with a Zipf-like skew towards the largest assets. It then injects
+``--ticks`` synthetic price updates through the channel layer and reports
+delivery latency, the time for a tick to reach its last client, server memory
+per connection and reconnect throughput.
+
+By default the ASGI application is served in this process with uvicorn, which
+works with either channel layer (``--layer``). With ``--url`` the sockets go to
+a separately running server instead; ticks then have to travel through Redis,
+so the Redis layer is required. Pass ``--server-pid`` to measure that server's
+memory. Needs the ``websockets`` and ``uvicorn`` packages.
+"""
+import asyncio
+import json
+import os
+import resource
+import socket
+import time
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from crypto.models import CryptoAsset
+from crypto.store import get_snapshot
+
+USERNAME_PREFIX = 'loadtest_'
+LAYERS = {
+    'memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    'redis': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [settings.REDIS_URL]}},
+}
+
+
+def rss_bytes(pid=None):
+    """Resident set size of ``pid`` (default: this process) from /proc."""
+    with open(f"/proc/{pid or 'self'}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def distribution(samples):
+    if not samples:
+        return None
+    ms = np.asarray(samples) * 1000
+    return {
+        'count': int(ms.size),
+        **{f'p{p}_ms': round(float(np.percentile(ms, p)), 3) for p in (50, 90, 99)},
+        'max_ms': round(float(ms.max()), 3),
+    }
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class LoadClient:
+    def __init__(self, url, symbols):
+        self.url = url
+        self.symbols = symbols
+        self.socket = None
+        self.reader = None
+        self.latencies = {}  # tick -> [seconds]
+
+    async def connect(self, connect):
+        self.socket = await connect(self.url, max_queue=None, ping_interval=None)
+        await self.socket.send(json.dumps({'action': 'subscribe', 'symbols': self.symbols}))
+        self.reader = asyncio.get_running_loop().create_task(self.read())
+
+    async def read(self):
+        async for raw in self.socket:
+            received = time.time()
+            message = json.loads(raw)
+            data = message.get('data')
+            if message.get('type') == 'price' and isinstance(data, dict) and 'tick' in data:
+                self.latencies.setdefault(data['tick'], []).append(received - data['sent_at'])
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+        if self.reader is not None:
+            self.reader.cancel()
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+
+class Command(BaseCommand):
+    help = 'Load test the price WebSocket: fan-out latency, memory per connection and reconnect rate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--url', help='ws://host:port/ws/crypto/ of a running server (default: serve in-process)')
+        parser.add_argument('--server-pid', type=int, help='PID of the --url server, for memory per connection')
+        parser.add_argument('--layer', choices=sorted(LAYERS), help='Channel layer for the in-process server')
+        parser.add_argument('--symbols', type=int, default=100, help='Draw subscriptions from the top N assets')
+        parser.add_argument('--max-symbols', type=int, default=10, help='Most symbols a single client subscribes to')
+        parser.add_argument('--ticks', type=int, default=20)
+        parser.add_argument('--tick-interval', type=float, default=0.5)
+        parser.add_argument('--drain-timeout', type=float, default=5.0, help='Give up on missing messages after this idle time')
+        parser.add_argument('--reconnect', type=float, default=0.25, help='Share of clients to reconnect')
+        parser.add_argument('--concurrency', type=int, default=200, help='Connections opened at once')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', help='Also write the report to this file')
+
+    def handle(self, *args, **options):
+        try:
+            import websockets  # noqa: F401
+        except ImportError:
+            raise CommandError('loadtest_ws requires the websockets package (pip install websockets)')
+        if options['url']:
+            if options['layer'] == 'memory' or 'InMemory' in settings.CHANNEL_LAYERS['default']['BACKEND']:
+                raise CommandError('Ticks cannot reach an external server through the in-memory layer; use Redis')
+        else:
+            try:
+                import uvicorn  # noqa: F401
+            except ImportError:
+                raise CommandError('Serving in-process requires uvicorn (pip install uvicorn), or pass --url')
+            if options['layer']:
+                settings.CHANNEL_LAYERS = {'default': LAYERS[options['layer']]}
+
+        limit = raise_fd_limit()
+        if options['clients'] + 100 > limit:
+            self.stderr.write(f'Open file limit is {limit}; some connections may fail')
+
+        universe = self.symbol_universe(options['symbols'])
+        if not universe:
+            raise CommandError('No assets to subscribe to; run generate_scale_data or ingest prices first')
+        tokens = self.tokens(options['clients'])
+        rng = np.random.default_rng(options['seed'])
+        weights = 1.0 / np.arange(1, len(universe) + 1)
+        weights /= weights.sum()
+        mixes = [
+            [universe[i] for i in rng.choice(len(universe), size=size, replace=False, p=weights)]
+            for size in rng.integers(1, min(options['max_symbols'], len(universe)) + 1, options['clients'])
+        ]
+
+        report = asyncio.run(self.run(tokens, mixes, options))
+        self.print_report(report)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+    @staticmethod
+    def symbol_universe(count):
+        snapshot = get_snapshot()
+        if snapshot.symbols:
+            by_cap = sorted(snapshot.payloads.values(), key=lambda p: -(p.get('market_cap_usd') or 0))
+            return [p['symbol'] for p in by_cap[:count]]
+        return list(CryptoAsset.objects.order_by('symbol').values_list('symbol', flat=True)[:count])
+
+    @staticmethod
+    def tokens(count):
+        """Access tokens for ``count`` load-test users, creating the missing ones in bulk."""
+        User = get_user_model()
+        names = [f'{USERNAME_PREFIX}{i}' for i in range(count)]
+        existing = set(User.objects.filter(username__in=names).values_list('username', flat=True))
+        missing = []
+        for name in names:
+            if name not in existing:
+                user = User(username=name, email=f'{name}@example.com')
+                user.set_unusable_password()
+                missing.append(user)
+        User.objects.bulk_create(missing, batch_size=5000)
+        users = {u.username: u for u in User.objects.filter(username__in=names)}
+        return [str(AccessToken.for_user(users[name])) for name in names]
+
+    async def run(self, tokens, mixes, options):
+        from channels.layers import get_channel_layer
+        from websockets.asyncio.client import connect
+
+        server = None
+        url = options['url']
+        server_pid = options['server_pid']
+        if not url:
+            server, port = await self.start_server()
+            url = f'ws://127.0.0.1:{port}/ws/crypto/'
+            server_pid = os.getpid()
+        layer = get_channel_layer()
+
+        clients = [LoadClient(f'{url}?token={token}', symbols) for token, symbols in zip(tokens, mixes)]
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def open_one(client):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await client.connect(connect)
+                except Exception:
+                    return None
+                return time.perf_counter() - start
+
+        rss_before = rss_bytes(server_pid) if server_pid else None
+        started = time.perf_counter()
+        connect_times = await asyncio.gather(*(open_one(c) for c in clients))
+        connect_elapsed = time.perf_counter() - started
+        connected = [c for c, t in zip(clients, connect_times) if t is not None]
+        await asyncio.sleep(1.0)  # let subscriptions settle
+        rss_after = rss_bytes(server_pid) if server_pid else None
+
+        subscribers = {}
+        for client in connected:
+            for symbol in client.symbols:
+                subscribers[symbol] = subscribers.get(symbol, 0) + 1
+        for tick in range(options['ticks']):
+            sent_at = time.time()
+            await asyncio.gather(*(
+                layer.group_send(f'crypto_{symbol}', {
+                    'type': 'price.update',
+                    'data': {'symbol': symbol, 'price_usd': 100.0 + tick, 'tick': tick, 'sent_at': sent_at},
+                })
+                for symbol in subscribers
+            ))
+            await asyncio.sleep(options['tick_interval'])
+        expected = sum(subscribers.values()) * options['ticks']
+        await self.drain(connected, expected, options['drain_timeout'])
+
+        latencies = []
+        last_client = []
+        for tick in range(options['ticks']):
+            per_tick = [s for c in connected for s in c.latencies.get(tick, ())]
+            latencies.extend(per_tick)
+            if per_tick:
+                last_client.append(max(per_tick))
+
+        to_reconnect = connected[:int(len(connected) * options['reconnect'])]
+        await asyncio.gather(*(c.close() for c in to_reconnect))
+        started = time.perf_counter()
+        reconnect_times = await asyncio.gather(*(open_one(c) for c in to_reconnect))
+        reconnect_elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*(c.close() for c in clients))
+        if server is not None:
+            server.should_exit = True
+            await server.main_task
+
+        reconnected = sum(t is not None for t in reconnect_times)
+        return {
+            'layer': settings.CHANNEL_LAYERS['default']['BACKEND'],
+            'url': url,
+            'clients': len(clients),
+            'connected': len(connected),
+            'connect': {
+                'per_second': round(len(connected) / connect_elapsed, 1) if connect_elapsed else None,
+                'latency': distribution([t for t in connect_times if t is not None]),
+            },
+            'memory_per_connection_bytes': (
+                round((rss_after - rss_before) / len(connected)) if rss_before and connected else None
+            ),
+            'ticks': options['ticks'],
+            'deliveries': {'expected': expected, 'received': len(latencies)},
+            'delivery_latency': distribution(latencies),
+            'last_client_latency': distribution(last_client),
+            'reconnect': {
+                'attempted': len(to_reconnect),
+                'succeeded': reconnected,
+                'per_second': round(reconnected / reconnect_elapsed, 1) if reconnect_elapsed and reconnected else None,
+            },
+        }
+
+    @staticmethod
+    async def drain(clients, expected, timeout):
+        """Wait until every expected message arrived, or none arrived for ``timeout`` seconds."""
+        received = -1
+        idle_since = time.monotonic()
+        while True:
+            now_received = sum(len(v) for c in clients for v in c.latencies.values())
+            if now_received >= expected:
+                return
+            if now_received != received:
+                received, idle_since = now_received, time.monotonic()
+            elif time.monotonic() - idle_since > timeout:
+                return
+            await asyncio.sleep(0.1)
+
+    @staticmethod
+    async def start_server():
+        import uvicorn
+
+        from backend.asgi import application
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        server = uvicorn.Server(uvicorn.Config(application, log_level='warning', lifespan='off', ws_max_queue=1024))
+        server.main_task = asyncio.get_running_loop().create_task(server.serve(sockets=[sock]))
+        while not server.started:
+            await asyncio.sleep(0.05)
+        return server, port
+
+    def print_report(self, report):
+        self.stdout.write(f"Layer: {report['layer']}")
+        self.stdout.write(f"Connected {report['connected']}/{report['clients']} at {report['connect']['per_second']}/s")
+        if report['memory_per_connection_bytes'] is not None:
+            self.stdout.write(f"Server memory per connection: {report['memory_per_connection_bytes'] / 1024:.1f} KiB")
+        deliveries = report['deliveries']
+        self.stdout.write(f"Delivered {deliveries['received']}/{deliveries['expected']} price messages")
+        self.stdout.write(f"Delivery latency: {report['delivery_latency']}")
+        self.stdout.write(f"Time to last client per tick: {report['last_client_latency']}")
+        reconnect = report['reconnect']
+        self.stdout.write(
+            f"Reconnected {reconnect['succeeded']}/{reconnect['attempted']} at {reconnect['per_second']}/s"
+        )
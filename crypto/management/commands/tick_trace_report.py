@@ -0,0 +1,77 @@
+"""
+Per-stage latency percentiles from exported tick traces (see ``crypto.tracing``).
+
+Reads JSON-lines spans from a file or a log where each line ends in a span.
+It joins delivery spans to their tick by trace id.
+"""
+import json
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+# (name, from stage, to stage); the last three need delivery spans
+INTERVALS = (
+    ('fetch', 'started', 'fetched'),
+    ('persist', 'fetched', 'persisted'),
+    ('store', 'persisted', 'stored'),
+    ('publish', 'stored', 'published'),
+    ('tick', 'started', 'published'),
+    ('transport', 'published', 'received'),
+    ('send', 'received', 'delivered'),
+    ('end_to_end', 'started', 'delivered'),
+)
+
+
+def read_spans(path):
+    with open(path) as f:
+        for line in f:
+            start = line.find('{')
+            if start < 0:
+                continue
+            try:
+                yield json.loads(line[start:])
+            except ValueError:
+                continue
+
+
+class Command(BaseCommand):
+    help = 'Report per-stage tick latency percentiles from exported traces'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File written by TICK_TRACE_EXPORT (or a log containing the spans)')
+        parser.add_argument('--since', type=float, help='Only ticks started at or after this Unix time')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    def handle(self, *args, **options):
+        try:
+            spans = list(read_spans(options['path']))
+        except OSError as exc:
+            raise CommandError(str(exc))
+        ticks = {s['id']: s for s in spans if 'started' in s and 'id' in s}
+        if options['since'] is not None:
+            ticks = {k: t for k, t in ticks.items() if t['started'] >= options['since']}
+        deliveries = [{**ticks[s['id']], **s} for s in spans if 'delivered' in s and s.get('id') in ticks]
+
+        report = {'ticks': len(ticks), 'deliveries': len(deliveries), 'stages': {}}
+        for name, begin, end in INTERVALS:
+            rows = deliveries if end in ('received', 'delivered') else ticks.values()
+            samples = [r[end] - r[begin] for r in rows if begin in r and end in r]
+            if not samples:
+                continue
+            ms = np.asarray(samples) * 1000
+            report['stages'][name] = {
+                'count': int(ms.size),
+                **{f'p{p}_ms': round(float(np.percentile(ms, p)), 3) for p in (50, 90, 99)},
+                'max_ms': round(float(ms.max()), 3),
+            }
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{report['ticks']} ticks, {report['deliveries']} sampled deliveries")
+        self.stdout.write(f"{'stage':<12}{'count':>8}{'p50 ms':>12}{'p90 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+        for name, row in report['stages'].items():
+            self.stdout.write(
+                f"{name:<12}{row['count']:>8}{row['p50_ms']:>12.3f}{row['p90_ms']:>12.3f}"
+                f"{row['p99_ms']:>12.3f}{row['max_ms']:>12.3f}"
+            )
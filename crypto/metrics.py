@@ -0,0 +1,23 @@
+"""Metrics for the price pipeline; see ``backend.metrics``."""
+from backend import metrics
+
+TICK_SECONDS = metrics.histogram('crypto_tick_seconds', 'Duration of a price tick by stage', ['stage'])
+PROVIDER_REQUEST_SECONDS = metrics.histogram(
+    'crypto_provider_request_seconds', 'Market data provider call latency', ['provider', 'method', 'outcome'],
+)
+PRICE_ROWS_WRITTEN = metrics.counter('crypto_price_rows_written_total', 'CryptoPrice rows written by ingest')
+FANOUT_SECONDS = metrics.histogram('crypto_fanout_seconds', 'Time to hand one tick to the channel layer')
+FANOUT_MESSAGES = metrics.counter('crypto_fanout_messages_total', 'Channel layer group messages sent', ['type'])
+STORE_READS = metrics.counter(
+    'crypto_store_reads_total', 'Latest-price store reads by where they were served from', ['source'],
+)
+REGISTRY_LOADS = metrics.counter('crypto_asset_registry_loads_total', 'Asset registry loads from the database')
+
+WS_CONNECTIONS = metrics.gauge('crypto_ws_connections', 'Open price WebSocket connections')
+WS_CONNECTS = metrics.counter('crypto_ws_connects_total', 'Price WebSocket connection attempts', ['outcome'])
+WS_SUBSCRIPTIONS = metrics.counter('crypto_ws_subscriptions_total', 'Symbol subscriptions added on price sockets')
+WS_MESSAGES_SENT = metrics.counter('crypto_ws_messages_sent_total', 'Messages sent on price sockets', ['type'])
+WS_SEND_SECONDS = metrics.histogram(
+    'crypto_ws_send_seconds', 'Time to send one message on a price socket',
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+)
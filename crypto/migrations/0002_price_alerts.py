@@ -0,0 +1,33 @@
+# Generated by Django 5.2.5 on 2026-10-19 15:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crypto', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceAlert',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('direction', models.CharField(choices=[('above', 'Crosses above'), ('below', 'Crosses below')], max_length=8)),
+                ('threshold', models.DecimalField(decimal_places=8, max_digits=24)),
+                ('channel', models.CharField(choices=[('websocket', 'WebSocket'), ('email', 'Email')], default='websocket', max_length=16)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('triggered_at', models.DateTimeField(blank=True, null=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alerts', to='crypto.cryptoasset')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='price_alerts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'is_active'], name='crypto_pric_user_id_bc9b73_idx'), models.Index(fields=['asset', 'is_active'], name='crypto_pric_asset_i_70e803_idx')],
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.conf import settings
 from django.utils import timezone
 
 
@@ -32,3 +33,36 @@ class CryptoPrice(models.Model):
 
     def __str__(self):
         return f"{self.asset.symbol} @ {self.price_usd} ({self.last_updated.isoformat()})"
+
+
+class PriceAlert(models.Model):
+    DIRECTION_ABOVE = 'above'
+    DIRECTION_BELOW = 'below'
+    DIRECTION_CHOICES = [
+        (DIRECTION_ABOVE, 'Crosses above'),
+        (DIRECTION_BELOW, 'Crosses below'),
+    ]
+    CHANNEL_WEBSOCKET = 'websocket'
+    CHANNEL_EMAIL = 'email'
+    CHANNEL_CHOICES = [
+        (CHANNEL_WEBSOCKET, 'WebSocket'),
+        (CHANNEL_EMAIL, 'Email'),
+    ]
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='price_alerts')
+    asset = models.ForeignKey(CryptoAsset, on_delete=models.CASCADE, related_name='alerts')
+    direction = models.CharField(max_length=8, choices=DIRECTION_CHOICES)
+    threshold = models.DecimalField(max_digits=24, decimal_places=8)
+    channel = models.CharField(max_length=16, choices=CHANNEL_CHOICES, default=CHANNEL_WEBSOCKET)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    triggered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'is_active']),
+            models.Index(fields=['asset', 'is_active']),
+        ]
+
+    def __str__(self):
+        return f"{self.asset.symbol} {self.direction} {self.threshold} ({self.user_id})"
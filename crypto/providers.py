@@ -0,0 +1,269 @@
+"""
+Market data providers.
+
+Every provider returns market items in the CoinGecko ``/coins/markets`` shape
+(``id`` is our ``CryptoAsset.external_id``). ``ProviderPool`` puts the configured
+providers behind per-provider timeouts and circuit breakers, hedges a slow
+primary with the next provider, and merges the answers field by field.
+"""
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import PROVIDER_REQUEST_SECONDS
+from .scheduler import RateLimited
+
+
+class ProviderUnavailable(Exception):
+    pass
+
+
+class MarketDataProvider:
+    name = 'base'
+
+    def __init__(self, timeout=20, **options):
+        self.timeout = timeout
+        self.options = options
+
+    def fetch_markets(self, external_ids):
+        """Return market items for ``external_ids`` (at most 250 per call)."""
+        raise NotImplementedError
+
+    def fetch_fx_rates(self):
+        """Return fiat rates as units per USD, e.g. ``{'usd': 1.0, 'eur': 0.92}``."""
+        raise NotImplementedError
+
+
+class CoinGeckoProvider(MarketDataProvider):
+    name = 'coingecko'
+
+    def __init__(self, timeout=20, base_url=None, **options):
+        super().__init__(timeout=timeout, **options)
+        self.base_url = base_url or settings.CRYPTO_API_URL
+
+    def _get(self, path, params=None):
+        resp = requests.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        if resp.status_code == 429:
+            retry_after = resp.headers.get('Retry-After')
+            raise RateLimited(float(retry_after) if retry_after and retry_after.isdigit() else None)
+        resp.raise_for_status()
+        return resp.json()
+
+    def fetch_markets(self, external_ids):
+        return self._get('/coins/markets', {
+            'vs_currency': 'usd',
+            'ids': ','.join(external_ids),
+            'order': 'market_cap_desc',
+            'per_page': 250,
+            'page': 1,
+            'sparkline': 'false',
+            'price_change_percentage': '24h',
+        })
+
+    def fetch_fx_rates(self):
+        rates = self._get('/exchange_rates').get('rates') or {}
+        usd = (rates.get('usd') or {}).get('value')
+        if not usd:
+            return {}
+        return {
+            code: float(rate['value']) / float(usd)
+            for code, rate in rates.items()
+            if rate.get('type') == 'fiat' and rate.get('value')
+        }
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures; allows one probe after ``reset_timeout``."""
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether ``allow`` could let a call through; unlike ``allow``, takes no half-open probe."""
+        opened_at = self.opened_at
+        return opened_at is None or time.monotonic() - opened_at >= self.reset_timeout
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this call through, a failure re-opens immediately
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+def _merge_values(policy, values):
+    present = [v for v in values if v is not None]
+    if not present:
+        return None
+    if policy == 'median':
+        return statistics.median(present)
+    if policy == 'max':
+        return max(present)
+    if policy == 'min':
+        return min(present)
+    return present[0]  # 'primary': first provider that has a value
+
+
+def merge_markets(results, policy):
+    """
+    Merge ``[items, ...]`` (ordered by provider priority) into one item per id.
+    ``policy`` maps field names to 'primary', 'median', 'max' or 'min'; unlisted
+    fields use 'primary'.
+    """
+    by_id = {}
+    for items in results:
+        for item in items:
+            by_id.setdefault(item.get('id'), []).append(item)
+    merged = []
+    for item_id, versions in by_id.items():
+        if len(versions) == 1:
+            merged.append(versions[0])
+            continue
+        fields = {}
+        for version in versions:
+            for key in version:
+                fields.setdefault(key, None)
+        merged.append({
+            key: _merge_values(policy.get(key, 'primary'), [v.get(key) for v in versions])
+            for key in fields
+        })
+    return merged
+
+
+class ProviderPool:
+    def __init__(self, providers, hedge_after=2.0, merge_policy=None, failure_threshold=3, reset_timeout=30.0, max_workers=8):
+        self.providers = list(providers)
+        self.hedge_after = hedge_after
+        self.merge_policy = merge_policy or {}
+        self.breakers = {p.name: CircuitBreaker(failure_threshold, reset_timeout) for p in self.providers}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='market-data')
+
+    def _available(self):
+        return [p for p in self.providers if self.breakers[p.name].available()]
+
+    def _record(self, provider, method, started, future):
+        # Runs when the call finishes, even if the pool stopped waiting for it
+        exc = future.exception()
+        if exc is None:
+            self.breakers[provider.name].record_success()
+        else:
+            self.breakers[provider.name].record_failure()
+        outcome = 'ok' if exc is None else 'rate_limited' if isinstance(exc, RateLimited) else 'error'
+        PROVIDER_REQUEST_SECONDS.labels(provider.name, method, outcome).observe(time.monotonic() - started)
+
+    def _call(self, method, *args):
+        """
+        Call ``method`` on the first available provider. If it has not answered
+        after ``hedge_after`` seconds, or fails, the next provider is started too.
+        Returns the successful results ordered by provider priority.
+        """
+        candidates = self._available()
+        if not candidates:
+            raise ProviderUnavailable('All market data providers are open-circuited')
+        pending = {}
+        results = {}
+        errors = []
+        queue = list(candidates)
+        deadline = time.monotonic()
+
+        def launch():
+            nonlocal deadline
+            while queue:
+                provider = queue.pop(0)
+                # Only the provider actually called takes a half-open probe
+                if not self.breakers[provider.name].allow():
+                    continue  # another call took the probe first
+                started = time.monotonic()
+                future = self.executor.submit(getattr(provider, method), *args)
+                future.add_done_callback(lambda f, p=provider: self._record(p, method, started, f))
+                pending[future] = provider
+                deadline = max(deadline, time.monotonic() + provider.timeout)
+                return True
+            return False
+
+        if not launch():
+            raise ProviderUnavailable('All market data providers are open-circuited')
+        while pending and not results:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            timeout = min(self.hedge_after, remaining) if queue else remaining
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                if queue:
+                    launch()  # primary is slow: hedge with the next provider
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    results[provider.name] = future.result()
+                except Exception as exc:
+                    errors.append(exc)
+                    if queue and not pending:
+                        launch()
+        # Merge anything else that has already finished, without waiting for it
+        for future, provider in pending.items():
+            if future.done() and future.exception() is None:
+                results[provider.name] = future.result()
+        if not results:
+            if any(isinstance(e, RateLimited) for e in errors):
+                raise next(e for e in errors if isinstance(e, RateLimited))
+            raise ProviderUnavailable(f'No market data provider answered: {errors!r}')
+        return [results[p.name] for p in self.providers if p.name in results]
+
+    def fetch_markets(self, external_ids):
+        return merge_markets(self._call('fetch_markets', external_ids), self.merge_policy)
+
+    def fetch_fx_rates(self):
+        return self._call('fetch_fx_rates')[0]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def build_pool(config=None):
+    config = config or settings.CRYPTO_PROVIDERS
+    providers = [
+        import_string(entry['class'])(**{k: v for k, v in entry.items() if k != 'class'})
+        for entry in config['providers']
+    ]
+    return ProviderPool(
+        providers,
+        hedge_after=config.get('hedge_after', 2.0),
+        merge_policy=config.get('merge_policy'),
+        failure_threshold=config.get('failure_threshold', 3),
+        reset_timeout=config.get('reset_timeout', 30.0),
+    )
+
+
+def get_provider_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = build_pool()
+    return _pool
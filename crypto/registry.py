@@ -0,0 +1,130 @@
+"""
+In-process asset registry.
+
+The asset universe changes only when a coin is listed or edited, yet views and
+the ingest task need it on every call. Each process loads every
+``CryptoAsset`` once into ``AssetRecord``s indexed by symbol, id and
+external id. It also pre-serializes the symbol list and its ETag.
+
+Saving or deleting an asset bumps a version in Redis and publishes it on
+``ASSETS_CHANNEL`` (see ``crypto.signals``). A daemon thread in each process
+listens there and marks the local registry stale, so the next read compares
+versions and reloads. A process without a working subscription still
+re-checks the version every ``CHECK_SECONDS``. Code that writes assets without
+signals, such as ``bulk_create``, should call ``bump_assets_version`` itself.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from backend.redis_client import get_redis
+from .metrics import REGISTRY_LOADS
+from .models import CryptoAsset
+
+logger = logging.getLogger(__name__)
+
+ASSETS_VERSION_KEY = 'crypto:assets:version'
+ASSETS_CHANNEL = 'crypto:assets:changed'
+CHECK_SECONDS = 30.0
+RESUBSCRIBE_SECONDS = 5.0
+
+
+class AssetRecord:
+    __slots__ = ('id', 'symbol', 'name', 'external_id', 'logo_url')
+
+    def __init__(self, id, symbol, name, external_id, logo_url):
+        self.id = id
+        self.symbol = symbol
+        self.name = name
+        self.external_id = external_id
+        self.logo_url = logo_url
+
+
+class AssetRegistry:
+    def __init__(self, version, records):
+        self.version = version
+        self.records = sorted(records, key=lambda r: r.symbol)
+        self.by_symbol = {r.symbol: r for r in self.records}
+        self.by_id = {r.id: r for r in self.records}
+        self.by_external_id = {r.external_id: r for r in self.records}
+        self.symbols_json = json.dumps(
+            [{'symbol': r.symbol, 'name': r.name, 'logo_url': r.logo_url} for r in self.records],
+            separators=(',', ':'),
+        ).encode()
+        self.etag = f'"{hashlib.blake2b(self.symbols_json, digest_size=12).hexdigest()}"'
+
+
+def load_registry(version=None):
+    REGISTRY_LOADS.inc()
+    rows = CryptoAsset.objects.values_list('id', 'symbol', 'name', 'external_id', 'logo_url')
+    return AssetRegistry(version, [AssetRecord(*row) for row in rows])
+
+
+_local = {'registry': None, 'stale': True, 'checked_at': 0.0, 'listener': None, 'pid': None}
+
+
+def bump_assets_version():
+    """Make every process reload its registry; call after changing assets without model signals."""
+    _local['registry'] = None
+    try:
+        client = get_redis()
+        client.publish(ASSETS_CHANNEL, client.incr(ASSETS_VERSION_KEY))
+    except Exception:
+        # Other processes catch up within CHECK_SECONDS of Redis coming back
+        logger.warning('Could not publish an asset registry change', exc_info=True)
+
+
+def _read_version():
+    try:
+        return int(get_redis().get(ASSETS_VERSION_KEY) or 0)
+    except Exception:
+        logger.debug('Asset registry version unavailable', exc_info=True)
+        return None
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(ASSETS_CHANNEL)
+            _local['stale'] = True  # changes published while unsubscribed were missed
+            for _ in pubsub.listen():
+                _local['stale'] = True
+        except Exception:
+            logger.debug('Asset registry subscription lost', exc_info=True)
+        time.sleep(RESUBSCRIBE_SECONDS)
+
+
+def _ensure_listener():
+    # Threads do not survive a fork, so each worker process starts its own
+    if _local['pid'] == os.getpid():
+        return
+    _local['pid'] = os.getpid()
+    _local['stale'] = True
+    listener = threading.Thread(target=_listen, name='asset-registry-listener', daemon=True)
+    listener.start()
+    _local['listener'] = listener
+
+
+def get_registry():
+    _ensure_listener()
+    registry = _local['registry']
+    now = time.monotonic()
+    if registry is not None and not _local['stale'] and now - _local['checked_at'] < CHECK_SECONDS:
+        return registry
+    # Cleared before reading so that a change arriving during the reload marks it stale again
+    _local['stale'] = False
+    _local['checked_at'] = now
+    version = _read_version()
+    if registry is None or registry.version != version:
+        registry = load_registry(version)
+        _local['registry'] = registry
+    return registry
+
+
+def reset():
+    """Forget this process's registry, e.g. between tests."""
+    _local.update(registry=None, stale=True, checked_at=0.0)
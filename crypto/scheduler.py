@@ -0,0 +1,190 @@
+"""
+Tiered adaptive polling.
+
+Assets are sorted into hot, warm and cold tiers from their subscriber count
+(watchlists and active alerts), 24h volatility and 24h volume. Each tier has
+its own polling interval. Every run picks the assets that are due, spends at
+most the remaining per-minute API budget on them (hot first, most overdue
+first) and backs off exponentially, with jitter, when the upstream fails or
+answers HTTP 429. Reads never wait on this: they keep serving the last good
+snapshot, marked stale once it is older than its tier allows.
+"""
+import math
+import random
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+from backend.redis_client import get_redis
+from users.models import WatchlistItem
+from .models import PriceAlert
+from .registry import get_registry
+
+TIER_HOT = 'hot'
+TIER_WARM = 'warm'
+TIER_COLD = 'cold'
+TIERS = (TIER_HOT, TIER_WARM, TIER_COLD)
+
+# Provider limit for ids per /coins/markets call
+IDS_PER_CALL = 250
+# Calls every tick makes besides /coins/markets: the FX table
+FX_CALLS = 1
+
+TIERS_KEY = 'crypto:poll:tiers'
+# Redis hash of external id -> time it was last polled
+LAST_POLLED_KEY = 'crypto:poll:last'
+BACKOFF_KEY = 'crypto:poll:backoff'
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=None):
+        super().__init__('Provider rate limit exceeded')
+        self.retry_after = retry_after
+
+
+def classify(subscribers, change_24h_percent, volume_24h_usd):
+    rules = settings.CRYPTO_TIER_RULES
+    volatility = abs(change_24h_percent or 0)
+    volume = volume_24h_usd or 0
+    hot, warm = rules[TIER_HOT], rules[TIER_WARM]
+    if (
+        subscribers >= hot['subscribers']
+        or volatility >= hot['volatility']
+        or volume >= hot['volume_usd']
+    ):
+        return TIER_HOT
+    if (
+        subscribers >= warm['subscribers']
+        or volatility >= warm['volatility']
+        or volume >= warm['volume_usd']
+    ):
+        return TIER_WARM
+    return TIER_COLD
+
+
+def subscriber_counts():
+    counts = {}
+    watchers = WatchlistItem.objects.values('asset_id').annotate(n=Count('id')).values_list('asset_id', 'n')
+    alerts = (
+        PriceAlert.objects.filter(is_active=True)
+        .values('asset_id').annotate(n=Count('id')).values_list('asset_id', 'n')
+    )
+    for asset_id, n in list(watchers) + list(alerts):
+        counts[asset_id] = counts.get(asset_id, 0) + n
+    return counts
+
+
+def compute_tiers(payloads):
+    """Return ``{external_id: tier}`` for every asset."""
+    counts = subscriber_counts()
+    tiers = {}
+    for asset in get_registry().records:
+        payload = payloads.get(asset.symbol) or {}
+        tiers[asset.external_id] = classify(
+            counts.get(asset.id, 0),
+            payload.get('change_24h_percent'),
+            payload.get('volume_24h_usd'),
+        )
+    return tiers
+
+
+def get_tiers(payloads):
+    tiers = cache.get(TIERS_KEY)
+    if tiers is None:
+        tiers = compute_tiers(payloads)
+        cache.set(TIERS_KEY, tiers, settings.CRYPTO_TIER_REFRESH_SECONDS)
+    return tiers
+
+
+def due_assets(tiers, last_polled, now):
+    """External ids that are due, ordered hot first and most overdue first."""
+    intervals = settings.CRYPTO_POLL_INTERVALS
+    due = []
+    for external_id, tier in tiers.items():
+        interval = intervals[tier]
+        overdue = now - last_polled.get(external_id, 0) - interval
+        if overdue >= 0:
+            due.append((TIERS.index(tier), -overdue, external_id))
+    due.sort()
+    return [external_id for _, _, external_id in due]
+
+
+def _minute_key(now):
+    return f'crypto:poll:calls:{int(now // 60)}'
+
+
+def remaining_budget(now):
+    used = cache.get(_minute_key(now), 0)
+    return max(settings.CRYPTO_API_CALLS_PER_MINUTE - used, 0)
+
+
+def spend_budget(now, calls):
+    key = _minute_key(now)
+    if not cache.add(key, calls, timeout=120):
+        cache.incr(key, calls)
+
+
+def allocate(due, now):
+    """Trim ``due`` to what the remaining per-minute budget can fetch, after the tick's FX call."""
+    calls = min(remaining_budget(now) - FX_CALLS, math.ceil(len(due) / IDS_PER_CALL))
+    return due[:max(calls, 0) * IDS_PER_CALL]
+
+
+def backoff_active(now):
+    state = cache.get(BACKOFF_KEY)
+    return bool(state and now < state['until'])
+
+
+def record_upstream_failure(now, retry_after=None):
+    state = cache.get(BACKOFF_KEY) or {'level': 0}
+    level = state['level'] + 1
+    delay = min(settings.CRYPTO_BACKOFF_BASE_SECONDS * 2 ** (level - 1), settings.CRYPTO_BACKOFF_MAX_SECONDS)
+    delay = max(delay * random.uniform(0.5, 1.0), retry_after or 0)
+    cache.set(BACKOFF_KEY, {'level': level, 'until': now + delay}, timeout=None)
+    return delay
+
+
+def clear_backoff():
+    cache.delete(BACKOFF_KEY)
+
+
+def shard(external_ids, shards):
+    """Split ids into ``[(shard, ids), ...]`` by a stable hash; empty shards are left out."""
+    buckets = {}
+    for external_id in external_ids:
+        buckets.setdefault(zlib.crc32(external_id.encode()) % shards, []).append(external_id)
+    return sorted(buckets.items())
+
+
+def max_age_for(external_id):
+    """Seconds a price may age before it is stale: a few missed polls of its tier."""
+    tiers = cache.get(TIERS_KEY) or {}
+    interval = settings.CRYPTO_POLL_INTERVALS[tiers.get(external_id, TIER_COLD)]
+    return interval * settings.CRYPTO_STALE_AFTER_INTERVALS
+
+
+def mark_polled(external_ids, now):
+    # One field per id, so poll_prices and finalize_tick never overwrite each other's ids
+    if external_ids:
+        get_redis().hset(LAST_POLLED_KEY, mapping=dict.fromkeys(external_ids, now))
+
+
+def last_polled(external_ids):
+    """``{external_id: last polled time}`` for those of ``external_ids`` polled before."""
+    if not external_ids:
+        return {}
+    times = get_redis().hmget(LAST_POLLED_KEY, external_ids)
+    return {external_id: float(t) for external_id, t in zip(external_ids, times) if t is not None}
+
+
+def plan(payloads, now=None):
+    """Pick the external ids to poll in this run, or ``[]`` while backing off."""
+    now = now or time.time()
+    if backoff_active(now):
+        return []
+    tiers = get_tiers(payloads)
+    due = due_assets(tiers, last_polled(list(tiers)), now)
+    return allocate(due, now)
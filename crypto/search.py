@@ -0,0 +1,154 @@
+"""
+Asset search for autocomplete.
+
+The index is built from the asset registry and rebuilt whenever the registry
+reloads. Symbols, and full names with each of their words, are kept in sorted
+arrays, so a prefix lookup is two bisections. A query of three or more
+characters that finds too few prefix matches also looks up words that share
+most of its trigrams, which catches typos. Exact symbols rank first, then
+symbol prefixes, name prefixes and close words. Each group is ordered by
+market cap from the latest-price store. Nothing here queries
+the database once the registry and the price snapshot are loaded.
+"""
+import heapq
+import math
+from bisect import bisect_left
+
+from .registry import get_registry
+from .store import MONEY_FIELDS, get_snapshot
+
+MIN_FUZZY_LENGTH = 3
+MIN_SIMILARITY = 0.4  # share of the query's trigrams a fuzzy match must contain
+# Up to this many candidates are sorted by market cap. Past it, assets are
+# walked in market-cap order until enough match, which for a broad query
+# ends within a few steps.
+SORT_MAX_CANDIDATES = 256
+
+_MARKET_CAP = MONEY_FIELDS.index('market_cap_usd')
+_EMPTY = frozenset()
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def trigrams(term):
+    padded = f' {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _sorted_terms(pairs):
+    pairs = sorted(pairs)
+    return [term for term, _ in pairs], [i for _, i in pairs]
+
+
+class SearchIndex:
+    def __init__(self, records):
+        self.records = records
+        self.symbols = [r.symbol.lower() for r in records]
+        self.by_symbol = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.words = []
+        self.vocabulary = {}  # single word (symbol or word of a name) -> records using it
+        for i, record in enumerate(records):
+            name = normalize(record.name)
+            words = (name, *sorted(set(name.split()) - {name}))
+            self.words.append(words)
+            for word in (self.symbols[i], *name.split()):
+                self.vocabulary.setdefault(word, set()).add(i)
+        self.symbol_keys, self.symbol_ids = _sorted_terms((symbol, i) for i, symbol in enumerate(self.symbols))
+        self.word_keys, self.word_ids = _sorted_terms((word, i) for i, words in enumerate(self.words) for word in words)
+        self.trigrams = {}  # trigram -> vocabulary words containing it
+        for word in self.vocabulary:
+            for gram in trigrams(word):
+                self.trigrams.setdefault(gram, set()).add(word)
+        self._ranked_version = None
+
+    def rank(self, snapshot):
+        """Market caps from this snapshot, and records ordered by them; computed once per store version."""
+        if self._ranked_version != snapshot.version:
+            caps = snapshot.money[:, _MARKET_CAP].tolist() if len(snapshot.symbols) else []
+            index = snapshot.index
+            self.caps = [
+                None if (row := index.get(r.symbol)) is None or math.isnan(caps[row]) else caps[row]
+                for r in self.records
+            ]
+            self.order = sorted(range(len(self.records)), key=lambda i: (-(self.caps[i] or 0.0), self.symbols[i]))
+            self.position = [0] * len(self.order)
+            for position, i in enumerate(self.order):
+                self.position[i] = position
+            self._ranked_version = snapshot.version
+        return self.caps
+
+    def _best(self, candidates, matches, exclude, n):
+        """The ``n`` largest by market cap of ``candidates``, or of the records ``matches`` accepts."""
+        if candidates is not None and len(candidates) > SORT_MAX_CANDIDATES:
+            candidates, matches = None, candidates.__contains__
+        if candidates is not None:
+            return heapq.nsmallest(n, candidates - exclude, key=self.position.__getitem__)
+        best = []
+        for i in self.order:
+            if i not in exclude and matches(i):
+                best.append(i)
+                if len(best) == n:
+                    break
+        return best
+
+    def _prefix(self, keys, ids, query):
+        lo = bisect_left(keys, query)
+        hi = bisect_left(keys, query + '\uffff', lo)
+        return set(ids[lo:hi]) if hi - lo <= SORT_MAX_CANDIDATES else None
+
+    def fuzzy(self, query):
+        """Records with a word close to ``query``: sharing enough trigrams, within two letters of its length."""
+        wanted = trigrams(query)
+        needed = math.ceil(MIN_SIMILARITY * len(wanted))
+        postings = sorted((self.trigrams.get(gram, _EMPTY) for gram in wanted), key=len)
+        # A word sharing ``needed`` trigrams shares at least one of the rarest len - needed + 1
+        words = set().union(*postings[:len(postings) - needed + 1])
+        records = set()
+        for word in words:
+            if abs(len(word) - len(query)) <= 2 and sum(word in p for p in postings) >= needed:
+                records |= self.vocabulary[word]
+        return records
+
+    def search(self, query, limit, snapshot):
+        query = normalize(query)
+        if not query:
+            return []
+        caps = self.rank(snapshot)
+        found = []
+        seen = set()
+
+        def add(ids):
+            found.extend(ids)
+            seen.update(ids)
+
+        exact = self.by_symbol.get(query)
+        if exact is not None:
+            add([exact])
+        steps = (
+            (self._prefix(self.symbol_keys, self.symbol_ids, query), lambda i: self.symbols[i].startswith(query)),
+            (self._prefix(self.word_keys, self.word_ids, query), lambda i: any(w.startswith(query) for w in self.words[i])),
+        )
+        for candidates, matches in steps:
+            if len(found) < limit:
+                add(self._best(candidates, matches, seen, limit - len(found)))
+        if len(found) < limit and len(query) >= MIN_FUZZY_LENGTH:
+            add(self._best(self.fuzzy(query), None, seen, limit - len(found)))
+        return [(self.records[i], caps[i]) for i in found]
+
+
+_local = {'registry': None, 'index': None}
+
+
+def get_search_index():
+    registry = get_registry()
+    if _local['registry'] is not registry:
+        _local['index'] = SearchIndex(registry.records)
+        _local['registry'] = registry
+    return _local['index']
+
+
+def search_assets(query, limit=10):
+    """Up to ``limit`` ``(record, market cap)`` pairs for ``query``, best first."""
+    return get_search_index().search(query, limit, get_snapshot())
@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from .models import PriceAlert
 
 
 class CryptoPriceBasicSerializer(serializers.Serializer):
@@ -8,6 +9,8 @@ class CryptoPriceBasicSerializer(serializers.Serializer):
     price_usd = serializers.FloatField()
     change_24h_percent = serializers.FloatField()
     last_updated = serializers.CharField()
+    age_seconds = serializers.FloatField(help_text="Seconds since the price was fetched")
+    stale = serializers.BooleanField(help_text="True when the price is older than its polling tier allows")
 
 
 class CryptoPricePremiumSerializer(CryptoPriceBasicSerializer):
@@ -28,9 +31,39 @@ class CryptoSymbolSerializer(serializers.Serializer):
     logo_url = serializers.URLField(allow_null=True)
 
 
+class AssetSearchResultSerializer(CryptoSymbolSerializer):
+    """Asset search hit"""
+    market_cap_usd = serializers.FloatField(allow_null=True)
+
+
 class LatestPricesQuerySerializer(serializers.Serializer):
     """Query parameters for latest prices endpoint"""
     symbols = serializers.CharField(
         required=False,
         help_text="Comma-separated list of crypto symbols (e.g., BTC,ETH,ADA)"
-    )
\ No newline at end of file
+    )
+    vs = serializers.CharField(
+        required=False,
+        default='usd',
+        help_text="Quote currency (e.g., usd, eur, gbp)"
+    )
+
+
+class PriceAlertCreateSerializer(serializers.Serializer):
+    """Input for creating a price alert"""
+    symbol = serializers.CharField(max_length=16)
+    direction = serializers.ChoiceField(choices=PriceAlert.DIRECTION_CHOICES)
+    threshold = serializers.DecimalField(max_digits=24, decimal_places=8, min_value=0)
+    channel = serializers.ChoiceField(choices=PriceAlert.CHANNEL_CHOICES, default=PriceAlert.CHANNEL_WEBSOCKET)
+
+
+class PriceAlertSerializer(serializers.Serializer):
+    """Price alert as returned by the API"""
+    id = serializers.IntegerField()
+    symbol = serializers.CharField()
+    direction = serializers.CharField()
+    threshold = serializers.FloatField()
+    channel = serializers.CharField()
+    is_active = serializers.BooleanField()
+    created_at = serializers.DateTimeField()
+    triggered_at = serializers.DateTimeField(allow_null=True)
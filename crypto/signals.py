@@ -0,0 +1,26 @@
+from functools import partial
+
+from django.db.models.signals import post_delete, post_save
+from django.db import transaction
+from django.dispatch import receiver
+
+from .alerts import alert_entry, record_alert_change
+from .models import CryptoAsset, PriceAlert
+from .registry import bump_assets_version
+
+
+@receiver(post_save, sender=PriceAlert)
+def log_alert_saved(sender, instance, **kwargs):
+    entry = alert_entry(instance) if instance.is_active else None
+    transaction.on_commit(partial(record_alert_change, instance.pk, entry))
+
+
+@receiver(post_delete, sender=PriceAlert)
+def log_alert_deleted(sender, instance, **kwargs):
+    transaction.on_commit(partial(record_alert_change, instance.pk))
+
+
+@receiver(post_save, sender=CryptoAsset)
+@receiver(post_delete, sender=CryptoAsset)
+def invalidate_asset_registry(sender, **kwargs):
+    transaction.on_commit(bump_assets_version)
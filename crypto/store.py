@@ -0,0 +1,227 @@
+"""
+Latest-price store.
+
+The ingest task publishes the payload of every asset after each tick to the
+shared cache, together with a small fiat FX table (units per USD). Readers keep
+a per-process ``PriceSnapshot`` with the monetary fields laid out as a NumPy
+matrix, and only reload it when the published version changes. Quotes in other
+currencies are derived from the USD snapshot with one vectorized multiply and
+kept on the snapshot for the rest of the tick.
+
+Each symbol also carries freshness metadata (when it was fetched and how old it
+may get before it counts as stale), so reads keep serving the last good values
+while the upstream is down and tell clients how old they are.
+"""
+import math
+import time
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import OuterRef, Subquery
+
+from .metrics import STORE_READS
+from .models import CryptoAsset, CryptoPrice
+
+LATEST_KEY = 'crypto:latest'
+LATEST_VERSION_KEY = 'crypto:latest:version'
+FX_KEY = 'crypto:fx'
+FRESHNESS_KEY = 'crypto:freshness'
+BASE_CURRENCY = 'usd'
+# Payload fields holding an amount in the base currency
+MONEY_FIELDS = ('price_usd', 'market_cap_usd', 'volume_24h_usd', 'ath', 'atl')
+# How long a process trusts its snapshot before checking the published version
+LOCAL_TTL_SECONDS = 1.0
+
+
+def currency_field(field, vs):
+    """Name of a payload field once converted, e.g. ``price_usd`` -> ``price_eur``."""
+    if vs != BASE_CURRENCY and field.endswith('_usd'):
+        return f'{field[:-4]}_{vs}'
+    return field
+
+
+def convert_payload(payload, vs, rate):
+    """Convert a single USD payload; used for per-message WebSocket conversion."""
+    if vs == BASE_CURRENCY:
+        return payload
+    return {
+        currency_field(field, vs): (value * rate if field in MONEY_FIELDS and value is not None else value)
+        for field, value in payload.items()
+    }
+
+
+class PriceSnapshot:
+    __slots__ = (
+        'version', 'symbols', 'index', 'prices', 'payloads', 'money', 'fx',
+        'fetched_at', 'max_age', '_converted',
+    )
+
+    def __init__(self, version, payloads, fx=None, freshness=None):
+        self.version = version
+        self.payloads = payloads
+        self.symbols = sorted(payloads)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.money = np.array(
+            [[payloads[s].get(f) for f in MONEY_FIELDS] for s in self.symbols],
+            dtype=np.float64,
+        ).reshape(len(self.symbols), len(MONEY_FIELDS))
+        self.prices = self.money[:, 0]
+        self.fx = dict(fx or {})
+        self.fx[BASE_CURRENCY] = 1.0
+        freshness = freshness or {}
+        default_max_age = settings.CRYPTO_STALE_AFTER_SECONDS
+        fetched_at, max_age = [], []
+        for symbol in self.symbols:
+            fetched, age = freshness.get(symbol) or (_parse_timestamp(payloads[symbol]['last_updated']), default_max_age)
+            fetched_at.append(fetched)
+            max_age.append(age)
+        self.fetched_at = np.array(fetched_at, dtype=np.float64)
+        self.max_age = np.array(max_age, dtype=np.float64)
+        self._converted = {}
+
+    def with_freshness(self, payloads, now=None):
+        """Copies of ``payloads`` with ``age_seconds`` and ``stale`` added."""
+        if not payloads:
+            return []
+        now = now or time.time()
+        rows = np.fromiter((self.index[p['symbol']] for p in payloads), dtype=np.intp, count=len(payloads))
+        ages = np.maximum(now - self.fetched_at[rows], 0)
+        stale = ages > self.max_age[rows]
+        return [
+            {**payload, 'age_seconds': round(age, 1), 'stale': is_stale}
+            for payload, age, is_stale in zip(payloads, ages.tolist(), stale.tolist())
+        ]
+
+    def payloads_for(self, vs):
+        """Payloads quoted in ``vs``; raises ``KeyError`` if there is no FX rate for it."""
+        if vs == BASE_CURRENCY:
+            return self.payloads
+        converted = self._converted.get(vs)
+        if converted is None:
+            money = (self.money * self.fx[vs]).tolist()
+            converted = {}
+            for i, symbol in enumerate(self.symbols):
+                amounts = dict(zip(MONEY_FIELDS, money[i]))
+                payload = {}
+                for field, value in self.payloads[symbol].items():
+                    if field in amounts:
+                        value = None if math.isnan(amounts[field]) else amounts[field]
+                    payload[currency_field(field, vs)] = value
+                converted[symbol] = payload
+            self._converted[vs] = converted
+        return converted
+
+    def indices(self, symbols):
+        """Positions of ``symbols`` in ``prices``; unknown symbols map to -1."""
+        index = self.index
+        return np.fromiter((index.get(s, -1) for s in symbols), dtype=np.intp, count=len(symbols))
+
+    def prices_for(self, indices):
+        """Vectorized lookup of prices by index; -1 yields NaN."""
+        if not len(self.prices):
+            return np.full(len(indices), np.nan)
+        out = self.prices[indices]
+        out[indices < 0] = np.nan
+        return out
+
+
+_local = {'snapshot': None, 'checked_at': 0.0}
+_reads = {source: STORE_READS.labels(source) for source in ('local', 'cache', 'db')}
+
+
+def publish_snapshot(payloads, fx=None, freshness=None):
+    """
+    Merge this tick's ``{symbol: payload}`` and ``{symbol: (fetched_at, max_age)}``
+    into the store, replace the FX table when one is given, and bump the store
+    version.
+    """
+    merged = dict(cache.get(LATEST_KEY) or {})
+    merged.update(payloads)
+    cache.set(LATEST_KEY, merged, timeout=None)
+    if freshness:
+        merged_freshness = dict(cache.get(FRESHNESS_KEY) or {})
+        merged_freshness.update(freshness)
+        cache.set(FRESHNESS_KEY, merged_freshness, timeout=None)
+    if fx:
+        cache.set(FX_KEY, fx, timeout=None)
+    if not cache.add(LATEST_VERSION_KEY, 1, timeout=None):
+        try:
+            return cache.incr(LATEST_VERSION_KEY)
+        except ValueError:
+            cache.set(LATEST_VERSION_KEY, 1, timeout=None)
+    return 1
+
+
+def published_prices():
+    """``{symbol: price_usd}`` as last published to the shared store, bypassing the local snapshot."""
+    return {symbol: payload['price_usd'] for symbol, payload in (cache.get(LATEST_KEY) or {}).items()}
+
+
+def peek_snapshot(version=None):
+    """Return the local snapshot without any I/O if it is at least ``version``."""
+    snapshot = _local['snapshot']
+    if snapshot is not None and (version is None or snapshot.version >= version):
+        return snapshot
+    return None
+
+
+def get_snapshot():
+    snapshot = _local['snapshot']
+    now = time.monotonic()
+    if snapshot is not None and now - _local['checked_at'] < LOCAL_TTL_SECONDS:
+        _reads['local'].inc()
+        return snapshot
+    _local['checked_at'] = now
+    version = cache.get(LATEST_VERSION_KEY)
+    if snapshot is not None and snapshot.version == version:
+        _reads['local'].inc()
+        return snapshot
+    payloads = cache.get(LATEST_KEY) if version is not None else None
+    if payloads is None:
+        _reads['db'].inc()
+        payloads = load_payloads_from_db()
+        version = 0
+    else:
+        _reads['cache'].inc()
+    snapshot = PriceSnapshot(version, payloads, cache.get(FX_KEY), cache.get(FRESHNESS_KEY))
+    _local['snapshot'] = snapshot
+    return snapshot
+
+
+def load_payloads_from_db():
+    """Cold start: build payloads from the most recent ``CryptoPrice`` per asset."""
+    latest_price_sub = CryptoPrice.objects.filter(asset=OuterRef('pk')).order_by('-last_updated')
+    assets = CryptoAsset.objects.annotate(latest_price_id=Subquery(latest_price_sub.values('id')[:1]))
+    assets = {a.latest_price_id: a for a in assets if a.latest_price_id}
+    payloads = {}
+    for price in CryptoPrice.objects.filter(id__in=list(assets)):
+        asset = assets[price.id]
+        payloads[asset.symbol] = price_payload(asset, price)
+    return payloads
+
+
+def _parse_timestamp(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _float_or_none(value):
+    return float(value) if value is not None else None
+
+
+def price_payload(asset, price):
+    return {
+        'symbol': asset.symbol,
+        'name': asset.name,
+        'price_usd': float(price.price_usd),
+        'change_24h_percent': float(price.change_24h_percent),
+        'last_updated': price.last_updated.isoformat().replace('+00:00', 'Z'),
+        'market_cap_usd': _float_or_none(price.market_cap_usd),
+        'volume_24h_usd': _float_or_none(price.volume_24h_usd),
+        'circulating_supply': _float_or_none(price.circulating_supply),
+        'total_supply': _float_or_none(price.total_supply),
+        'ath': _float_or_none(price.ath),
+        'atl': _float_or_none(price.atl),
+        'logo_url': asset.logo_url,
+    }
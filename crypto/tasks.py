@@ -1,52 +1,115 @@
+import logging
+import math
 import os
-import requests
-from celery import shared_task
+import time
+from celery import chord, shared_task
 from django.conf import settings
 from django.utils import timezone
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from .models import CryptoAsset, CryptoPrice
-
-
-def coingecko_fetch(ids_csv: str):
-    url = f"{settings.CRYPTO_API_URL}/coins/markets"
-    params = {
-        'vs_currency': 'usd',
-        'ids': ids_csv,
-        'order': 'market_cap_desc',
-        'per_page': 250,
-        'page': 1,
-        'sparkline': 'false',
-        'price_change_percentage': '24h',
-    }
-    resp = requests.get(url, params=params, timeout=20)
-    resp.raise_for_status()
-    return resp.json()
+from . import scheduler, tracing
+from .alerts import alert_payload, evaluate_alerts
+from .locks import Lease
+from .metrics import FANOUT_MESSAGES, FANOUT_SECONDS, PRICE_ROWS_WRITTEN, TICK_SECONDS
+from .models import CryptoAsset, CryptoPrice, PriceAlert
+from .providers import ProviderUnavailable, get_provider_pool
+from .registry import get_registry
+from .scheduler import RateLimited
+from .store import get_snapshot, price_payload, publish_snapshot, published_prices
+from users.mail import queue_email
+
+logger = logging.getLogger(__name__)
+
+# Sockets that asked for a per-tick portfolio value
+PORTFOLIO_GROUP = 'portfolio_ticks'
 
 
 @shared_task
-def fetch_and_broadcast_prices():
-    assets = list(CryptoAsset.objects.all())
+def poll_prices():
+    """
+    Beat entry point: fetch only the assets whose tier interval has elapsed.
+    With ``CRYPTO_INGEST_SHARDS`` > 1 the due assets are split into hash shards
+    that run as separate tasks, and ``finalize_tick`` publishes their combined
+    results as one tick.
+    """
+    now = time.time()
+    external_ids = scheduler.plan(get_snapshot().payloads, now)
+    if not external_ids:
+        return 0
+    # One /coins/markets call per chunk of ids, plus the FX table
+    scheduler.spend_budget(now, math.ceil(len(external_ids) / scheduler.IDS_PER_CALL) + scheduler.FX_CALLS)
+    scheduler.mark_polled(external_ids, now)
+    shards = scheduler.shard(external_ids, settings.CRYPTO_INGEST_SHARDS)
+    if len(shards) == 1:
+        shard, ids = shards[0]
+        return finalize_tick([ingest_prices_shard(shard, ids)])
+    chord(ingest_prices_shard.s(shard, ids) for shard, ids in shards)(finalize_tick.s())
+    return len(external_ids)
+
+
+@shared_task
+def ingest_prices_shard(shard, external_ids):
+    """Fetch and store one shard under its lease; broadcasting is left to ``finalize_tick``."""
+    lease = Lease(f'crypto:ingest:{shard}', ttl=settings.CRYPTO_INGEST_LEASE_SECONDS)
+    if not lease.acquire():
+        # A previous run still owns this shard; finalize_tick makes these assets due again
+        return {'shard': shard, 'skipped': external_ids}
+
+    def renew():
+        if not lease.renew():
+            logger.warning('Lost the ingest lease of shard %s while fetching', shard)
+
+    try:
+        result = ingest_markets(external_ids, before_call=renew)
+    except (RateLimited, ProviderUnavailable) as exc:
+        # Readers keep the last good snapshot; retry after a jittered backoff
+        delay = scheduler.record_upstream_failure(time.time(), getattr(exc, 'retry_after', None))
+        logger.warning('Price refresh of shard %s failed (%s); retrying in %.0fs', shard, exc, delay)
+        return {'shard': shard, 'failed': external_ids}
+    finally:
+        lease.release()
+    result['shard'] = shard
+    return result
+
+
+def ingest_markets(external_ids=None, before_call=None):
+    """Fetch market data and store one ``CryptoPrice`` per asset; returns a JSON-serializable tick part.
+
+    ``before_call`` runs before each provider call, e.g. to renew a lease.
+    """
+    start = time.perf_counter()
+    trace = tracing.new_trace()
+    known = get_registry().by_external_id
+    if external_ids is not None:
+        assets = {ext: known[ext] for ext in external_ids if ext in known}
+    else:
+        assets = dict(known)
     if not assets:
-        return
-    ids_csv = ','.join([a.external_id for a in assets])
-    data = coingecko_fetch(ids_csv)
+        return {'payloads': {}, 'freshness': {}, 'trace': trace}
+    ids = list(assets)
+    pool = get_provider_pool()
+    data = []
+    for i in range(0, len(ids), scheduler.IDS_PER_CALL):
+        if before_call is not None:
+            before_call()
+        data.extend(pool.fetch_markets(ids[i:i + scheduler.IDS_PER_CALL]))
+    tracing.stamp(trace, 'fetched')
     now = timezone.now()
-    created = []
+    rows = []
+    priced = []
     for item in data:
         symbol = (item.get('symbol') or '').upper()
         ext_id = item.get('id')
         name = item.get('name')
-        try:
-            asset = next(a for a in assets if a.external_id == ext_id)
-        except StopIteration:
+        asset = assets.get(ext_id)
+        if asset is None:
             asset, _ = CryptoAsset.objects.get_or_create(external_id=ext_id, defaults={
                 'symbol': symbol,
                 'name': name,
                 'logo_url': (item.get('image') or ''),
             })
-        price = CryptoPrice.objects.create(
-            asset=asset,
+        price = CryptoPrice(
+            asset_id=asset.id,
             price_usd=item.get('current_price') or 0,
             change_24h_percent=(item.get('price_change_percentage_24h') or 0),
             market_cap_usd=item.get('market_cap'),
@@ -57,24 +120,119 @@ def fetch_and_broadcast_prices():
             atl=item.get('atl'),
             last_updated=now,
         )
-        created.append(price)
-        payload = {
-            'symbol': asset.symbol,
-            'name': asset.name,
-            'price_usd': float(price.price_usd),
-            'change_24h_percent': float(price.change_24h_percent),
-            'last_updated': price.last_updated.isoformat().replace('+00:00', 'Z'),
-            'market_cap_usd': float(price.market_cap_usd) if price.market_cap_usd is not None else None,
-            'volume_24h_usd': float(price.volume_24h_usd) if price.volume_24h_usd is not None else None,
-            'circulating_supply': float(price.circulating_supply) if price.circulating_supply is not None else None,
-            'total_supply': float(price.total_supply) if price.total_supply is not None else None,
-            'ath': float(price.ath) if price.ath is not None else None,
-            'atl': float(price.atl) if price.atl is not None else None,
-            'logo_url': asset.logo_url,
-        }
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(f'crypto_{asset.symbol.upper()}', {
+        rows.append(price)
+        priced.append((asset, price))
+    CryptoPrice.objects.bulk_create(rows)
+    tracing.stamp(trace, 'persisted')
+    PRICE_ROWS_WRITTEN.inc(len(rows))
+    TICK_SECONDS.labels('ingest').observe(time.perf_counter() - start)
+    return {
+        'payloads': {asset.symbol: price_payload(asset, price) for asset, price in priced},
+        'freshness': {
+            asset.symbol: (now.timestamp(), scheduler.max_age_for(asset.external_id))
+            for asset, price in priced
+        },
+        'trace': trace,
+    }
+
+
+@shared_task
+def finalize_tick(parts):
+    """Publish every shard's results as a single store version, then broadcast and evaluate alerts."""
+    start = time.perf_counter()
+    payloads, freshness, failed, skipped = {}, {}, [], []
+    for part in parts:
+        payloads.update(part.get('payloads') or {})
+        freshness.update(part.get('freshness') or {})
+        failed.extend(part.get('failed') or [])
+        skipped.extend(part.get('skipped') or [])
+    if skipped:
+        scheduler.mark_polled(skipped, 0)  # marked polled when planned, but never fetched
+    if failed:
+        scheduler.mark_polled(failed, 0)  # due again as soon as the backoff ends
+        broadcast_stale(failed)
+    elif payloads:
+        scheduler.clear_backoff()
+    if not payloads:
+        return 0
+    try:
+        fx = get_provider_pool().fetch_fx_rates()
+    except (ProviderUnavailable, RateLimited):
+        fx = None  # keep converting with the last published table
+    previous_prices = published_prices()  # before this tick replaces them
+    version = publish_snapshot(payloads, fx, freshness)
+    trace = tracing.stamp(tracing.merge_traces(part.get('trace') for part in parts), 'stored')
+    channel_layer = get_channel_layer()
+    fanout_start = time.perf_counter()
+    for symbol, payload in payloads.items():
+        async_to_sync(channel_layer.group_send)(f'crypto_{symbol.upper()}', {
             'type': 'price.update',
-            'data': payload,
+            'version': version,
+            'data': {**payload, 'age_seconds': 0.0, 'stale': False},
+            'trace': trace,
+        })
+    FANOUT_SECONDS.observe(time.perf_counter() - fanout_start)
+    tracing.stamp(trace, 'published')
+    tracing.export({**trace, 'symbols': len(payloads)})
+    FANOUT_MESSAGES.labels('price.update').inc(len(payloads))
+    tick_prices = {symbol: payload['price_usd'] for symbol, payload in payloads.items()}
+    dispatch_fired_alerts(evaluate_alerts(tick_prices, previous_prices), tick_prices, channel_layer)
+    async_to_sync(channel_layer.group_send)(PORTFOLIO_GROUP, {
+        'type': 'portfolio.tick',
+        'version': version,
+    })
+    TICK_SECONDS.labels('finalize').observe(time.perf_counter() - start)
+    return len(payloads)
+
+
+@shared_task
+def fetch_and_broadcast_prices(external_ids=None):
+    """Fetch, store and broadcast in one go, without shards or leases."""
+    with TICK_SECONDS.labels('total').time():
+        return finalize_tick([ingest_markets(external_ids)])
+
+
+def broadcast_stale(external_ids):
+    """Tell subscribers of assets that could not be refreshed how old their price is."""
+    known = get_registry().by_external_id
+    symbols = {known[ext].symbol for ext in external_ids if ext in known}
+    snapshot = get_snapshot()
+    payloads = [snapshot.payloads[s] for s in snapshot.symbols if s in symbols]
+    channel_layer = get_channel_layer()
+    for item in snapshot.with_freshness(payloads):
+        if item['stale']:
+            async_to_sync(channel_layer.group_send)(f"crypto_{item['symbol']}", {
+                'type': 'price.stale',
+                'data': {k: item[k] for k in ('symbol', 'last_updated', 'age_seconds', 'stale')},
+            })
+
+
+def dispatch_fired_alerts(fired, tick_prices, channel_layer):
+    email_ids = []
+    for alert_id, user_id, channel, symbol, direction, threshold in fired:
+        if channel == PriceAlert.CHANNEL_EMAIL:
+            email_ids.append(alert_id)
+            continue
+        async_to_sync(channel_layer.group_send)(f'user_{user_id}', {
+            'type': 'alert.triggered',
+            'data': alert_payload(alert_id, symbol, direction, threshold, tick_prices[symbol]),
         })
-    return len(created) 
\ No newline at end of file
+    if email_ids:
+        send_price_alert_emails.delay(email_ids)
+
+
+@shared_task
+def send_price_alert_emails(alert_ids):
+    alerts = PriceAlert.objects.filter(id__in=alert_ids).select_related('user', 'asset')
+    queued = 0
+    for alert in alerts:
+        if not alert.user.email:
+            continue
+        # The mail worker batches these over its reused SMTP connection
+        queued += queue_email(
+            subject=f'{alert.asset.symbol} price alert',
+            body=f'{alert.asset.symbol} crossed {alert.direction} {alert.threshold} USD.',
+            to=[alert.user.email],
+            dedup_key=f'alert:{alert.id}',
+        )
+    return queued
@@ -1,3 +1,605 @@
-from django.test import TestCase
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend import ratelimit
+from users import blacklist
+from users.models import User
+from users.portfolio import Positions
+from users.tokens import EntitledRefreshToken
+
+from . import alerts, registry, scheduler, search, store, tasks, tracing
+from .consumers import CryptoPriceConsumer
+from .models import CryptoAsset, CryptoPrice, PriceAlert
+from .providers import MarketDataProvider, ProviderPool, ProviderUnavailable, merge_markets
+from .scheduler import RateLimited
+from .store import PriceSnapshot
+
+
+class FakeProvider(MarketDataProvider):
+    """Local provider with injected latency and failures."""
+
+    def __init__(self, name, price=100.0, latency=0.0, error=None, timeout=1.0):
+        super().__init__(timeout=timeout)
+        self.name = name
+        self.price = price
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+
+    def fetch_markets(self, external_ids):
+        self.calls += 1
+        time.sleep(self.latency)
+        if self.error:
+            raise self.error
+        return [{'id': i, 'current_price': self.price, 'total_volume': None} for i in external_ids]
+
+    def fetch_fx_rates(self):
+        return self.fetch_markets(['fx']) and {'usd': 1.0}
+
+
+def p99(samples):
+    ordered = sorted(samples)
+    return ordered[int(len(ordered) * 0.99) - 1]
+
+
+class ProviderPoolTests(SimpleTestCase):
+    def test_fails_over_when_primary_errors(self):
+        primary = FakeProvider('primary', error=ConnectionError('down'))
+        backup = FakeProvider('backup', price=101.0)
+        pool = ProviderPool([primary, backup], hedge_after=1.0)
+        items = pool.fetch_markets(['bitcoin'])
+        self.assertEqual(items[0]['current_price'], 101.0)
+
+    def test_hedging_bounds_tick_latency_with_slow_primary(self):
+        primary = FakeProvider('primary', latency=0.5)
+        backup = FakeProvider('backup', latency=0.005)
+        pool = ProviderPool([primary, backup], hedge_after=0.02, max_workers=32)
+        samples = []
+        for _ in range(30):
+            start = time.monotonic()
+            pool.fetch_markets(['bitcoin'])
+            samples.append(time.monotonic() - start)
+        self.assertLess(p99(samples), 0.15)
+
+    def test_tick_latency_bounded_when_every_provider_hangs(self):
+        pool = ProviderPool(
+            [FakeProvider('a', latency=1.0, timeout=0.05), FakeProvider('b', latency=1.0, timeout=0.05)],
+            hedge_after=0.01,
+        )
+        start = time.monotonic()
+        with self.assertRaises(ProviderUnavailable):
+            pool.fetch_markets(['bitcoin'])
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        primary = FakeProvider('primary', error=ConnectionError('down'))
+        backup = FakeProvider('backup')
+        pool = ProviderPool([primary, backup], hedge_after=1.0, failure_threshold=2, reset_timeout=60)
+        for _ in range(4):
+            pool.fetch_markets(['bitcoin'])
+        self.assertEqual(primary.calls, 2)
+        self.assertEqual(backup.calls, 4)
+
+    def test_unused_backup_keeps_its_half_open_probe(self):
+        primary = FakeProvider('primary')
+        backup = FakeProvider('backup')
+        pool = ProviderPool([primary, backup], hedge_after=1.0, failure_threshold=1, reset_timeout=0.01)
+        pool.breakers['backup'].record_failure()
+        time.sleep(0.02)
+        pool.fetch_markets(['bitcoin'])
+        self.assertEqual(backup.calls, 0)
+        self.assertTrue(pool.breakers['backup'].allow())  # the probe is still there for a real call
+
+    def test_rate_limit_is_surfaced_when_no_provider_answers(self):
+        pool = ProviderPool([FakeProvider('only', error=RateLimited(5))])
+        with self.assertRaises(RateLimited):
+            pool.fetch_markets(['bitcoin'])
+
+    def test_merge_policy_per_field(self):
+        merged = merge_markets(
+            [
+                [{'id': 'bitcoin', 'current_price': 100.0, 'total_volume': None, 'name': 'Bitcoin'}],
+                [{'id': 'bitcoin', 'current_price': 110.0, 'total_volume': 5.0, 'name': 'BTC'}],
+                [{'id': 'bitcoin', 'current_price': 90.0, 'total_volume': 7.0, 'name': 'btc'}],
+            ],
+            {'current_price': 'median', 'total_volume': 'max'},
+        )
+        self.assertEqual(merged, [{'id': 'bitcoin', 'current_price': 100.0, 'total_volume': 7.0, 'name': 'Bitcoin'}])
+
+
+class LimitedConsumer(ratelimit.RateLimitedConsumerMixin):
+    def __init__(self):
+        self.scope = {'client': ('10.0.0.1', 5000)}
+        self.user = None
+        self.sent = []
+
+    async def send_json(self, content):
+        self.sent.append(content)
+
+
+@override_settings(RATE_LIMIT_ENABLED=True, RATE_LIMITS={'ws_subscribe': {'anon': '2/min'}})
+class ConsumerRateLimitTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch('backend.ratelimit.get_redis', return_value=fakeredis.FakeRedis())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, ratelimit, '_limiter', None)
+        ratelimit._limiter = None
+
+    def test_actions_over_the_limit_are_refused_with_retry_after(self):
+        consumer = LimitedConsumer()
+        limited = [async_to_sync(consumer.rate_limited)('ws_subscribe') for _ in range(3)]
+        self.assertEqual(limited, [False, False, True])
+        self.assertEqual([m['error'] for m in consumer.sent], ['rate_limited'])
+        self.assertGreater(consumer.sent[0]['retry_after'], 0)
+
+
+class SocketAuthTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('users.blacklist.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, blacklist, '_local', None)
+        blacklist._local = None
+        self.redis.set(blacklist.SEEDED_KEY, 1)
+        self.user = User.objects.create_user('socket', 'socket@example.com', 'pw')
+
+    def connect(self, token):
+        async def attempt():
+            communicator = WebsocketCommunicator(CryptoPriceConsumer.as_asgi(), f'/ws/crypto/?token={token}')
+            connected, code = await communicator.connect()
+            await communicator.disconnect()
+            return connected, code
+        return async_to_sync(attempt)()
+
+    def test_logged_out_access_token_cannot_open_a_socket(self):
+        refresh = EntitledRefreshToken.for_user(self.user)
+        access = refresh.access_token
+        other = EntitledRefreshToken.for_user(self.user).access_token
+        response = self.client.post(reverse('logout'), {'refresh': str(refresh)},
+                                    headers={'Authorization': f'Bearer {access}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.connect(access), (False, 4002))
+        self.assertFalse(blacklist.is_blacklisted(other['jti']))
+
+
+class AssetRegistryTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for patcher in (
+            mock.patch('crypto.registry.get_redis', return_value=self.redis),
+            mock.patch('crypto.registry._ensure_listener'),  # the tests play the listener's part
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(registry.reset)
+        registry.reset()
+        CryptoAsset.objects.create(symbol='BTC', name='Bitcoin', external_id='bitcoin')
+        CryptoAsset.objects.create(symbol='ETH', name='Ethereum', external_id='ethereum')
+        user = User.objects.create_user('reader', 'reader@example.com', 'pw')
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+    def test_symbols_are_served_from_the_registry_with_an_etag(self):
+        url = reverse('crypto-symbols')
+        self.client.get(url, headers=self.auth)
+        with self.assertNumQueries(1):  # the user only
+            response = self.client.get(url, headers=self.auth)
+        self.assertEqual([a['symbol'] for a in response.json()], ['BTC', 'ETH'])
+        response = self.client.get(url, headers={**self.auth, 'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_saving_an_asset_reloads_the_registry(self):
+        before = registry.get_registry()
+        with self.captureOnCommitCallbacks(execute=True):
+            CryptoAsset.objects.create(symbol='SOL', name='Solana', external_id='solana')
+        after = registry.get_registry()
+        self.assertIn('SOL', after.by_symbol)
+        self.assertNotEqual(before.etag, after.etag)
+        self.assertEqual(self.redis.get(registry.ASSETS_VERSION_KEY), b'1')
+
+    def test_change_published_by_another_process_is_picked_up(self):
+        registry.get_registry()
+        CryptoAsset.objects.filter(symbol='ETH').update(name='Ether')
+        self.redis.incr(registry.ASSETS_VERSION_KEY)
+        with self.assertNumQueries(0):
+            self.assertEqual(registry.get_registry().by_external_id['ethereum'].name, 'Ethereum')
+        registry._local['stale'] = True  # what the listener does on a message
+        self.assertEqual(registry.get_registry().by_external_id['ethereum'].name, 'Ether')
+
+    def test_search_endpoint(self):
+        url = reverse('crypto-search')
+        self.client.get(url, {'q': 'bit'}, headers=self.auth)
+        with self.assertNumQueries(1):  # the user only
+            response = self.client.get(url, {'q': 'eth', 'limit': 5}, headers=self.auth)
+        self.assertEqual([a['symbol'] for a in response.json()], ['ETH'])
+        self.assertEqual(self.client.get(url, {'q': 'eth', 'limit': 'x'}, headers=self.auth).status_code, 400)
+
+
+class AssetSearchTests(SimpleTestCase):
+    def setUp(self):
+        coins = [
+            (1, 'BTC', 'Bitcoin', 1.2e12), (2, 'BCH', 'Bitcoin Cash', 9e9), (3, 'ETH', 'Ethereum', 4e11),
+            (4, 'ETC', 'Ethereum Classic', 3e9), (5, 'WBTC', 'Wrapped Bitcoin', 1e10), (6, 'B', 'Build', None),
+        ]
+        self.index = search.SearchIndex([
+            registry.AssetRecord(pk, symbol, name, name.lower(), '') for pk, symbol, name, _ in coins
+        ])
+        self.snapshot = PriceSnapshot(1, {
+            symbol: {'symbol': symbol, 'price_usd': 1.0, 'market_cap_usd': cap, 'last_updated': '2026-01-01T00:00:00Z'}
+            for _, symbol, _, cap in coins
+        })
+
+    def symbols(self, query, limit=10):
+        return [record.symbol for record, _ in self.index.search(query, limit, self.snapshot)]
+
+    def test_exact_symbol_then_prefixes_by_market_cap(self):
+        self.assertEqual(self.symbols('b'), ['B', 'BTC', 'BCH', 'WBTC'])
+        self.assertEqual(self.symbols('bitcoin'), ['BTC', 'WBTC', 'BCH'])
+        self.assertEqual(self.symbols('eth', limit=1), ['ETH'])
+
+    def test_name_words_and_misspellings_match(self):
+        self.assertEqual(self.symbols('Cash'), ['BCH'])
+        self.assertEqual(self.symbols('classic'), ['ETC'])
+        self.assertEqual(self.symbols('etherum')[:2], ['ETH', 'ETC'])
+
+    def test_market_cap_comes_from_the_snapshot(self):
+        results = self.index.search('bt', 10, self.snapshot)
+        self.assertEqual([(r.symbol, cap) for r, cap in results], [('BTC', 1.2e12)])
+        self.assertEqual(self.index.search('build', 10, self.snapshot)[0][1], None)
+
+    def test_blank_query_finds_nothing(self):
+        self.assertEqual(self.symbols('  '), [])
+
+
+def run_chord(header):
+    """``celery.chord`` run in this process: every header task, then the body with their results."""
+    return lambda body: body.apply(([task.apply().get() for task in header],)).get()
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   CRYPTO_INGEST_LEASE_SECONDS=60, CRYPTO_INGEST_SHARDS=1)
+class IngestShardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+        self.redis = fakeredis.FakeRedis()
+        self.pool = mock.Mock(fetch_fx_rates=mock.Mock(return_value={'usd': 1.0}))
+        self.pool.fetch_markets.side_effect = lambda ids: [{'id': i, 'current_price': 10.0} for i in ids]
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        for patcher in (
+            mock.patch('crypto.locks.get_redis', return_value=self.redis),
+            mock.patch('crypto.registry.get_redis', return_value=self.redis),
+            mock.patch('crypto.alerts.get_redis', return_value=self.redis),
+            mock.patch('crypto.scheduler.get_redis', return_value=self.redis),
+            mock.patch('crypto.registry._ensure_listener'),
+            mock.patch('crypto.tasks.get_provider_pool', return_value=self.pool),
+            mock.patch('crypto.tasks.get_channel_layer', return_value=self.channel_layer),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(registry.reset)
+        registry.reset()
+        CryptoAsset.objects.create(symbol='BTC', name='Bitcoin', external_id='bitcoin')
+        CryptoAsset.objects.create(symbol='ETH', name='Ethereum', external_id='ethereum')
+
+    def last_polled(self):
+        return scheduler.last_polled(['bitcoin', 'ethereum'])
+
+    def snapshot(self):
+        store._local.update(snapshot=None, checked_at=0.0)  # as read by another process
+        return store.get_snapshot()
+
+    def test_lease_is_renewed_before_each_call(self):
+        key = 'lease:crypto:ingest:0'
+        ttls = []
+
+        def fetch(ids):
+            ttls.append(self.redis.pttl(key))
+            self.redis.pexpire(key, 50)  # most of the lease used up by this call
+            return [{'id': i, 'current_price': 10.0} for i in ids]
+
+        self.pool.fetch_markets.side_effect = fetch
+        with mock.patch('crypto.scheduler.IDS_PER_CALL', 1):
+            result = tasks.ingest_prices_shard(0, ['bitcoin', 'ethereum'])
+        self.assertEqual(set(result['payloads']), {'BTC', 'ETH'})
+        self.assertEqual(len(ttls), 2)
+        self.assertTrue(all(ttl > 50_000 for ttl in ttls))
+        self.assertFalse(self.redis.exists(key))
+
+    def test_losing_the_lease_is_logged(self):
+        def fetch(ids):
+            self.redis.delete('lease:crypto:ingest:0')  # expired, or taken over
+            return []
+
+        self.pool.fetch_markets.side_effect = fetch
+        with mock.patch('crypto.scheduler.IDS_PER_CALL', 1), self.assertLogs('crypto.tasks', 'WARNING'):
+            tasks.ingest_prices_shard(0, ['bitcoin', 'ethereum'])
+
+    def test_skipped_shard_is_due_again(self):
+        self.redis.set('lease:crypto:ingest:0', 'another run')
+        self.assertEqual(tasks.poll_prices(), 0)
+        self.pool.fetch_markets.assert_not_called()
+        self.assertEqual(self.last_polled(), {'bitcoin': 0, 'ethereum': 0})
+        self.assertEqual(set(scheduler.plan({})), {'bitcoin', 'ethereum'})
+
+    def test_fetched_shard_is_not_due_again(self):
+        self.assertEqual(tasks.poll_prices(), 2)
+        self.assertTrue(all(self.last_polled().values()))
+        self.assertEqual(scheduler.plan({}), [])
+        self.assertEqual(set(self.snapshot().payloads), {'BTC', 'ETH'})
+
+    @override_settings(CRYPTO_INGEST_SHARDS=3)  # bitcoin and ethereum land in different shards
+    def test_chord_publishes_every_shard_as_one_tick(self):
+        self.redis.set(f"lease:crypto:ingest:{scheduler.shard(['ethereum'], 3)[0][0]}", 'another run')
+        with mock.patch('crypto.tasks.chord', run_chord):
+            tasks.poll_prices()
+        snapshot = self.snapshot()
+        self.assertEqual(list(snapshot.payloads), ['BTC'])
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(self.last_polled()['ethereum'], 0)
+        self.assertGreater(self.last_polled()['bitcoin'], 0)
+        groups = [c.args[0] for c in self.channel_layer.group_send.call_args_list]
+        self.assertIn('crypto_BTC', groups)
+        self.assertNotIn('crypto_ETH', groups)
+
+    def test_finalize_marks_failed_and_skipped_ids_due(self):
+        scheduler.mark_polled(['bitcoin', 'ethereum'], time.time())
+        self.assertEqual(tasks.finalize_tick([{'shard': 0, 'failed': ['bitcoin']}, {'shard': 1, 'skipped': ['ethereum']}]), 0)
+        self.assertEqual(self.last_polled(), {'bitcoin': 0, 'ethereum': 0})
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AlertEvaluationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+        self.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        for patcher in (
+            mock.patch('crypto.alerts.get_redis', return_value=fakeredis.FakeRedis()),
+            mock.patch('crypto.alerts.alert_index', alerts.AlertIndex()),
+            mock.patch('crypto.tasks.get_provider_pool', return_value=mock.Mock(fetch_fx_rates=mock.Mock(return_value=None))),
+            mock.patch('crypto.tasks.get_channel_layer', return_value=self.channel_layer),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.asset = CryptoAsset.objects.create(symbol='BTC', name='Bitcoin', external_id='bitcoin')
+        self.user = User.objects.create_user('watcher', 'watcher@example.com', 'pw')
+        self.above = PriceAlert.objects.create(user=self.user, asset=self.asset, direction='above', threshold=105)
+        self.below = PriceAlert.objects.create(user=self.user, asset=self.asset, direction='below', threshold=95)
+
+    def tick(self, price):
+        """What ingest_markets does for one shard, then finalize_tick."""
+        row = CryptoPrice.objects.create(asset=self.asset, price_usd=price, change_24h_percent=0, last_updated=timezone.now())
+        return tasks.finalize_tick([{'payloads': {'BTC': store.price_payload(self.asset, row)}}])
+
+    def alert_messages(self):
+        return [c.args[1]['data']['id'] for c in self.channel_layer.group_send.call_args_list
+                if c.args[0] == f'user_{self.user.pk}']
+
+    def test_first_tick_of_a_process_measures_from_the_published_price(self):
+        self.tick(100)
+        with mock.patch('crypto.alerts.alert_index', alerts.AlertIndex()):  # a fresh worker
+            self.tick(110)
+        self.assertEqual(self.alert_messages(), [self.above.pk])
+        self.above.refresh_from_db()
+        self.assertFalse(self.above.is_active)
+        self.assertIsNotNone(self.above.triggered_at)
+
+    def test_nothing_fires_without_a_previous_price(self):
+        self.tick(110)
+        self.assertEqual(self.alert_messages(), [])
+        self.assertEqual(PriceAlert.objects.filter(is_active=True).count(), 2)
+
+    def test_moves_below_fire_below_alerts(self):
+        fired = alerts.evaluate_alerts({'BTC': 90.0}, {'BTC': 100.0})
+        self.assertEqual([f[0] for f in fired], [self.below.pk])
+        self.assertEqual(list(PriceAlert.objects.filter(is_active=True)), [self.above])
+
+    def test_alert_fired_by_two_workers_is_reported_once(self):
+        other = alerts.AlertIndex()
+        self.assertEqual([f[0] for f in alerts.evaluate_alerts({'BTC': 110.0}, {'BTC': 100.0})], [self.above.pk])
+        with mock.patch('crypto.alerts.alert_index', other):
+            self.assertEqual(alerts.evaluate_alerts({'BTC': 110.0}, {'BTC': 100.0}), [])
+
+    def test_changed_alerts_are_applied_without_a_rebuild(self):
+        index = alerts.AlertIndex()
+        index.sync()
+        with self.captureOnCommitCallbacks(execute=True):
+            higher = PriceAlert.objects.create(user=self.user, asset=self.asset, direction='above', threshold=120)
+            self.below.delete()
+            self.above.threshold = 130
+            self.above.save()
+        with self.assertNumQueries(0):
+            self.assertEqual([f[0] for f in index.evaluate({'BTC': 125.0}, {'BTC': 100.0})], [higher.pk])
+            self.assertEqual(index.evaluate({'BTC': 80.0}, {'BTC': 125.0}), [])
+            self.assertEqual([f[0] for f in index.evaluate({'BTC': 135.0}, {'BTC': 125.0})], [self.above.pk])
+
+    def test_deactivated_alert_leaves_the_index(self):
+        index = alerts.AlertIndex()
+        index.sync()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.below.is_active = False
+            self.below.save()
+        self.assertEqual(index.evaluate({'BTC': 90.0}, {'BTC': 100.0}), [])
+
+    def test_index_behind_the_kept_log_rebuilds(self):
+        index = alerts.AlertIndex()
+        index.sync()
+        with mock.patch('crypto.alerts.CHANGES_KEPT', 1), self.captureOnCommitCallbacks(execute=True):
+            self.above.delete()
+            self.below.delete()
+        with mock.patch.object(index, 'rebuild', wraps=index.rebuild) as rebuild:
+            self.assertEqual(index.evaluate({'BTC': 110.0}, {'BTC': 100.0}), [])
+        rebuild.assert_called_once()
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   CRYPTO_API_CALLS_PER_MINUTE=3)
+class PollBudgetTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_allocation_leaves_room_for_the_fx_call(self):
+        due = [f'coin-{i}' for i in range(5 * scheduler.IDS_PER_CALL)]
+        now = 60.0
+        allocated = scheduler.allocate(due, now)
+        self.assertEqual(len(allocated), 2 * scheduler.IDS_PER_CALL)
+        scheduler.spend_budget(now, 2 + scheduler.FX_CALLS)
+        self.assertEqual(scheduler.remaining_budget(now), 0)
+        self.assertEqual(scheduler.allocate(due, now), [])
+
+    def test_budget_for_only_the_fx_call_fetches_nothing(self):
+        scheduler.spend_budget(60.0, 2)
+        self.assertEqual(scheduler.allocate(['bitcoin'], 60.0), [])
+
+
+def price_payload(symbol, price, market_cap=None, last_updated='2026-01-01T00:00:00Z'):
+    return {
+        'symbol': symbol, 'name': symbol, 'price_usd': price, 'change_24h_percent': 0.0,
+        'last_updated': last_updated, 'market_cap_usd': market_cap, 'volume_24h_usd': None,
+        'circulating_supply': None, 'total_supply': None, 'ath': None, 'atl': None, 'logo_url': '',
+    }
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PriceStoreTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        store._local.update(snapshot=None, checked_at=0.0)
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+        self.payloads = {'BTC': price_payload('BTC', 100.0, market_cap=2000.0), 'ETH': price_payload('ETH', 10.0)}
+
+    def test_prices_are_looked_up_by_index_and_unknown_symbols_are_nan(self):
+        snapshot = PriceSnapshot(1, self.payloads)
+        prices = snapshot.prices_for(snapshot.indices(['ETH', 'XRP', 'BTC']))
+        self.assertEqual(prices[[0, 2]].tolist(), [10.0, 100.0])
+        self.assertTrue(math.isnan(prices[1]))
+        empty = PriceSnapshot(1, {})
+        self.assertTrue(all(math.isnan(p) for p in empty.prices_for(empty.indices(['BTC']))))
+
+    def test_payloads_are_converted_once_per_currency(self):
+        snapshot = PriceSnapshot(1, self.payloads, fx={'eur': 0.5})
+        eur = snapshot.payloads_for('eur')
+        self.assertEqual((eur['BTC']['price_eur'], eur['BTC']['market_cap_eur']), (50.0, 1000.0))
+        self.assertIsNone(eur['ETH']['market_cap_eur'])
+        self.assertIs(snapshot.payloads_for('eur'), eur)
+        self.assertIs(snapshot.payloads_for('usd'), self.payloads)
+        with self.assertRaises(KeyError):
+            snapshot.payloads_for('gbp')
+
+    def test_prices_older_than_their_max_age_are_stale(self):
+        snapshot = PriceSnapshot(1, self.payloads, freshness={'BTC': (1000.0, 30.0), 'ETH': (1030.0, 30.0)})
+        fresh = snapshot.with_freshness(list(self.payloads.values()), now=1040.0)
+        self.assertEqual([(p['symbol'], p['age_seconds'], p['stale']) for p in fresh], [('BTC', 40.0, True), ('ETH', 10.0, False)])
+
+    def test_ticks_are_merged_and_readers_reload_on_a_new_version(self):
+        self.assertEqual(store.publish_snapshot({'BTC': self.payloads['BTC']}, fx={'eur': 0.5}), 1)
+        first = store.get_snapshot()
+        self.assertEqual((first.version, first.symbols, first.fx), (1, ['BTC'], {'eur': 0.5, 'usd': 1.0}))
+        self.assertEqual(store.publish_snapshot({'ETH': self.payloads['ETH']}), 2)
+        self.assertIs(store.get_snapshot(), first)  # trusted for LOCAL_TTL_SECONDS
+        store._local['checked_at'] = 0.0
+        second = store.get_snapshot()
+        self.assertEqual((second.version, second.symbols, second.fx['eur']), (2, ['BTC', 'ETH'], 0.5))
+        self.assertIs(store.peek_snapshot(2), second)
+        self.assertIsNone(store.peek_snapshot(3))
+        self.assertEqual(store.published_prices(), {'BTC': 100.0, 'ETH': 10.0})
+
+
+class PortfolioConsumer(CryptoPriceConsumer):
+    def __init__(self, portfolio):
+        super().__init__()
+        self.portfolio = portfolio
+        self.sent = []
+
+    async def send_json(self, content, close=False):
+        self.sent.append(content)
+
+
+class PortfolioTickTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+        snapshot = PriceSnapshot(4, {'BTC': price_payload('BTC', 100.0), 'ETH': price_payload('ETH', 10.0)})
+        store._local.update(snapshot=snapshot, checked_at=time.monotonic())
+
+    def test_tick_sends_the_portfolio_value_without_positions(self):
+        consumer = PortfolioConsumer(Positions([(1, 'BTC', 2.0, 150.0), (1, 'ETH', 5.0, 60.0), (1, 'DOGE', 10.0, 0.0)]))
+        with mock.patch('crypto.consumers.get_snapshot', side_effect=AssertionError('store read')):
+            async_to_sync(consumer.portfolio_tick)({'type': 'portfolio.tick', 'version': 4})
+        self.assertEqual(consumer.sent, [{'type': 'portfolio', 'data': {
+            'total_value_usd': 250.0, 'total_cost_usd': 210.0, 'pnl_usd': 40.0, 'pnl_percent': 40.0 / 210.0 * 100,
+        }}])
+
+    def test_sockets_without_a_portfolio_subscription_get_nothing(self):
+        consumer = PortfolioConsumer(None)
+        async_to_sync(consumer.portfolio_tick)({'type': 'portfolio.tick', 'version': 4})
+        self.assertEqual(consumer.sent, [])
+
+
+class PriceUpdateTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+
+    def publish(self, fx):
+        snapshot = PriceSnapshot(4, {'BTC': price_payload('BTC', 100.0)}, fx=fx)
+        store._local.update(snapshot=snapshot, checked_at=time.monotonic())
+        return snapshot
+
+    def deliver(self, vs):
+        consumer = PortfolioConsumer(None)
+        consumer.vs, consumer.trace = vs, False
+        data = {**price_payload('BTC', 100.0), 'age_seconds': 0.0, 'stale': False}
+        async_to_sync(consumer.price_update)({'type': 'price.update', 'version': 4, 'data': data})
+        return consumer
+
+    def test_sockets_share_the_snapshot_conversion(self):
+        snapshot = self.publish({'eur': 0.5})
+        with mock.patch('crypto.consumers.convert_payload', side_effect=AssertionError('converted per socket')):
+            first, second = self.deliver('eur'), self.deliver('eur')
+        self.assertEqual(first.sent, second.sent)
+        self.assertEqual(first.sent[0]['data']['price_eur'], 50.0)
+        self.assertFalse(first.sent[0]['data']['stale'])
+        self.assertEqual(list(snapshot._converted), ['eur'])
+
+    def test_dropped_currency_falls_back_to_usd(self):
+        self.publish({'gbp': 0.8})
+        consumer = self.deliver('eur')
+        self.assertEqual(consumer.vs, 'usd')
+        self.assertEqual(consumer.sent[0], {'error': 'unsupported_currency', 'vs': 'usd'})
+        self.assertEqual(consumer.sent[1]['data']['price_usd'], 100.0)
+
+
+class TraceExportTests(SimpleTestCase):
+    def test_spans_are_written_by_the_writer_thread(self):
+        writers = []
+        real_write = os.write
+
+        def write(fd, data):
+            writers.append(threading.current_thread())
+            return real_write(fd, data)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'ticks.jsonl')
+            with override_settings(TICK_TRACE_EXPORT=path), mock.patch('crypto.tracing.os.write', write):
+                tracing.export({'id': 'a'})
+                tracing.export({'id': 'b'})
+                tracing.flush()
+            with open(path) as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], ['a', 'b'])
+        self.assertTrue(writers)
+        self.assertNotIn(threading.current_thread(), writers)
@@ -0,0 +1,122 @@
+"""
+Per-tick latency tracing.
+
+Every tick carries a trace: an id plus the wall-clock time each stage finished.
+
+- ``started``: the ingest task began.
+- ``fetched``: the provider answered.
+- ``persisted``: the ``CryptoPrice`` rows were written.
+- ``stored``: the latest-price store was updated.
+- ``published``: every event of the tick was handed to the channel layer.
+- ``received``: a consumer got the event.
+- ``delivered``: that consumer sent it to its socket.
+
+Stages run in different processes, so they are stamped with ``time.time()``
+rather than a monotonic clock.
+
+The trace rides along in the ``price.update`` event. Spans are exported as JSON
+lines to ``TICK_TRACE_EXPORT``, which can be a file path or ``log``. Every tick
+is exported, and a ``TICK_TRACE_DELIVERY_SAMPLE`` share of deliveries is too.
+``export`` only queues the line; a writer thread per process does the file or
+log I/O, so consumers never block the event loop on it.
+``manage.py tick_trace_report`` turns the spans into per-stage percentiles.
+"""
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('started', 'fetched', 'persisted', 'stored', 'published', 'received', 'delivered')
+
+_spans = queue.Queue()
+_local = {'writer': None, 'pid': None}
+
+
+def new_trace(started=None):
+    return {'id': uuid.uuid4().hex[:16], 'started': started or time.time()}
+
+
+def stamp(trace, stage):
+    trace[stage] = time.time()
+    return trace
+
+
+def merge_traces(traces):
+    """Combine the shard traces of one tick: earliest start, latest finish of every other stage."""
+    traces = [t for t in traces if t]
+    if not traces:
+        return new_trace()
+    merged = new_trace(min(t['started'] for t in traces))
+    for stage in STAGES[1:]:
+        values = [t[stage] for t in traces if stage in t]
+        if values:
+            merged[stage] = max(values)
+    return merged
+
+
+def _write(target, lines):
+    if target == 'log':
+        for line in lines:
+            logger.info('%s', line)
+        return
+    # One append per batch; O_APPEND keeps lines from concurrent workers intact
+    fd = os.open(target, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, ''.join(line + '\n' for line in lines).encode())
+    finally:
+        os.close(fd)
+
+
+def _drain():
+    while True:
+        batch = [_spans.get()]
+        while True:
+            try:
+                batch.append(_spans.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            for target, group in itertools.groupby(batch, key=lambda item: item[0]):
+                _write(target, [line for _, line in group])
+        except Exception:
+            logger.warning('Could not export %d tick trace spans', len(batch), exc_info=True)
+        finally:
+            for _ in batch:
+                _spans.task_done()
+
+
+def _ensure_writer():
+    # Threads do not survive a fork, so each worker process starts its own
+    if _local['pid'] == os.getpid():
+        return
+    _local['pid'] = os.getpid()
+    writer = threading.Thread(target=_drain, name='tick-trace-writer', daemon=True)
+    writer.start()
+    _local['writer'] = writer
+
+
+def export(span):
+    target = settings.TICK_TRACE_EXPORT
+    if not target:
+        return
+    _ensure_writer()
+    _spans.put((target, json.dumps(span, separators=(',', ':'))))
+
+
+def flush():
+    """Wait until every span exported so far has been written."""
+    _spans.join()
+
+
+def export_delivery(trace, symbol, received, delivered):
+    if settings.TICK_TRACE_EXPORT and random.random() < settings.TICK_TRACE_DELIVERY_SAMPLE:
+        export({'id': trace['id'], 'symbol': symbol, 'received': received, 'delivered': delivered})
@@ -4,4 +4,7 @@ from . import views
 urlpatterns = [
     path('prices/latest/', views.LatestPricesView.as_view(), name='crypto-latest-prices'),
     path('symbols/', views.CryptoSymbolsView.as_view(), name='crypto-symbols'),
+    path('search/', views.AssetSearchView.as_view(), name='crypto-search'),
+    path('alerts/', views.PriceAlertListView.as_view(), name='crypto-alerts'),
+    path('alerts/<int:pk>/', views.PriceAlertDetailView.as_view(), name='crypto-alert-detail'),
 ] 
\ No newline at end of file
@@ -2,20 +2,31 @@ from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.http import HttpResponse, HttpResponseNotModified
 from django.utils import timezone
-from django.db.models import OuterRef, Subquery
+from django.utils.http import parse_etags
 from drf_spectacular.utils import extend_schema, OpenApiParameter
-from .models import CryptoAsset, CryptoPrice
+from backend.metrics import InstrumentedViewMixin
+from users.authentication import ClaimsJWTAuthentication
+from .models import CryptoAsset, PriceAlert
+from .registry import get_registry
+from .search import search_assets
+from .store import BASE_CURRENCY, currency_field, get_snapshot
 from .serializers import (
     CryptoPriceBasicSerializer, 
     CryptoPricePremiumSerializer,
     LatestPricesQuerySerializer,
-    CryptoSymbolSerializer
+    CryptoSymbolSerializer,
+    AssetSearchResultSerializer,
+    PriceAlertCreateSerializer,
+    PriceAlertSerializer,
 )
 
 
 # Create your views here.
 
+BASIC_FIELDS = ('symbol', 'name', 'price_usd', 'change_24h_percent', 'last_updated')
+
 
 @extend_schema(
     tags=['Crypto'],
@@ -25,55 +36,45 @@ from .serializers import (
             description='Comma-separated list of crypto symbols (e.g., BTC,ETH,ADA)',
             required=False,
             type=str
-        )
+        ),
+        OpenApiParameter(
+            name='vs',
+            description='Quote currency (e.g., usd, eur, gbp). Money fields are renamed accordingly, e.g. price_eur',
+            required=False,
+            type=str
+        ),
     ],
     responses={
         200: CryptoPriceBasicSerializer(many=True),
         401: {'description': 'Authentication required'}
     },
     summary="Get latest crypto prices",
-    description="Get latest cryptocurrency prices. Premium users get additional data like market cap, volume, etc."
+    description="Get latest cryptocurrency prices from the latest-price store. Every item carries age_seconds and a stale flag; stale prices are still served while the upstream provider is unavailable. Premium users get additional data like market cap, volume, etc."
 )
-class LatestPricesView(APIView):
+class LatestPricesView(InstrumentedViewMixin, APIView):
+    metrics_name = 'latest_prices'
+    authentication_classes = [ClaimsJWTAuthentication]
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'latest_prices'
     serializer_class = LatestPricesQuerySerializer
 
     def get(self, request):
         symbols_param = request.query_params.get('symbols', '')
         symbols = [s.strip().upper() for s in symbols_param.split(',') if s.strip()]
-        assets_qs = CryptoAsset.objects.all()
+        vs = request.query_params.get('vs', BASE_CURRENCY).strip().lower()
+        snapshot = get_snapshot()
+        try:
+            payloads = snapshot.payloads_for(vs)
+        except KeyError:
+            return Response({'detail': f'Unsupported currency: {vs}'}, status=400)
         if symbols:
-            assets_qs = assets_qs.filter(symbol__in=symbols)
-        latest_price_sub = CryptoPrice.objects.filter(asset=OuterRef('pk')).order_by('-last_updated')
-        assets = assets_qs.annotate(
-            latest_price_id=Subquery(latest_price_sub.values('id')[:1])
-        )
-        price_map = {p.asset_id: p for p in CryptoPrice.objects.filter(id__in=[a.latest_price_id for a in assets if a.latest_price_id])}
-        is_premium = request.user.has_active_premium()
-        data = []
-        for asset in assets:
-            price = price_map.get(asset.id)
-            if not price:
-                continue
-            base = {
-                'symbol': asset.symbol,
-                'name': asset.name,
-                'price_usd': float(price.price_usd),
-                'change_24h_percent': float(price.change_24h_percent),
-                'last_updated': price.last_updated.isoformat().replace('+00:00', 'Z'),
-            }
-            if is_premium:
-                base.update({
-                    'market_cap_usd': float(price.market_cap_usd) if price.market_cap_usd is not None else None,
-                    'volume_24h_usd': float(price.volume_24h_usd) if price.volume_24h_usd is not None else None,
-                    'circulating_supply': float(price.circulating_supply) if price.circulating_supply is not None else None,
-                    'total_supply': float(price.total_supply) if price.total_supply is not None else None,
-                    'ath': float(price.ath) if price.ath is not None else None,
-                    'atl': float(price.atl) if price.atl is not None else None,
-                    'logo_url': asset.logo_url,
-                })
-            data.append(base)
-        return Response(data)
+            selected = [payloads[s] for s in symbols if s in payloads]
+        else:
+            selected = [payloads[s] for s in snapshot.symbols]
+        if not request.user.has_active_premium():
+            basic_fields = [currency_field(f, vs) for f in BASIC_FIELDS]
+            selected = [{f: p[f] for f in basic_fields} for p in selected]
+        return Response(snapshot.with_freshness(selected))
 
 
 @extend_schema(
@@ -86,16 +87,127 @@ class LatestPricesView(APIView):
     description="Get a list of all available cryptocurrency symbols and their basic information."
 )
 class CryptoSymbolsView(APIView):
+    authentication_classes = [ClaimsJWTAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = CryptoSymbolSerializer
 
     def get(self, request):
-        assets = CryptoAsset.objects.all().order_by('symbol')
-        data = []
-        for asset in assets:
-            data.append({
-                'symbol': asset.symbol,
-                'name': asset.name,
-                'logo_url': asset.logo_url,
-            })
-        return Response(data)
+        registry = get_registry()
+        if registry.etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(registry.symbols_json, content_type='application/json')
+        response['ETag'] = registry.etag
+        return response
+
+
+SEARCH_DEFAULT_LIMIT = 10
+SEARCH_MAX_LIMIT = 50
+
+
+@extend_schema(
+    tags=['Crypto'],
+    parameters=[
+        OpenApiParameter(name='q', description='Start of a symbol or name; close misspellings also match', required=True, type=str),
+        OpenApiParameter(name='limit', description=f'Maximum results (default {SEARCH_DEFAULT_LIMIT}, at most {SEARCH_MAX_LIMIT})', required=False, type=int),
+    ],
+    responses={
+        200: AssetSearchResultSerializer(many=True),
+        401: {'description': 'Authentication required'}
+    },
+    summary="Search crypto assets",
+    description="Autocomplete over symbols and names. Exact symbols come first, then symbol prefixes, name prefixes and close matches, each ordered by market cap."
+)
+class AssetSearchView(InstrumentedViewMixin, APIView):
+    metrics_name = 'asset_search'
+    authentication_classes = [ClaimsJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'asset_search'
+    serializer_class = AssetSearchResultSerializer
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get('limit', SEARCH_DEFAULT_LIMIT))
+        except ValueError:
+            return Response({'detail': 'limit must be an integer'}, status=400)
+        limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+        results = search_assets(request.query_params.get('q', ''), limit)
+        return Response([
+            {'symbol': asset.symbol, 'name': asset.name, 'logo_url': asset.logo_url, 'market_cap_usd': market_cap}
+            for asset, market_cap in results
+        ])
+
+
+def serialize_alert(alert):
+    return {
+        'id': alert.id,
+        'symbol': alert.asset.symbol,
+        'direction': alert.direction,
+        'threshold': float(alert.threshold),
+        'channel': alert.channel,
+        'is_active': alert.is_active,
+        'created_at': alert.created_at,
+        'triggered_at': alert.triggered_at,
+    }
+
+
+@extend_schema(
+    tags=['Crypto'],
+    request=PriceAlertCreateSerializer,
+    responses={
+        200: PriceAlertSerializer(many=True),
+        201: PriceAlertSerializer,
+        400: {'description': 'Invalid input or unknown symbol'},
+        401: {'description': 'Authentication required'}
+    },
+    summary="List or create price alerts",
+    description="List your price alerts, or create one that fires when a symbol crosses a threshold. Fired alerts are pushed to your WebSocket or sent by email."
+)
+class PriceAlertListView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = PriceAlertCreateSerializer
+
+    def get(self, request):
+        alerts = PriceAlert.objects.filter(user=request.user).select_related('asset').order_by('-created_at')
+        return Response([serialize_alert(a) for a in alerts])
+
+    def post(self, request):
+        serializer = PriceAlertCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        data = serializer.validated_data
+        try:
+            asset = CryptoAsset.objects.get(symbol=data['symbol'].strip().upper())
+        except CryptoAsset.DoesNotExist:
+            return Response({'detail': 'Unknown symbol'}, status=400)
+        alert = PriceAlert.objects.create(
+            user=request.user,
+            asset=asset,
+            direction=data['direction'],
+            threshold=data['threshold'],
+            channel=data['channel'],
+        )
+        return Response(serialize_alert(alert), status=201)
+
+
+@extend_schema(
+    tags=['Crypto'],
+    request=None,
+    responses={
+        204: None,
+        404: {'description': 'Alert not found'}
+    },
+    summary="Delete a price alert",
+    description="Delete one of your price alerts."
+)
+class PriceAlertDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = None
+
+    def delete(self, request, pk):
+        alert = PriceAlert.objects.filter(user=request.user, pk=pk).first()
+        if not alert:
+            return Response({'detail': 'Not found'}, status=404)
+        alert.delete()
+        return Response(status=204)
+
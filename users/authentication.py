@@ -0,0 +1,92 @@
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .tokens import CLAIMS_CACHE_SECONDS, ENTITLEMENT_CLAIMS, current_claims, entitlements_version
+
+
+class ClaimsUser(TokenUser):
+    """
+    Request user backed by the entitlement claims of an access token.
+
+    Premium checks need nothing else. Any other ``User`` attribute loads the row
+    through a cache that is keyed by the entitlements version.
+    """
+
+    def __init__(self, token, claims):
+        super().__init__(token)
+        self.claims = claims
+        self.version = claims['ent_ver']
+
+    @cached_property
+    def username(self):
+        return self.claims['username']
+
+    @cached_property
+    def is_staff(self):
+        return self.claims['is_staff']
+
+    @cached_property
+    def is_superuser(self):
+        return self.claims['is_superuser']
+
+    @cached_property
+    def is_premium(self):
+        return self.claims['is_premium']
+
+    @cached_property
+    def premium_expires_at(self):
+        expires = self.claims['premium_expires_at']
+        return datetime.fromtimestamp(expires, tz=dt_timezone.utc) if expires is not None else None
+
+    def has_active_premium(self) -> bool:
+        return bool(self.is_premium and self.premium_expires_at and self.premium_expires_at > timezone.now())
+
+    def __getattr__(self, name):
+        # Only called for attributes the token does not answer
+        if name.startswith('_') or name in ('token', 'claims', 'version'):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    @cached_property
+    def user(self):
+        from .models import User
+
+        key = f'users:user:{self.id}:{self.version}'
+        user = cache.get(key)
+        if user is None:
+            user = User.objects.get(pk=self.id)
+            cache.set(key, user, CLAIMS_CACHE_SECONDS)
+        return user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    With ``AUTH_STATELESS_CLAIMS`` on, authenticates from the token's entitlement
+    claims and a cached version number instead of a ``User`` query. Otherwise,
+    and for tokens minted without claims, it behaves like ``JWTAuthentication``.
+    """
+
+    def get_user(self, validated_token):
+        if not settings.AUTH_STATELESS_CLAIMS or 'ent_ver' not in validated_token:
+            return super().get_user(validated_token)
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+        version = entitlements_version(user_id)
+        if validated_token['ent_ver'] == version:
+            claims = {name: validated_token.get(name) for name in ENTITLEMENT_CLAIMS}
+            claims['ent_ver'] = version
+        else:
+            # Entitlements changed since the token was minted
+            claims = current_claims(user_id, version)
+            if claims is None:
+                raise AuthenticationFailed('User not found', code='user_not_found')
+        if not claims['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return ClaimsUser(validated_token, claims)
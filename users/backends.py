@@ -0,0 +1,73 @@
+"""
+Log in with a username or an email address, in either case.
+
+One query matches both columns case-insensitively, and the functional indexes
+on ``UPPER(username)`` and ``UPPER(email)`` answer it. The password hasher then
+runs exactly once. It checks the user's hash, or a dummy hash when nobody
+matches, so response time does not reveal which accounts exist.
+"""
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import get_hasher, make_password, verify_password
+from django.db.models import Case, Q, Value, When
+from django.utils.crypto import get_random_string
+
+from .hashing import acheck_password, get_hashing_pool
+from .models import User
+
+_dummy_hashes = {}
+
+
+def check_dummy_password(password):
+    """Check ``password`` against a hash from the current default hasher, costing what a real check costs."""
+    algorithm = get_hasher().algorithm
+    if algorithm not in _dummy_hashes:
+        _dummy_hashes[algorithm] = make_password(get_random_string(32))
+    verify_password(password, _dummy_hashes[algorithm])
+
+
+class UsernameOrEmailBackend(ModelBackend):
+    @staticmethod
+    def candidates(identifier):
+        # Usernames are unique only in exact case, so rank before capping or the exact match can be cut off
+        rank = Case(
+            When(username=identifier, then=Value(0)),
+            When(username__iexact=identifier, then=Value(1)),
+            default=Value(2),
+        )
+        return (
+            User.objects.filter(Q(username__iexact=identifier) | Q(email__iexact=identifier))
+            .order_by(rank, 'pk')[:2]
+        )
+
+    @staticmethod
+    def pick(users, identifier):
+        # An exact username wins over one differing in case, which wins over another account's email
+        folded = identifier.casefold()
+        return (
+            next((u for u in users if u.username == identifier), None)
+            or next((u for u in users if u.username.casefold() == folded), None)
+            or (users[0] if users else None)
+        )
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None or password is None:
+            return None
+        user = self.pick(list(self.candidates(username)), username)
+        if user is None:
+            check_dummy_password(password)
+            return None
+        if user.check_password(password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        """``authenticate`` with the async ORM, hashing on the shared pool."""
+        if username is None or password is None:
+            return None
+        user = self.pick([u async for u in self.candidates(username)], username)
+        if user is None:
+            await get_hashing_pool().run(check_dummy_password, password)
+            return None
+        if await acheck_password(user, password) and self.user_can_authenticate(user):
+            return user
+        return None
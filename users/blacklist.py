@@ -0,0 +1,185 @@
+"""
+Token blacklist checks without a database query.
+
+simplejwt checks ``BlacklistedToken`` with a join on every refresh. That
+lookup is moved here. Every blacklisted JTI also goes into a Redis sorted set
+scored by when it was blacklisted. Each process mirrors that set, either as an
+exact set or as a Bloom filter when ``TOKEN_BLACKLIST_BLOOM`` is on. It only
+fetches the entries added since its last sync, at most every
+``TOKEN_BLACKLIST_SYNC_SECONDS``. A Bloom hit is confirmed in Redis, so false
+positives never reject a valid token. A token blacklisted by another process
+is therefore honoured here within the sync interval. One blacklisted by this
+process is honoured at once. If Redis is unreachable, the check falls back to
+the database.
+
+Entries only need to outlive the refresh lifetime. ``prune_expired`` drops
+expired rows from both tables and from the Redis set. Deleting a
+``BlacklistedToken`` by hand does not un-blacklist the token.
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from backend import metrics
+from backend.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+BLACKLIST_KEY = 'auth:blacklist'
+SEEDED_KEY = 'auth:blacklist:seeded'
+CLOCK_SKEW_SECONDS = 5  # re-read this much before the last sync; re-adding is harmless
+FULL_RESYNC_SECONDS = 60 * 60  # drops pruned entries (and Bloom saturation) from the local copy
+
+BLACKLIST_CHECKS = metrics.counter('users_token_blacklist_checks_total', 'Token blacklist checks by answer source', ['source'])
+PRUNED_ROWS = metrics.counter('users_token_blacklist_pruned_total', 'Expired token rows pruned', ['table'])
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        a, b = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class LocalBlacklist:
+    """This process's copy of the Redis set."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = self._empty()
+        self.exact = not settings.TOKEN_BLACKLIST_BLOOM
+        self.cursor = 0.0
+        self.synced_at = 0.0
+        self.full_sync_at = time.monotonic()
+
+    @staticmethod
+    def _empty():
+        if settings.TOKEN_BLACKLIST_BLOOM:
+            return BloomFilter(settings.TOKEN_BLACKLIST_BLOOM_CAPACITY, 0.001)
+        return set()
+
+    def add(self, jti):
+        with self._lock:
+            self.entries.add(jti)
+
+    def sync(self, client):
+        now = time.monotonic()
+        if now - self.synced_at < settings.TOKEN_BLACKLIST_SYNC_SECONDS:
+            return
+        with self._lock:
+            full = now - self.full_sync_at > FULL_RESYNC_SECONDS
+            if not client.exists(SEEDED_KEY):
+                seed(client)
+            # A full resync fills a new copy and swaps it in, so lock-free readers never see it part-filled
+            entries, cursor = (self._empty(), 0.0) if full else (self.entries, self.cursor)
+            added = client.zrangebyscore(BLACKLIST_KEY, cursor - CLOCK_SKEW_SECONDS, '+inf', withscores=True)
+            for jti, score in added:
+                entries.add(jti.decode() if isinstance(jti, bytes) else jti)
+                cursor = max(cursor, score)
+            self.entries, self.cursor, self.synced_at = entries, cursor, now
+            if full:
+                self.full_sync_at = now
+
+
+_local = None
+
+
+def get_local():
+    global _local
+    if _local is None:
+        _local = LocalBlacklist()
+    return _local
+
+
+def seed(client):
+    """Copy the unexpired database blacklist into Redis, e.g. on first deploy or after Redis lost its data."""
+    rows = (
+        BlacklistedToken.objects.filter(token__expires_at__gt=timezone.now())
+        .values_list('token__jti', 'blacklisted_at')
+        .iterator(chunk_size=5000)
+    )
+    batch = {}
+    for jti, blacklisted_at in rows:
+        batch[jti] = blacklisted_at.timestamp()
+        if len(batch) >= 5000:
+            client.zadd(BLACKLIST_KEY, batch)
+            batch = {}
+    if batch:
+        client.zadd(BLACKLIST_KEY, batch)
+    client.set(SEEDED_KEY, 1)
+
+
+def record_blacklisted(jti, blacklisted_at=None):
+    """Called for every new ``BlacklistedToken`` (see ``users.signals``)."""
+    get_local().add(jti)
+    try:
+        get_redis().zadd(BLACKLIST_KEY, {jti: (blacklisted_at or timezone.now()).timestamp()})
+    except Exception:
+        # Other processes fall back to the database until Redis is back and reseeded
+        logger.warning('Could not add token %s to the Redis blacklist', jti, exc_info=True)
+
+
+def is_blacklisted(jti):
+    local = get_local()
+    try:
+        client = get_redis()
+        local.sync(client)
+        if jti not in local.entries:
+            BLACKLIST_CHECKS.labels('local').inc()
+            return False
+        if local.exact:
+            BLACKLIST_CHECKS.labels('local').inc()
+            return True
+        BLACKLIST_CHECKS.labels('redis').inc()
+        return client.zscore(BLACKLIST_KEY, jti) is not None
+    except Exception:
+        logger.debug('Redis blacklist unavailable, checking the database', exc_info=True)
+        BLACKLIST_CHECKS.labels('db').inc()
+        return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+def prune_expired(batch_size=5000):
+    """Delete expired outstanding and blacklisted tokens; returns the number removed per table."""
+    now = timezone.now()
+    blacklisted = outstanding = 0
+    while True:
+        ids = list(BlacklistedToken.objects.filter(token__expires_at__lte=now).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        blacklisted += BlacklistedToken.objects.filter(pk__in=ids).delete()[0]
+    while True:
+        ids = list(OutstandingToken.objects.filter(expires_at__lte=now).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        _, deleted = OutstandingToken.objects.filter(pk__in=ids).delete()
+        outstanding += deleted.get(OutstandingToken._meta.label, 0)
+        blacklisted += deleted.get(BlacklistedToken._meta.label, 0)
+    # A token blacklisted at t expires by t + refresh lifetime
+    horizon = now - api_settings.REFRESH_TOKEN_LIFETIME
+    try:
+        cached = get_redis().zremrangebyscore(BLACKLIST_KEY, '-inf', horizon.timestamp())
+    except Exception:
+        logger.warning('Could not prune the Redis blacklist', exc_info=True)
+        cached = 0
+    PRUNED_ROWS.labels('outstanding').inc(outstanding)
+    PRUNED_ROWS.labels('blacklisted').inc(blacklisted)
+    return {'outstanding': outstanding, 'blacklisted': blacklisted, 'cached': cached}
@@ -0,0 +1,97 @@
+"""
+Password hashing off the event loop.
+
+Async auth views hand every hash and check to one bounded thread pool per
+process. Argon2 releases the GIL, so the pool's threads hash in parallel, and
+the loop keeps serving other requests meanwhile. When ``PASSWORD_HASH_WORKERS``
+hashes are running and ``PASSWORD_HASH_MAX_QUEUE`` more are waiting, further
+requests fail at once with 503 and ``Retry-After`` instead of queueing behind
+them.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, verify_password
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from backend import metrics
+
+HASH_SECONDS = metrics.histogram('users_password_hash_seconds', 'Password hash or check time, queueing included')
+HASH_PENDING = metrics.gauge('users_password_hash_pending', 'Password hashes running or queued')
+HASH_SHED = metrics.counter('users_password_hash_shed_total', 'Requests refused because the hashing queue was full')
+
+
+class HashingOverloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-in requests, please retry shortly.'
+    default_code = 'hashing_overloaded'
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait
+
+
+class HashingPool:
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hash')
+        return self._executor
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.workers + self.max_queue:
+                HASH_SHED.inc()
+                raise HashingOverloaded(settings.PASSWORD_HASH_RETRY_AFTER)
+            self.pending += 1
+        HASH_PENDING.inc()
+        start = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self._get_executor().submit(func, *args))
+        finally:
+            with self._lock:
+                self.pending -= 1
+            HASH_PENDING.dec()
+            HASH_SECONDS.observe(time.perf_counter() - start)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_hashing_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = HashingPool(settings.PASSWORD_HASH_WORKERS, settings.PASSWORD_HASH_MAX_QUEUE)
+    return _pool
+
+
+async def acheck_password(user, raw_password):
+    """``user.check_password`` on the hashing pool, including the hash upgrade Django does on login."""
+    if raw_password is None:
+        return False
+    valid, must_update = await get_hashing_pool().run(verify_password, raw_password, user.password)
+    if valid and must_update:
+        await aset_password(user, raw_password)
+        await user.asave(update_fields=['password'])
+    return valid
+
+
+async def aset_password(user, raw_password):
+    """``user.set_password`` on the hashing pool; the caller saves."""
+    user.password = await get_hashing_pool().run(make_password, raw_password)
+    user._password = raw_password
@@ -0,0 +1,196 @@
+"""
+Outbound email queue.
+
+Views call ``queue_email``, which only writes to Redis, and only once the
+surrounding transaction commits, so request latency never depends on the mail
+server. ``users.tasks.send_queued_emails`` drains the queue in batches of
+``MAIL_BATCH_SIZE``. It sends over one SMTP connection that each worker
+process keeps open between batches.
+
+Delivery is at least once. A batch stays in the list until it has been sent,
+so a worker that dies mid-batch leaves it for the next drain. Each message id
+is marked as sent, which keeps the retry from mailing it twice. Callers can
+also pass a ``dedup_key`` so that a repeated request queues only one message.
+Failed messages are retried with backoff up to ``MAIL_MAX_ATTEMPTS`` times.
+They wait in a sorted set scored by when they are due, and a drain moves the
+due ones back into the outbox before sending.
+"""
+import json
+import logging
+import smtplib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from backend import metrics
+from backend.redis_client import get_redis
+from crypto.locks import Lease
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_KEY = 'mail:outbox'
+RETRY_KEY = 'mail:retry'  # failed messages scored by the time they may be retried
+DRAIN_SCHEDULED_KEY = 'mail:drain-scheduled'
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 600
+
+MAIL_SENT = metrics.counter('users_mail_sent_total', 'Queued emails by delivery outcome', ['outcome'])
+MAIL_BATCH_SECONDS = metrics.histogram('users_mail_batch_seconds', 'Time to send one batch of queued emails')
+
+
+def queue_email(subject, body, to, dedup_key=None, from_email=None, headers=None):
+    """Queue a message for the mail worker once the current transaction commits; returns False for a duplicate."""
+    if dedup_key and not cache.add(f'mail:dedup:{dedup_key}', 1, settings.MAIL_DEDUP_SECONDS):
+        return False
+    message = {
+        'id': uuid.uuid4().hex,
+        'subject': subject,
+        'body': body,
+        'from_email': from_email or settings.DEFAULT_FROM_EMAIL,
+        'to': list(to),
+        'headers': headers or {},
+        'attempts': 0,
+    }
+    transaction.on_commit(lambda: push([message]))
+    return True
+
+
+def push(messages, client=None, delay=None):
+    client = client or get_redis()
+    client.rpush(OUTBOX_KEY, *(json.dumps(m) for m in messages))
+    schedule_drain(delay)
+
+
+def retry_later(messages, client, now=None):
+    """Hold failed ``messages`` back until their backoff, doubling with each attempt, has passed."""
+    now = time.time() if now is None else now
+    due = {
+        json.dumps(m): now + min(RETRY_BASE_SECONDS * 2 ** m['attempts'], RETRY_MAX_SECONDS)
+        for m in messages
+    }
+    client.zadd(RETRY_KEY, due)
+    schedule_drain(min(due.values()) - now)
+
+
+def release_due(client, now=None):
+    """Move retries whose backoff has passed into the outbox; returns how many were moved."""
+    now = time.time() if now is None else now
+    due = client.zrangebyscore(RETRY_KEY, '-inf', now)
+    if due:
+        with client.pipeline() as pipe:
+            pipe.rpush(OUTBOX_KEY, *due)
+            pipe.zrem(RETRY_KEY, *due)
+            pipe.execute()
+    return len(due)
+
+
+def schedule_drain(delay=None):
+    # With eager Celery the beat entry drains the queue instead, so requests never send mail themselves
+    if settings.CELERY_TASK_ALWAYS_EAGER:
+        return
+    from .tasks import send_queued_emails
+
+    delay = settings.MAIL_BATCH_DELAY if delay is None else delay
+    if cache.add(DRAIN_SCHEDULED_KEY, 1, timeout=delay + 60):
+        send_queued_emails.apply_async(countdown=delay)
+
+
+# Sending
+
+_connection = None
+_connection_used = 0.0
+
+
+def _get_connection():
+    """The worker's SMTP connection, reopened after ``MAIL_CONNECTION_IDLE_SECONDS`` without use."""
+    global _connection, _connection_used
+    if _connection is not None and time.monotonic() - _connection_used > settings.MAIL_CONNECTION_IDLE_SECONDS:
+        close_connection()
+    if _connection is None:
+        _connection = get_connection()
+        _connection.open()
+    _connection_used = time.monotonic()
+    return _connection
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except Exception:
+            pass
+        _connection = None
+
+
+def _send(message):
+    email = EmailMessage(
+        subject=message['subject'],
+        body=message['body'],
+        from_email=message['from_email'],
+        to=message['to'],
+        headers=message['headers'],
+    )
+    try:
+        _get_connection().send_messages([email])
+    except (smtplib.SMTPServerDisconnected, ConnectionError):
+        # The server dropped the idle connection; reconnect once
+        close_connection()
+        _get_connection().send_messages([email])
+
+
+def deliver(messages):
+    """Send ``messages`` over the reused connection; returns the ones that failed."""
+    failed = []
+    for message in messages:
+        sent_key = f"mail:sent:{message['id']}"
+        if cache.get(sent_key):
+            continue
+        try:
+            _send(message)
+        except Exception as exc:
+            logger.warning('Sending email %s to %s failed: %s', message['id'], message['to'], exc)
+            MAIL_SENT.labels('failed').inc()
+            failed.append(message)
+            continue
+        cache.set(sent_key, 1, settings.MAIL_DEDUP_SECONDS)
+        MAIL_SENT.labels('sent').inc()
+    return failed
+
+
+def drain(client=None):
+    """Send everything queued, one batch at a time; returns the number of messages handled."""
+    client = client or get_redis()
+    lease = Lease('mail:drain', ttl=300, client=client)
+    if not lease.acquire():
+        return 0  # another worker is draining
+    cache.delete(DRAIN_SCHEDULED_KEY)
+    handled = 0
+    retry = []
+    try:
+        release_due(client)
+        while True:
+            raw = client.lrange(OUTBOX_KEY, 0, settings.MAIL_BATCH_SIZE - 1)
+            if not raw:
+                break
+            with MAIL_BATCH_SECONDS.time():
+                failed = deliver([json.loads(r) for r in raw])
+            client.ltrim(OUTBOX_KEY, len(raw), -1)
+            lease.renew()
+            handled += len(raw)
+            for message in failed:
+                message['attempts'] += 1
+                if message['attempts'] >= settings.MAIL_MAX_ATTEMPTS:
+                    logger.error('Dropping email %s to %s after %d attempts', message['id'], message['to'], message['attempts'])
+                    MAIL_SENT.labels('dropped').inc()
+                else:
+                    retry.append(message)
+    finally:
+        lease.release()
+    if retry:
+        retry_later(retry, client)
+    return handled
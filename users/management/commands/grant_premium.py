@@ -0,0 +1,45 @@
+"""
+Grant premium to many users at once.
+
+Usernames come from the command line, from a CSV file with usernames in the
+first column (``-`` reads stdin), or both. They are applied in chunks with one
+``UPDATE`` per chunk; see ``users.premium``.
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.premium import grant_premium, read_usernames
+
+
+class Command(BaseCommand):
+    help = 'Grant premium to the given usernames and/or the usernames in a CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='*', help='Usernames to grant')
+        parser.add_argument('--csv', help='CSV file with usernames in the first column, or - for stdin')
+        parser.add_argument('--days', type=int, default=365, help='Days of premium from now')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Users per UPDATE')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1')
+        usernames = list(options['usernames'])
+        if options['csv'] == '-':
+            usernames.extend(read_usernames(sys.stdin))
+        elif options['csv']:
+            try:
+                with open(options['csv'], newline='', encoding='utf-8-sig') as f:
+                    usernames.extend(read_usernames(f))
+            except OSError as exc:
+                raise CommandError(f'Cannot read {options["csv"]}: {exc}')
+        if not usernames:
+            raise CommandError('No usernames given')
+
+        result = grant_premium(usernames, options['days'], chunk_size=options['chunk_size'])
+        for username in result['missing']:
+            self.stderr.write(f'Unknown user: {username}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Granted {options['days']} days of premium to {result['granted']} users "
+            f"({len(result['missing'])} unknown)"
+        ))
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-19 15:46
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crypto', '0002_price_alerts'),
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=8, max_digits=28)),
+                ('cost_basis_usd', models.DecimalField(decimal_places=2, default=0, max_digits=28)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to='crypto.cryptoasset')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='holdings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'asset'), name='unique_holding_per_asset')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_value_usd', models.DecimalField(decimal_places=2, max_digits=28)),
+                ('total_cost_usd', models.DecimalField(decimal_places=2, max_digits=28)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio_snapshots', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='users_portf_user_id_e198b7_idx')],
+            },
+        ),
+    ]
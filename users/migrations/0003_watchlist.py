@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-19 15:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crypto', '0002_price_alerts'),
+        ('users', '0002_holdings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WatchlistItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='watchers', to='crypto.cryptoasset')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='watchlist', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'asset'), name='unique_watchlist_asset')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Index simplejwt's outstanding tokens by expiry for ``users.blacklist.prune_expired``."""
+
+    dependencies = [
+        ('token_blacklist', '0013_alter_blacklistedtoken_options_and_more'),
+        ('users', '0004_user_login_indexes'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX IF NOT EXISTS users_outstandingtoken_expires_at '
+            'ON token_blacklist_outstandingtoken (expires_at)',
+            'DROP INDEX IF EXISTS users_outstandingtoken_expires_at',
+        ),
+    ]
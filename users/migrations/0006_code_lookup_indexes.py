@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-19 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_outstanding_token_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='emailverificationcode',
+            index=models.Index(fields=['code_hash', 'expires_at'], name='users_verify_code_lookup'),
+        ),
+        migrations.AddIndex(
+            model_name='emailverificationcode',
+            index=models.Index(fields=['expires_at'], name='users_verify_expires'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordresettoken',
+            index=models.Index(condition=models.Q(('used', False)), fields=['code_hash', 'expires_at'], name='users_reset_code_unused'),
+        ),
+        migrations.AddIndex(
+            model_name='passwordresettoken',
+            index=models.Index(fields=['expires_at'], name='users_reset_expires'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-19 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0006_code_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_premium', True)), fields=['premium_expires_at'], name='users_user_premium_expiry'),
+        ),
+    ]
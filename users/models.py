@@ -1,5 +1,6 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import connection, models
+from django.db.models.functions import Upper
 from django.utils import timezone
 from django.conf import settings
 import hashlib
@@ -10,19 +11,54 @@ class User(AbstractUser):
     is_premium = models.BooleanField(default=False)
     premium_expires_at = models.DateTimeField(null=True, blank=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive login by username or email (users.backends)
+            models.Index(Upper('username'), name='users_user_username_upper'),
+            models.Index(Upper('email'), name='users_user_email_upper'),
+            # Lapsed subscriptions (users.premium.expire_premium)
+            models.Index(
+                fields=['premium_expires_at'],
+                name='users_user_premium_expiry',
+                condition=models.Q(is_premium=True),
+            ),
+        ]
+
     def has_active_premium(self) -> bool:
         return bool(self.is_premium and self.premium_expires_at and self.premium_expires_at > timezone.now())
 
 
+def _hash_code(raw_code: str) -> str:
+    return hashlib.sha256(raw_code.encode()).hexdigest()
+
+
+def _delete_expired(model, batch_size: int) -> int:
+    """Delete rows past ``expires_at`` in batches, so no single statement holds locks for long."""
+    now = timezone.now()
+    deleted = 0
+    while True:
+        ids = list(model.objects.filter(expires_at__lte=now).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += model.objects.filter(pk__in=ids).delete()[0]
+
+
 class EmailVerificationCode(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     code_hash = models.CharField(max_length=128)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            # Code-only lookup (consume_code_by_code) and the expiry sweep
+            models.Index(fields=['code_hash', 'expires_at'], name='users_verify_code_lookup'),
+            models.Index(fields=['expires_at'], name='users_verify_expires'),
+        ]
+
     @classmethod
     def create_for_user(cls, user, code: str, ttl_minutes: int = 30):
-        code_hash = hashlib.sha256(code.encode()).hexdigest()
+        code_hash = _hash_code(code)
         return cls.objects.create(
             user=user,
             code_hash=code_hash,
@@ -31,7 +67,7 @@ class EmailVerificationCode(models.Model):
 
     @classmethod
     def verify_code(cls, user, code: str) -> bool:
-        code_hash = hashlib.sha256(code.encode()).hexdigest()
+        code_hash = _hash_code(code)
         obj = (
             cls.objects.filter(user=user, code_hash=code_hash, expires_at__gt=timezone.now())
             .order_by('-created_at')
@@ -42,6 +78,29 @@ class EmailVerificationCode(models.Model):
             return True
         return False
 
+    @classmethod
+    def consume_code_by_code(cls, raw_code: str):
+        """Delete the newest live code matching ``raw_code`` and return its user id, or None.
+
+        One ``DELETE ... RETURNING`` statement, so two requests racing with the
+        same code cannot both succeed.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} WHERE id = ('
+                f'SELECT id FROM {table} WHERE code_hash = %s AND expires_at > %s '
+                f'ORDER BY created_at DESC LIMIT 1'
+                f') RETURNING user_id',
+                [_hash_code(raw_code), timezone.now()],
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 5000) -> int:
+        return _delete_expired(cls, batch_size)
+
 
 class PasswordResetToken(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -50,10 +109,21 @@ class PasswordResetToken(models.Model):
     expires_at = models.DateTimeField()
     used = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Only unused codes are ever looked up, so used ones stay out of the index
+            models.Index(
+                fields=['code_hash', 'expires_at'],
+                name='users_reset_code_unused',
+                condition=models.Q(used=False),
+            ),
+            models.Index(fields=['expires_at'], name='users_reset_expires'),
+        ]
+
     @classmethod
     def create_for_user(cls, user, ttl_minutes: int = 30):
         raw = f"{secrets.randbelow(1000000):06d}"
-        code_hash = hashlib.sha256(raw.encode()).hexdigest()
+        code_hash = _hash_code(raw)
         obj = cls.objects.create(
             user=user,
             code_hash=code_hash,
@@ -63,34 +133,43 @@ class PasswordResetToken(models.Model):
         return obj
 
     @classmethod
-    def consume_code(cls, user, raw_code: str) -> bool:
-        code_hash = hashlib.sha256(raw_code.encode()).hexdigest()
-        obj = (
-            cls.objects.filter(
-                user=user,
-                code_hash=code_hash,
-                expires_at__gt=timezone.now(),
-                used=False,
+    def _consume(cls, raw_code: str, user=None):
+        """Mark the newest live matching code used and return its user id, or None.
+
+        The guard on ``used`` in the outer ``WHERE`` is re-checked after a
+        concurrent update commits, so only one of two racing requests wins.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        params = [True, _hash_code(raw_code), timezone.now(), False]
+        user_filter = ''
+        if user is not None:
+            user_filter = 'AND user_id = %s '
+            params.append(user.pk)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET used = %s WHERE id = ('
+                f'SELECT id FROM {table} WHERE code_hash = %s AND expires_at > %s AND used = %s '
+                f'{user_filter}ORDER BY created_at DESC LIMIT 1'
+                f') AND used = %s RETURNING user_id',
+                params + [False],
             )
-            .order_by('-created_at')
-            .first()
-        )
-        if obj:
-            obj.used = True
-            obj.save(update_fields=['used'])
-            return True
-        return False
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def consume_code(cls, user, raw_code: str) -> bool:
+        return cls._consume(raw_code, user) is not None
 
     @classmethod
     def find_user_by_code(cls, raw_code: str):
         """Find user by reset code without knowing username"""
-        code_hash = hashlib.sha256(raw_code.encode()).hexdigest()
         obj = (
             cls.objects.filter(
-                code_hash=code_hash,
+                code_hash=_hash_code(raw_code),
                 expires_at__gt=timezone.now(),
                 used=False,
             )
+            .select_related('user')
             .order_by('-created_at')
             .first()
         )
@@ -99,18 +178,48 @@ class PasswordResetToken(models.Model):
     @classmethod
     def consume_code_by_code(cls, raw_code: str) -> tuple[bool, object]:
         """Find user and consume code in one operation"""
-        code_hash = hashlib.sha256(raw_code.encode()).hexdigest()
-        obj = (
-            cls.objects.filter(
-                code_hash=code_hash,
-                expires_at__gt=timezone.now(),
-                used=False,
-            )
-            .order_by('-created_at')
-            .first()
-        )
-        if obj:
-            obj.used = True
-            obj.save(update_fields=['used'])
-            return True, obj.user
-        return False, None
+        user_id = cls._consume(raw_code)
+        if user_id is None:
+            return False, None
+        user = User.objects.filter(pk=user_id).first()
+        return user is not None, user
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 5000) -> int:
+        return _delete_expired(cls, batch_size)
+
+
+class Holding(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='holdings')
+    asset = models.ForeignKey('crypto.CryptoAsset', on_delete=models.CASCADE, related_name='holdings')
+    quantity = models.DecimalField(max_digits=28, decimal_places=8)
+    cost_basis_usd = models.DecimalField(max_digits=28, decimal_places=2, default=0)  # total paid for the position
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'asset'], name='unique_holding_per_asset'),
+        ]
+
+
+class PortfolioSnapshot(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='portfolio_snapshots')
+    total_value_usd = models.DecimalField(max_digits=28, decimal_places=2)
+    total_cost_usd = models.DecimalField(max_digits=28, decimal_places=2)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class WatchlistItem(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='watchlist')
+    asset = models.ForeignKey('crypto.CryptoAsset', on_delete=models.CASCADE, related_name='watchers')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'asset'], name='unique_watchlist_asset'),
+        ]
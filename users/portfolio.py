@@ -0,0 +1,102 @@
+"""
+Portfolio valuation.
+
+Positions are loaded as flat arrays (one query, no model instances) and
+joined against the latest-price store with NumPy, so valuing one user is a
+handful of array operations and valuing every user is a single ``bincount``.
+"""
+import numpy as np
+from django.utils import timezone
+
+from crypto.store import get_snapshot
+from .models import Holding, PortfolioSnapshot
+
+
+class Positions:
+    __slots__ = ('user_ids', 'symbols', 'quantities', 'costs')
+
+    def __init__(self, rows):
+        self.user_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        self.symbols = [r[1] for r in rows]
+        self.quantities = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        self.costs = np.fromiter((r[3] for r in rows), dtype=np.float64, count=len(rows))
+
+    def __len__(self):
+        return len(self.symbols)
+
+
+def load_positions(user=None):
+    qs = Holding.objects.all()
+    if user is not None:
+        qs = qs.filter(user=user)
+    rows = list(
+        qs.order_by('user_id', 'asset__symbol')
+        .values_list('user_id', 'asset__symbol', 'quantity', 'cost_basis_usd')
+    )
+    return Positions(rows)
+
+
+def position_prices(positions, snapshot=None):
+    snapshot = snapshot or get_snapshot()
+    return snapshot.prices_for(snapshot.indices(positions.symbols))
+
+
+def value_positions(positions, snapshot=None):
+    """Return ``(prices, values, pnl)`` arrays aligned with ``positions``; unpriced assets count as 0."""
+    prices = position_prices(positions, snapshot)
+    values = np.nan_to_num(positions.quantities * prices)
+    return prices, values, values - positions.costs
+
+
+def portfolio_summary(positions, snapshot=None):
+    prices, values, pnl = value_positions(positions, snapshot)
+    total_value = float(values.sum())
+    total_cost = float(positions.costs.sum())
+    return {
+        'total_value_usd': total_value,
+        'total_cost_usd': total_cost,
+        'pnl_usd': total_value - total_cost,
+        'pnl_percent': (total_value - total_cost) / total_cost * 100 if total_cost else None,
+        'positions': [
+            {
+                'symbol': positions.symbols[i],
+                'quantity': float(positions.quantities[i]),
+                'price_usd': None if np.isnan(prices[i]) else float(prices[i]),
+                'value_usd': float(values[i]),
+                'cost_basis_usd': float(positions.costs[i]),
+                'pnl_usd': float(pnl[i]),
+            }
+            for i in range(len(positions))
+        ],
+    }
+
+
+def value_all_portfolios(snapshot=None):
+    """Value every portfolio at once; returns ``(user_ids, total_values, total_costs)`` arrays."""
+    positions = load_positions()
+    if not len(positions):
+        empty = np.array([], dtype=np.float64)
+        return np.array([], dtype=np.int64), empty, empty
+    _, values, _ = value_positions(positions, snapshot)
+    user_ids, owner = np.unique(positions.user_ids, return_inverse=True)
+    totals = np.bincount(owner, weights=values, minlength=len(user_ids))
+    costs = np.bincount(owner, weights=positions.costs, minlength=len(user_ids))
+    return user_ids, totals, costs
+
+
+def snapshot_all_portfolios(batch_size=5000):
+    user_ids, totals, costs = value_all_portfolios()
+    now = timezone.now()
+    PortfolioSnapshot.objects.bulk_create(
+        (
+            PortfolioSnapshot(
+                user_id=int(user_id),
+                total_value_usd=round(float(total), 2),
+                total_cost_usd=round(float(cost), 2),
+                created_at=now,
+            )
+            for user_id, total, cost in zip(user_ids, totals, costs)
+        ),
+        batch_size=batch_size,
+    )
+    return len(user_ids)
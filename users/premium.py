@@ -0,0 +1,74 @@
+"""
+Granting and expiring premium in bulk.
+
+Both paths change many users with set-based ``UPDATE`` statements, which skip
+``save()`` and so the ``post_save`` receiver that outdates entitlement claims.
+They bump the entitlements version of every user they touched themselves.
+"""
+import csv
+from itertools import islice
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from backend import metrics
+
+from .models import User
+from .tokens import bump_entitlements_many
+
+PREMIUM_GRANTED = metrics.counter('users_premium_granted_total', 'Users granted premium in bulk')
+PREMIUM_EXPIRED = metrics.counter('users_premium_expired_total', 'Users whose premium lapsed and was cleared')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def read_usernames(lines):
+    """Usernames from the first column of CSV ``lines``, skipping blanks and a ``username`` header."""
+    for row in csv.reader(lines):
+        if row and row[0].strip() and row[0].strip().lower() != 'username':
+            yield row[0].strip()
+
+
+def grant_premium(usernames, days, chunk_size=1000):
+    """Grant ``days`` of premium from now to every user in ``usernames``.
+
+    Returns ``{'granted': <count>, 'missing': [<unknown usernames>]}``.
+    """
+    expires_at = timezone.now() + timezone.timedelta(days=days)
+    wanted = dict.fromkeys(name.strip() for name in usernames if name and name.strip())
+    granted = 0
+    missing = []
+    for chunk in _chunks(wanted, chunk_size):
+        with transaction.atomic():
+            found = dict(User.objects.filter(username__in=chunk).values_list('username', 'pk'))
+            User.objects.filter(pk__in=found.values()).update(is_premium=True, premium_expires_at=expires_at)
+            ids = list(found.values())
+            transaction.on_commit(lambda ids=ids: bump_entitlements_many(ids))
+        granted += len(found)
+        missing.extend(name for name in chunk if name not in found)
+    PREMIUM_GRANTED.inc(granted)
+    return {'granted': granted, 'missing': missing}
+
+
+def expire_premium():
+    """Clear ``is_premium`` for every lapsed subscription in one statement; returns the number cleared.
+
+    Premium without an expiry date is cleared too, since ``has_active_premium``
+    never treats it as active.
+    """
+    table = connection.ops.quote_name(User._meta.db_table)
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET is_premium = %s '
+                f'WHERE is_premium = %s AND (premium_expires_at <= %s OR premium_expires_at IS NULL) RETURNING id',
+                [False, True, timezone.now()],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        transaction.on_commit(lambda: bump_entitlements_many(ids))
+    PREMIUM_EXPIRED.inc(len(ids))
+    return len(ids)
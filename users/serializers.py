@@ -73,6 +73,32 @@ class PremiumGrantSerializer(serializers.Serializer):
     days = serializers.IntegerField(default=365, min_value=1)
 
 
+class PremiumBulkGrantSerializer(serializers.Serializer):
+    usernames = serializers.ListField(child=serializers.CharField(max_length=150), required=False, max_length=50000)
+    file = serializers.FileField(required=False, help_text="CSV with usernames in the first column")
+    days = serializers.IntegerField(default=365, min_value=1)
+
+    def validate(self, attrs):
+        if not attrs.get('usernames') and not attrs.get('file'):
+            raise serializers.ValidationError('Provide usernames or a CSV file')
+        return attrs
+
+
+class PremiumBulkGrantResponseSerializer(serializers.Serializer):
+    granted = serializers.IntegerField()
+    missing = serializers.ListField(child=serializers.CharField())
+
+
+class HoldingSerializer(serializers.Serializer):
+    symbol = serializers.CharField(max_length=16)
+    quantity = serializers.DecimalField(max_digits=28, decimal_places=8, min_value=0)
+    cost_basis_usd = serializers.DecimalField(max_digits=28, decimal_places=2, min_value=0, default=0, help_text="Total amount paid for the position")
+
+
+class WatchlistSerializer(serializers.Serializer):
+    symbols = serializers.ListField(child=serializers.CharField(max_length=16), max_length=500, help_text="Crypto symbols, e.g. [\"BTC\", \"ETH\"]")
+
+
 class TestEmailSerializer(serializers.Serializer):
     email = serializers.EmailField(required=False, help_text="Email address to send test email to. Defaults to user's email.")
 
@@ -101,4 +127,26 @@ class MessageResponseSerializer(serializers.Serializer):
 
 class TestEmailResponseSerializer(serializers.Serializer):
     status = serializers.CharField()
-    message = serializers.CharField()
\ No newline at end of file
+    message = serializers.CharField()
+
+
+class PortfolioPositionSerializer(serializers.Serializer):
+    symbol = serializers.CharField()
+    quantity = serializers.FloatField()
+    price_usd = serializers.FloatField(allow_null=True)
+    value_usd = serializers.FloatField()
+    cost_basis_usd = serializers.FloatField()
+    pnl_usd = serializers.FloatField()
+
+
+class PortfolioResponseSerializer(serializers.Serializer):
+    total_value_usd = serializers.FloatField()
+    total_cost_usd = serializers.FloatField()
+    pnl_usd = serializers.FloatField()
+    pnl_percent = serializers.FloatField(allow_null=True)
+    positions = PortfolioPositionSerializer(many=True)
+
+
+class WatchlistResponseSerializer(serializers.Serializer):
+    symbols = serializers.ListField(child=serializers.CharField())
+    unknown = serializers.ListField(child=serializers.CharField(), required=False)
@@ -0,0 +1,25 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+
+from .blacklist import record_blacklisted
+from .models import User
+from .tokens import ENTITLEMENT_CLAIMS, bump_entitlements
+
+
+@receiver(post_save, sender=User)
+def outdate_entitlement_claims(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not set(update_fields) & set(ENTITLEMENT_CLAIMS)):
+        return
+    bump_entitlements(instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def outdate_deleted_user_claims(sender, instance, **kwargs):
+    bump_entitlements(instance.pk)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def cache_blacklisted_token(sender, instance, created, **kwargs):
+    if created:
+        record_blacklisted(instance.token.jti, instance.blacklisted_at)
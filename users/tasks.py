@@ -0,0 +1,47 @@
+import logging
+
+from celery import shared_task
+from . import blacklist, mail
+from .models import EmailVerificationCode, PasswordResetToken
+from .portfolio import snapshot_all_portfolios
+from .premium import expire_premium
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def snapshot_portfolios():
+    return snapshot_all_portfolios()
+
+
+@shared_task
+def send_queued_emails():
+    return mail.drain()
+
+
+@shared_task
+def prune_expired_tokens():
+    removed = blacklist.prune_expired()
+    logger.info(
+        'Pruned %(outstanding)d outstanding and %(blacklisted)d blacklisted tokens, %(cached)d cached JTIs',
+        removed,
+    )
+    return removed
+
+
+@shared_task
+def sweep_expired_codes():
+    removed = {
+        'verification': EmailVerificationCode.purge_expired(),
+        'reset': PasswordResetToken.purge_expired(),
+    }
+    logger.info('Swept %(verification)d verification and %(reset)d password reset codes', removed)
+    return removed
+
+
+@shared_task
+def expire_lapsed_premium():
+    cleared = expire_premium()
+    if cleared:
+        logger.info('Cleared premium for %d users whose subscription lapsed', cleared)
+    return cleared
@@ -1,3 +1,727 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import redis
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.hashers import verify_password
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backend import ratelimit
+from backend.async_views import AsyncAPIView
+from crypto import store
+from crypto.models import CryptoAsset
+
+from . import blacklist, hashing, mail, portfolio, premium
+from .authentication import ClaimsJWTAuthentication
+from .backends import UsernameOrEmailBackend
+from .models import EmailVerificationCode, Holding, PasswordResetToken, PortfolioSnapshot, User
+from .tokens import EntitledRefreshToken, bump_entitlements, entitlements_version
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """Minimal local SMTP server that records sessions and messages."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.rejected = []
+        self.sessions = 0
+        self.messages = []
+        self.open_sockets = []
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def drop_connections(self):
+        for sock in self.open_sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        server = self.server
+        server.sessions += 1
+        server.open_sockets.append(self.connection)
+        self.reply('220 stand-in ready')
+        recipients = []
+        try:
+            for raw in self.rfile:
+                command = raw.decode().strip()
+                verb = command[:4].upper()
+                if verb in ('EHLO', 'HELO'):
+                    self.reply('250 stand-in')
+                elif verb == 'MAIL':
+                    recipients = []
+                    self.reply('250 OK')
+                elif verb == 'RCPT':
+                    address = command.split(':', 1)[1].strip('<> ')
+                    if address in server.reject:
+                        server.rejected.append(address)
+                        self.reply('550 No such user')
+                    else:
+                        recipients.append(address)
+                        self.reply('250 OK')
+                elif verb == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    lines = []
+                    for data in self.rfile:
+                        if data in (b'.\r\n', b'.\n'):
+                            break
+                        lines.append(data)
+                    server.messages.append({'to': recipients, 'data': b''.join(lines).decode()})
+                    self.reply('250 Queued')
+                elif verb == 'QUIT':
+                    self.reply('221 Bye')
+                    return
+                else:
+                    self.reply('250 OK')
+        except OSError:
+            pass
+
+
+def message(to, subject='Hello'):
+    return {'id': f'{to}:{subject}', 'subject': subject, 'body': 'Body', 'from_email': 'app@example.com',
+            'to': [to], 'headers': {}, 'attempts': 0}
+
+
+@override_settings(
+    EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+    EMAIL_HOST='127.0.0.1',
+    EMAIL_USE_SSL=False,
+    EMAIL_USE_TLS=False,
+    EMAIL_HOST_USER='',
+    EMAIL_HOST_PASSWORD='',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CELERY_TASK_ALWAYS_EAGER=True,  # no drain task is scheduled; the tests drain by hand
+)
+class MailQueueTests(TestCase):
+    def setUp(self):
+        self.smtp = SMTPStandIn(reject={'bounce@example.com'})
+        self.redis = fakeredis.FakeRedis()
+        settings_override = override_settings(EMAIL_PORT=self.smtp.port)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.smtp.stop)
+        self.addCleanup(mail.close_connection)
+        cache.clear()
+
+    def outbox(self):
+        return [json.loads(m) for m in self.redis.lrange(mail.OUTBOX_KEY, 0, -1)]
+
+    def test_batch_goes_out_over_one_connection(self):
+        mail.push([message(f'user{i}@example.com') for i in range(5)], self.redis)
+        self.assertEqual(mail.drain(self.redis), 5)
+        self.assertEqual(len(self.smtp.messages), 5)
+        self.assertEqual(self.smtp.sessions, 1)
+        self.assertEqual(self.outbox(), [])
+
+    def test_connection_is_reused_across_drains(self):
+        mail.push([message('a@example.com')], self.redis)
+        mail.drain(self.redis)
+        mail.push([message('b@example.com')], self.redis)
+        mail.drain(self.redis)
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.smtp.sessions, 1)
+
+    def test_reconnects_when_server_drops_connection(self):
+        mail.push([message('a@example.com')], self.redis)
+        mail.drain(self.redis)
+        self.smtp.drop_connections()
+        mail.push([message('b@example.com')], self.redis)
+        mail.drain(self.redis)
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.smtp.sessions, 2)
+
+    def retrying(self):
+        return [(json.loads(m), due) for m, due in self.redis.zrange(mail.RETRY_KEY, 0, -1, withscores=True)]
+
+    def test_failed_message_waits_out_its_backoff(self):
+        mail.push([message('bounce@example.com'), message('ok@example.com')], self.redis)
+        start = time.time()
+        mail.drain(self.redis)
+        self.assertEqual([m['to'] for m in self.smtp.messages], [['ok@example.com']])
+        self.assertEqual(self.outbox(), [])
+        [(failed, due)] = self.retrying()
+        self.assertEqual((failed['to'], failed['attempts']), (['bounce@example.com'], 1))
+        self.assertGreaterEqual(due, start + 2 * mail.RETRY_BASE_SECONDS)
+
+        attempts = len(self.smtp.rejected)
+        for _ in range(3):  # e.g. the 5s beat entry
+            mail.drain(self.redis)
+        self.assertEqual(len(self.smtp.rejected), attempts)
+        self.assertEqual(len(self.retrying()), 1)
+
+        with mock.patch('users.mail.time.time', return_value=due + 1):
+            mail.drain(self.redis)
+        self.assertEqual(len(self.smtp.rejected), attempts + 1)
+        [(failed, later)] = self.retrying()
+        self.assertEqual(failed['attempts'], 2)
+        self.assertGreaterEqual(later, due + 1 + 4 * mail.RETRY_BASE_SECONDS)
+
+    def test_message_is_dropped_after_max_attempts(self):
+        failing = {**message('bounce@example.com'), 'attempts': 4}
+        with self.settings(MAIL_MAX_ATTEMPTS=5):
+            mail.push([failing], self.redis)
+            mail.drain(self.redis)
+        self.assertEqual(self.outbox(), [])
+
+    def test_redelivered_message_is_sent_once(self):
+        mail.push([message('a@example.com')], self.redis)
+        mail.drain(self.redis)
+        mail.push([message('a@example.com')], self.redis)  # e.g. a worker died before trimming the list
+        mail.drain(self.redis)
+        self.assertEqual(len(self.smtp.messages), 1)
+
+    def test_queue_email_waits_for_commit_and_dedups(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.assertTrue(mail.queue_email('Code', '123456', ['a@example.com'], dedup_key='verify:1'))
+            self.assertFalse(mail.queue_email('Code', '123456', ['a@example.com'], dedup_key='verify:1'))
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.outbox(), [])
+        with mock.patch('users.mail.get_redis', return_value=self.redis):
+            callbacks[0]()
+        self.assertEqual([m['subject'] for m in self.outbox()], ['Code'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TokenBlacklistTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('users.blacklist.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, blacklist, '_local', None)
+        blacklist._local = None
+        self.redis.set(blacklist.SEEDED_KEY, 1)
+        self.user = User.objects.create_user('holder', 'holder@example.com', 'pw')
+
+    def new_process(self):
+        blacklist._local = None
+
+    def test_blacklisted_token_is_found_without_a_query(self):
+        token = EntitledRefreshToken.for_user(self.user)
+        other = EntitledRefreshToken.for_user(self.user)
+        token.blacklist()
+        self.new_process()
+        with self.assertNumQueries(0):
+            self.assertTrue(blacklist.is_blacklisted(token['jti']))
+            self.assertFalse(blacklist.is_blacklisted(other['jti']))
+
+    @override_settings(TOKEN_BLACKLIST_BLOOM=True, TOKEN_BLACKLIST_BLOOM_CAPACITY=1000)
+    def test_bloom_filter_hits_are_confirmed_in_redis(self):
+        token = EntitledRefreshToken.for_user(self.user)
+        token.blacklist()
+        self.new_process()
+        with self.assertNumQueries(0):
+            self.assertTrue(blacklist.is_blacklisted(token['jti']))
+            self.assertFalse(any(blacklist.is_blacklisted(f'unknown-{i}') for i in range(200)))
+
+    def test_existing_database_blacklist_is_seeded_into_redis(self):
+        token = EntitledRefreshToken.for_user(self.user)
+        token.blacklist()
+        self.redis.flushall()  # e.g. Redis restarted empty
+        self.new_process()
+        self.assertTrue(blacklist.is_blacklisted(token['jti']))
+        self.assertIsNotNone(self.redis.zscore(blacklist.BLACKLIST_KEY, token['jti']))
+
+    def test_falls_back_to_database_without_redis(self):
+        token = EntitledRefreshToken.for_user(self.user)
+        token.blacklist()
+        self.new_process()
+        with mock.patch('users.blacklist.get_redis', side_effect=redis.ConnectionError):
+            with self.assertNumQueries(1):
+                self.assertTrue(blacklist.is_blacklisted(token['jti']))
+
+    def test_prune_removes_only_expired_tokens(self):
+        now = timezone.now()
+        expired = [
+            OutstandingToken.objects.create(user=self.user, jti=f'old-{i}', token='', expires_at=now - datetime.timedelta(hours=1))
+            for i in range(3)
+        ]
+        live = OutstandingToken.objects.create(user=self.user, jti='live', token='', expires_at=now + datetime.timedelta(days=1))
+        BlacklistedToken.objects.create(token=expired[0])
+        BlacklistedToken.objects.create(token=live)
+        self.redis.zadd(blacklist.BLACKLIST_KEY, {'ancient': (now - datetime.timedelta(days=30)).timestamp()})
+
+        removed = blacklist.prune_expired(batch_size=2)
+
+        self.assertEqual(removed, {'outstanding': 3, 'blacklisted': 1, 'cached': 1})
+        self.assertEqual(list(OutstandingToken.objects.values_list('jti', flat=True)), ['live'])
+        self.assertEqual(BlacklistedToken.objects.count(), 1)
+        self.assertIsNotNone(self.redis.zscore(blacklist.BLACKLIST_KEY, 'live'))
+
+    def test_prune_deletes_blacklisted_tokens_in_batches(self):
+        expired = timezone.now() - datetime.timedelta(hours=1)
+        for i in range(5):
+            BlacklistedToken.objects.create(
+                token=OutstandingToken.objects.create(user=self.user, jti=f'old-{i}', token='', expires_at=expired))
+        with CaptureQueriesContext(connection) as queries:
+            removed = blacklist.prune_expired(batch_size=2)
+        self.assertEqual(removed['blacklisted'], 5)
+        sql = [q['sql'] for q in queries]
+        outstanding_loop = next(i for i, q in enumerate(sql) if q.startswith('SELECT "token_blacklist_outstandingtoken"'))
+        self.assertEqual(sum(q.startswith('DELETE') for q in sql[:outstanding_loop]), 3)  # 2 + 2 + 1 rows
+        self.assertFalse(OutstandingToken.objects.exists())
+
+    def test_full_resync_swaps_in_a_filled_copy(self):
+        kept = EntitledRefreshToken.for_user(self.user)
+        kept.blacklist()
+        self.redis.zadd(blacklist.BLACKLIST_KEY, {'pruned': 1.0})
+        local = blacklist.get_local()
+        local.sync(self.redis)
+        self.assertIn('pruned', local.entries)
+        self.redis.zrem(blacklist.BLACKLIST_KEY, 'pruned')
+        local.full_sync_at -= blacklist.FULL_RESYNC_SECONDS + 1
+        local.synced_at = 0.0
+        seen_while_filling = []
+        zrangebyscore = self.redis.zrangebyscore
+
+        def fetch(*args, **kwargs):
+            seen_while_filling.append(kept['jti'] in local.entries)  # what a lock-free reader sees
+            return zrangebyscore(*args, **kwargs)
+
+        with mock.patch.object(self.redis, 'zrangebyscore', fetch):
+            local.sync(self.redis)
+        self.assertEqual(seen_while_filling, [True])
+        self.assertIn(kept['jti'], local.entries)
+        self.assertNotIn('pruned', local.entries)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CodeLookupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('pending', 'pending@example.com', 'pw', is_active=False)
+
+    def test_verify_email_activates_user_once(self):
+        EmailVerificationCode.create_for_user(self.user, '123456')
+        url = reverse('verify-email')
+        response = self.client.post(url, {'code': '123456'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.is_active)
+        response = self.client.post(url, {'code': '123456'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_expired_verification_code_is_rejected(self):
+        code = EmailVerificationCode.create_for_user(self.user, '123456')
+        EmailVerificationCode.objects.filter(pk=code.pk).update(expires_at=timezone.now() - datetime.timedelta(minutes=1))
+        self.assertIsNone(EmailVerificationCode.consume_code_by_code('123456'))
+
+    def test_reset_code_is_consumed_in_one_statement(self):
+        token = PasswordResetToken.create_for_user(self.user)
+        with self.assertNumQueries(1):
+            self.assertTrue(PasswordResetToken.consume_code(self.user, token.raw_code))
+        self.assertFalse(PasswordResetToken.consume_code(self.user, token.raw_code))
+        self.assertEqual(PasswordResetToken.consume_code_by_code(token.raw_code), (False, None))
+
+    def test_sweep_deletes_only_expired_codes(self):
+        past = timezone.now() - datetime.timedelta(minutes=1)
+        for i in range(3):
+            EmailVerificationCode.objects.create(user=self.user, code_hash=f'old-{i}', expires_at=past)
+            PasswordResetToken.objects.create(user=self.user, code_hash=f'old-{i}', expires_at=past, used=bool(i))
+        EmailVerificationCode.create_for_user(self.user, '123456')
+        live = PasswordResetToken.create_for_user(self.user)
+
+        self.assertEqual(EmailVerificationCode.purge_expired(batch_size=2), 3)
+        self.assertEqual(PasswordResetToken.purge_expired(batch_size=2), 3)
+
+        self.assertEqual(EmailVerificationCode.consume_code_by_code('123456'), self.user.pk)
+        self.assertEqual(list(PasswordResetToken.objects.values_list('pk', flat=True)), [live.pk])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PremiumBulkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user(f'member{i}', f'member{i}@example.com', 'pw') for i in range(5)]
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+
+    @staticmethod
+    def auth(user):
+        return {'Authorization': f'Bearer {AccessToken.for_user(user)}'}
+
+    def test_grant_updates_in_chunks_and_reports_unknown_users(self):
+        names = [u.username for u in self.users] + ['nobody']
+        before = [entitlements_version(u.pk) for u in self.users]
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(3 * 4):  # per chunk: savepoint, select, update, release
+                result = premium.grant_premium(names, days=30, chunk_size=2)
+        self.assertEqual(result, {'granted': 5, 'missing': ['nobody']})
+        self.assertEqual(User.objects.filter(is_premium=True).count(), 5)
+        self.assertEqual([entitlements_version(u.pk) for u in self.users], [v + 1 for v in before])
+
+    def test_bulk_grant_view_accepts_csv(self):
+        upload = SimpleUploadedFile('members.csv', b'username\nmember0\nmember1\n\nghost\n', content_type='text/csv')
+        response = self.client.post(reverse('premium-grant-bulk'), {'file': upload, 'days': 7}, headers=self.auth(self.admin))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'granted': 2, 'missing': ['ghost']})
+        self.assertEqual(set(User.objects.filter(is_premium=True).values_list('username', flat=True)), {'member0', 'member1'})
+
+    def test_bulk_grant_view_is_admin_only(self):
+        response = self.client.post(reverse('premium-grant-bulk'), {'usernames': ['member0']},
+                                    content_type='application/json', headers=self.auth(self.users[0]))
+        self.assertEqual(response.status_code, 403)
+
+    def test_expire_clears_only_lapsed_premium(self):
+        now = timezone.now()
+        User.objects.filter(pk__in=[u.pk for u in self.users[:3]]).update(
+            is_premium=True, premium_expires_at=now - datetime.timedelta(minutes=1))
+        User.objects.filter(pk=self.users[3].pk).update(is_premium=True, premium_expires_at=now + datetime.timedelta(days=1))
+        User.objects.filter(pk=self.users[4].pk).update(is_premium=True, premium_expires_at=None)
+        before = [entitlements_version(u.pk) for u in self.users]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(premium.expire_premium(), 4)
+        self.assertEqual(list(User.objects.filter(is_premium=True).values_list('username', flat=True)), ['member3'])
+        self.assertEqual([entitlements_version(u.pk) for u in self.users], [v + d for v, d in zip(before, [1, 1, 1, 0, 1])])
+
+    def test_concurrent_bulk_bumps_are_all_counted(self):
+        ids = [u.pk for u in self.users]
+        before = [entitlements_version(pk) for pk in ids]
+        workers = [
+            threading.Thread(target=lambda: [premium.bump_entitlements_many(ids) for _ in range(50)])
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([entitlements_version(pk) for pk in ids], [v + 200 for v in before])
+
+    def test_command_reads_csv(self):
+        path = os.path.join(tempfile.mkdtemp(), 'members.csv')
+        with open(path, 'w') as f:
+            f.write('member2,extra\nmember4\n')
+        out = io.StringIO()
+        call_command('grant_premium', 'member0', '--csv', path, '--days', '10', stdout=out)
+        self.assertIn('to 3 users', out.getvalue())
+        self.assertEqual(User.objects.filter(is_premium=True).count(), 3)
+
+
+@override_settings(
+    RATE_LIMIT_ENABLED=True,
+    RATE_LIMITS={'login': {'anon': '3/min'}, 'latest_prices': {'user': '2/min', 'premium': '5/min'}},
+)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('backend.ratelimit.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, ratelimit, '_limiter', None)
+        ratelimit._limiter = None
+        self.user = User.objects.create_user('limited', 'limited@example.com', 'pw')
+
+    def login(self, ip='10.0.0.1'):
+        return self.client.post(reverse('login'), {'username_or_email': 'limited', 'password': 'wrong'},
+                                content_type='application/json', REMOTE_ADDR=ip)
+
+    def test_login_is_limited_per_ip(self):
+        self.assertEqual([self.login().status_code for _ in range(4)], [401, 401, 401, 429])
+        self.assertIn('Retry-After', self.login())
+        self.assertEqual(self.login(ip='10.0.0.2').status_code, 401)
+
+    def test_forwarded_for_cannot_pick_a_fresh_bucket(self):
+        statuses = [
+            self.client.post(reverse('login'), {'username_or_email': 'limited', 'password': 'wrong'},
+                             content_type='application/json', REMOTE_ADDR='10.0.0.1',
+                             HTTP_X_FORWARDED_FOR=f'192.0.2.{i}').status_code
+            for i in range(4)
+        ]
+        self.assertEqual(statuses, [401, 401, 401, 429])
+
+    @override_settings(REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1})
+    def test_forwarded_for_is_trusted_behind_a_proxy(self):
+        request = mock.Mock(META={'REMOTE_ADDR': '10.0.0.9', 'HTTP_X_FORWARDED_FOR': '192.0.2.1, 198.51.100.7'})
+        self.assertEqual(ratelimit.TokenBucketThrottle().get_ident(request), '198.51.100.7')
+
+    def test_exhausted_bucket_is_refused_without_redis(self):
+        for _ in range(3):
+            self.assertTrue(ratelimit.check('login', ip='10.0.0.1')[0])
+        with mock.patch.object(self.redis, 'evalsha', side_effect=AssertionError('Redis was called')):
+            allowed, wait = ratelimit.check('login', ip='10.0.0.1')
+        self.assertFalse(allowed)
+        self.assertGreater(wait, 0)
+
+    def test_processes_share_the_redis_bucket(self):
+        for _ in range(3):
+            ratelimit.check('login', ip='10.0.0.1')
+        ratelimit._limiter = None  # another process, with no local copy
+        self.assertFalse(ratelimit.check('login', ip='10.0.0.1')[0])
+
+    def test_premium_users_get_their_own_quota(self):
+        self.assertEqual(sum(ratelimit.check('latest_prices', user=self.user)[0] for _ in range(6)), 2)
+        self.user.is_premium = True
+        self.user.premium_expires_at = timezone.now() + datetime.timedelta(days=1)
+        ratelimit._limiter = None
+        self.redis.flushall()
+        self.assertEqual(sum(ratelimit.check('latest_prices', user=self.user)[0] for _ in range(6)), 5)
+
+    def test_requests_are_allowed_without_redis(self):
+        with mock.patch('backend.ratelimit.get_redis', return_value=redis.Redis(port=1)):
+            self.assertEqual(ratelimit.check('login', ip='10.0.0.1'), (True, 0.0))
+
+
+class UsernameOrEmailBackendTests(TestCase):
+    def setUp(self):
+        self.backend = UsernameOrEmailBackend()
+        for username in ('Alice', 'ALICE', 'alice'):
+            User.objects.create_user(username, f'{username}-{len(username)}@example.com', f'{username}-pw')
+        User.objects.filter(username='ALICE').update(email='shared@example.com')
+
+    def test_exact_case_username_wins_over_case_variants(self):
+        for username in ('Alice', 'ALICE', 'alice'):
+            user = self.backend.authenticate(None, username=username, password=f'{username}-pw')
+            self.assertEqual(user.username if user else None, username)
+
+    def test_case_insensitive_username_falls_back_to_a_variant(self):
+        User.objects.create_user('Bob', 'bob@example.com', 'bob-pw')
+        self.assertEqual(self.backend.authenticate(None, username='BOB', password='bob-pw').username, 'Bob')
+
+    def test_login_by_email_in_any_case(self):
+        user = self.backend.authenticate(None, username='Shared@Example.com', password='ALICE-pw')
+        self.assertEqual(user.username, 'ALICE')
+
+    def test_wrong_password_is_rejected(self):
+        self.assertIsNone(self.backend.authenticate(None, username='alice', password='Alice-pw'))
+
+    def test_unknown_user_still_runs_the_hasher(self):
+        with mock.patch('users.backends.verify_password', wraps=verify_password) as verify:
+            self.assertIsNone(self.backend.authenticate(None, username='nobody', password='pw'))
+        verify.assert_called_once()
+
+
+@override_settings(AUTH_STATELESS_CLAIMS=True, CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class EntitlementClaimsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('claims', 'claims@example.com', 'pw', is_premium=True,
+                                             premium_expires_at=timezone.now() + datetime.timedelta(days=1))
+        self.auth = ClaimsJWTAuthentication()
+
+    def request_user(self, token):
+        return self.auth.get_user(self.auth.get_validated_token(str(token)))
+
+    def test_current_token_is_answered_from_its_claims(self):
+        access = EntitledRefreshToken.for_user(self.user).access_token
+        with self.assertNumQueries(0):
+            self.assertTrue(self.request_user(access).has_active_premium())
+
+    def test_outdated_token_reads_current_claims(self):
+        access = EntitledRefreshToken.for_user(self.user).access_token
+        self.user.is_premium = False
+        self.user.save()
+        self.assertFalse(self.request_user(access).has_active_premium())
+
+    def test_lost_version_does_not_revive_outdated_tokens(self):
+        access = EntitledRefreshToken.for_user(self.user).access_token
+        self.user.is_premium = False
+        self.user.save()
+        cache.clear()  # eviction or a flush
+        self.assertGreater(entitlements_version(self.user.pk), access['ent_ver'])
+        self.assertFalse(self.request_user(access).has_active_premium())
+
+    def test_bump_after_a_lost_version_moves_past_issued_tokens(self):
+        access = EntitledRefreshToken.for_user(self.user).access_token
+        cache.clear()
+        bump_entitlements(self.user.pk)
+        self.assertGreater(entitlements_version(self.user.pk), access['ent_ver'])
+
+
+class HashingPoolTests(SimpleTestCase):
+    def test_requests_past_the_queue_are_refused(self):
+        pool = hashing.HashingPool(workers=1, max_queue=1)
+        release = threading.Event()
+
+        async def main():
+            running = [asyncio.ensure_future(pool.run(release.wait, 5)) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            self.assertEqual(pool.pending, 2)
+            with self.assertRaises(hashing.HashingOverloaded) as refused:
+                await pool.run(release.wait, 5)
+            self.assertEqual(refused.exception.wait, settings.PASSWORD_HASH_RETRY_AFTER)
+            release.set()
+            self.assertEqual(await asyncio.gather(*running), [True, True])
+
+        asyncio.run(main())
+        self.assertEqual(pool.pending, 0)
+
+    def test_errors_in_the_pool_reach_the_caller_and_free_the_slot(self):
+        pool = hashing.HashingPool(workers=1, max_queue=0)
+
+        async def main():
+            with self.assertRaises(ValueError):
+                await pool.run(int, 'not a number')
+            return await pool.run(int, '7')
+
+        self.assertEqual(asyncio.run(main()), 7)
+        self.assertEqual(pool.pending, 0)
+
+
+class AsyncTestView(AsyncAPIView):
+    permission_classes = [AllowAny]
+
+    async def get(self, request):
+        return Response({'ok': True})
+
+    async def post(self, request):
+        if request.data.get('fail') == 'validation':
+            raise ValidationError({'fail': 'invalid'})
+        if request.data.get('fail') == 'overloaded':
+            raise hashing.HashingOverloaded(3)
+        raise RuntimeError('unexpected')
+
+
+class AsyncAPIViewTests(TestCase):
+    def setUp(self):
+        self.factory = APIRequestFactory()
+        self.view = async_to_sync(AsyncTestView.as_view())
+
+    def test_async_handler_is_awaited(self):
+        response = self.view(self.factory.get('/'))
+        self.assertEqual((response.status_code, response.data), (200, {'ok': True}))
+
+    def test_api_errors_become_responses(self):
+        response = self.view(self.factory.post('/', {'fail': 'validation'}, format='json'))
+        self.assertEqual((response.status_code, response.data), (400, {'fail': 'invalid'}))
+        response = self.view(self.factory.post('/', {'fail': 'overloaded'}, format='json'))
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '3'))
+
+    def test_unexpected_errors_are_raised(self):
+        with self.assertRaises(RuntimeError):
+            self.view(self.factory.post('/', {}, format='json'))
+
+    def test_unknown_method_is_not_allowed(self):
+        self.assertEqual(self.view(self.factory.delete('/')).status_code, 405)
+
+    def test_authentication_runs_before_the_handler(self):
+        response = self.client.post(reverse('password-change'), {}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(RATE_LIMIT_ENABLED=False)
+    def test_login_answers_503_with_retry_after_when_hashing_is_saturated(self):
+        User.objects.create_user('busy', 'busy@example.com', 'pw')
+        pool = hashing.HashingPool(workers=1, max_queue=0)
+        pool.pending = 1  # a hash already running
+        with mock.patch('users.hashing._pool', pool):
+            response = self.client.post(reverse('login'), {'username_or_email': 'busy', 'password': 'pw'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(settings.PASSWORD_HASH_RETRY_AFTER))
+
+
+def price_payload(symbol, price):
+    return {'symbol': symbol, 'price_usd': price, 'market_cap_usd': None, 'volume_24h_usd': None,
+            'ath': None, 'atl': None, 'last_updated': '2026-01-01T00:00:00Z'}
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PortfolioTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        store._local.update(snapshot=None, checked_at=0.0)
+        self.addCleanup(store._local.update, snapshot=None, checked_at=0.0)
+        self.assets = {
+            symbol: CryptoAsset.objects.create(symbol=symbol, name=symbol, external_id=symbol.lower())
+            for symbol in ('BTC', 'ETH', 'DOGE')
+        }
+        store.publish_snapshot({'BTC': price_payload('BTC', 100.0), 'ETH': price_payload('ETH', 10.0)})
+        self.user = User.objects.create_user('holder', 'holder@example.com', 'pw')
+        self.auth = {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}
+        patcher = mock.patch('users.views.notify_portfolio_changed')
+        self.notify = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hold(self, user, symbol, quantity, cost):
+        Holding.objects.create(user=user, asset=self.assets[symbol], quantity=quantity, cost_basis_usd=cost)
+
+    def test_holdings_are_set_listed_and_removed(self):
+        url = reverse('holdings')
+        for symbol, quantity in (('BTC', '2'), ('eth', '5'), ('BTC', '3')):
+            response = self.client.post(url, {'symbol': symbol, 'quantity': quantity, 'cost_basis_usd': '150'},
+                                        content_type='application/json', headers=self.auth)
+            self.assertEqual(response.status_code, 200)
+        response = self.client.post(url, {'symbol': 'XRP', 'quantity': '1'}, content_type='application/json', headers=self.auth)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.notify.call_count, 3)
+        listed = self.client.get(url, headers=self.auth).json()
+        self.assertEqual([(h['symbol'], float(h['quantity'])) for h in listed], [('BTC', 3.0), ('ETH', 5.0)])
+
+        detail = reverse('holding-detail', args=['btc'])
+        self.assertEqual(self.client.delete(detail, headers=self.auth).status_code, 200)
+        self.assertEqual(self.client.delete(detail, headers=self.auth).status_code, 404)
+        self.assertEqual([h['symbol'] for h in self.client.get(url, headers=self.auth).json()], ['ETH'])
+
+    def test_holdings_require_authentication(self):
+        self.assertEqual(self.client.get(reverse('holdings')).status_code, 401)
+
+    def test_portfolio_is_valued_at_the_latest_prices(self):
+        self.hold(self.user, 'BTC', 2, 150)
+        self.hold(self.user, 'ETH', 5, 60)
+        self.hold(self.user, 'DOGE', 100, 10)  # not priced yet
+        data = self.client.get(reverse('portfolio'), headers=self.auth).json()
+        self.assertEqual((data['total_value_usd'], data['total_cost_usd'], data['pnl_usd']), (250.0, 220.0, 30.0))
+        self.assertAlmostEqual(data['pnl_percent'], 30.0 / 220.0 * 100)
+        self.assertEqual(
+            [(p['symbol'], p['price_usd'], p['value_usd'], p['pnl_usd']) for p in data['positions']],
+            [('BTC', 100.0, 200.0, 50.0), ('DOGE', None, 0.0, -10.0), ('ETH', 10.0, 50.0, -10.0)],
+        )
+
+    def test_empty_portfolio_has_no_pnl_percent(self):
+        summary = portfolio.portfolio_summary(portfolio.load_positions(self.user))
+        self.assertEqual((summary['total_value_usd'], summary['pnl_percent'], summary['positions']), (0.0, None, []))
+        user_ids, totals, costs = portfolio.value_all_portfolios()
+        self.assertEqual((len(user_ids), len(totals), len(costs)), (0, 0, 0))
+
+    def test_every_portfolio_is_valued_and_snapshotted_at_once(self):
+        other = User.objects.create_user('other', 'other@example.com', 'pw')
+        self.hold(self.user, 'BTC', 2, 150)
+        self.hold(self.user, 'ETH', 5, 60)
+        self.hold(other, 'ETH', '0.3333', '1.25')
+        user_ids, totals, costs = portfolio.value_all_portfolios()
+        self.assertEqual(user_ids.tolist(), [self.user.pk, other.pk])
+        self.assertEqual(totals[0], 250.0)
+        self.assertAlmostEqual(totals[1], 3.333)
+        self.assertEqual(costs.tolist(), [210.0, 1.25])
+        self.assertEqual(portfolio.snapshot_all_portfolios(), 2)
+        rows = PortfolioSnapshot.objects.order_by('user_id').values_list('user_id', 'total_value_usd', 'total_cost_usd')
+        self.assertEqual([(u, float(v), float(c)) for u, v, c in rows], [(self.user.pk, 250.0, 210.0), (other.pk, 3.33, 1.25)])
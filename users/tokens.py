@@ -0,0 +1,137 @@
+"""
+Access tokens that carry the user's entitlements as signed claims.
+
+``ClaimsJWTAuthentication`` (see ``users.authentication``) builds the request
+user from these claims instead of loading the ``User`` row. Every user has an
+entitlements version in the cache. Premium or account changes bump it, and a
+token minted under an older version is answered from a short-TTL claims cache
+until the client refreshes it.
+
+A version missing from the cache, after an eviction or a flush, is seeded
+from the clock in microseconds rather than from zero. That is above any
+version a token could already hold, so a miss outdates every token instead of
+letting old ones match again.
+"""
+import time
+
+from django.core.cache import cache
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .blacklist import is_blacklisted
+
+CLAIMS_CACHE_SECONDS = 60
+ENTITLEMENT_CLAIMS = ('username', 'is_active', 'is_staff', 'is_superuser', 'is_premium', 'premium_expires_at')
+
+
+def _version_key(user_id):
+    return f'users:entitlements:{user_id}'
+
+
+def _fresh_version():
+    return time.time_ns() // 1000
+
+
+def entitlements_version(user_id):
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = _fresh_version()
+        if not cache.add(key, version, timeout=None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_entitlements(user_id):
+    """Outdate the claims in every token already issued to the user."""
+    key = _version_key(user_id)
+    if not cache.add(key, _fresh_version(), timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), timeout=None)
+
+
+def bump_entitlements_many(user_ids):
+    """``bump_entitlements`` for many users.
+
+    Each key is bumped with its own ``add`` or ``incr``, not a batched read and
+    write, so a bump racing with this one is never lost.
+    """
+    for user_id in user_ids:
+        bump_entitlements(user_id)
+
+
+def entitlement_claims(user, version=None):
+    expires = user.premium_expires_at
+    return {
+        'username': user.username,
+        'is_active': user.is_active,
+        'is_staff': user.is_staff,
+        'is_superuser': user.is_superuser,
+        'is_premium': user.is_premium,
+        'premium_expires_at': expires.timestamp() if expires else None,
+        'ent_ver': entitlements_version(user.pk) if version is None else version,
+    }
+
+
+def current_claims(user_id, version):
+    """Claims for ``version``, read from the DB at most once per ``CLAIMS_CACHE_SECONDS``; None if the user is gone."""
+    from .models import User
+
+    key = f'users:claims:{user_id}:{version}'
+    claims = cache.get(key)
+    if claims is None:
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            return None
+        claims = entitlement_claims(user, version)
+        cache.set(key, claims, CLAIMS_CACHE_SECONDS)
+    return claims
+
+
+def add_claims(token, claims):
+    for name, value in claims.items():
+        token[name] = value
+    return token
+
+
+class EntitledRefreshToken(RefreshToken):
+    """Refresh token whose access tokens carry ``entitlement_claims``, checked against the cached blacklist."""
+
+    @classmethod
+    def for_user(cls, user):
+        return add_claims(super().for_user(user), entitlement_claims(user))
+
+    def check_blacklist(self):
+        if is_blacklisted(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError('Token is blacklisted')
+
+
+class EntitledTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Mints refreshed access tokens with the current entitlements, not the ones
+    frozen at login. The blacklist and the user's active flag both come from
+    caches, so a refresh usually runs no query.
+    """
+
+    token_class = EntitledRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user_id = refresh[api_settings.USER_ID_CLAIM]
+        claims = current_claims(user_id, entitlements_version(user_id))
+        if claims is None or not claims['is_active']:
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+        data = {'access': str(add_claims(refresh.access_token, claims))}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION:
+                refresh.blacklist()
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            refresh.outstand()
+            data['refresh'] = str(refresh)
+        return data
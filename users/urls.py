@@ -14,5 +14,11 @@ urlpatterns = [
     path('premium/status/', views.PremiumStatusView.as_view(), name='premium-status'),
     path('premium/upgrade/', views.PremiumUpgradeView.as_view(), name='premium-upgrade'),
     path('premium/grant/', views.PremiumGrantView.as_view(), name='premium-grant'),
+    path('premium/grant/bulk/', views.PremiumBulkGrantView.as_view(), name='premium-grant-bulk'),
+    path('holdings/', views.HoldingsView.as_view(), name='holdings'),
+    path('holdings/<str:symbol>/', views.HoldingDetailView.as_view(), name='holding-detail'),
+    path('portfolio/', views.PortfolioView.as_view(), name='portfolio'),
+    path('watchlist/', views.WatchlistView.as_view(), name='watchlist'),
+    path('watchlist/<str:symbol>/', views.WatchlistDetailView.as_view(), name='watchlist-detail'),
     path('test-email/', views.TestEmailView.as_view(), name='test-email'),
 ] 
\ No newline at end of file
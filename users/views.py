@@ -1,25 +1,41 @@
+import csv
+import io
+import secrets
+
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
-from django.contrib.auth import get_user_model, authenticate
+from django.contrib.auth import aauthenticate, get_user_model
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.db import transaction
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenRefreshView as SimpleJWTTokenRefreshView
-from django.core.mail import send_mail, EmailMessage
-from django.conf import settings
 from django.http import JsonResponse
 from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiExample
-from .models import User, EmailVerificationCode, PasswordResetToken
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from backend.async_views import AsyncAPIView
+from backend.metrics import InstrumentedViewMixin
+from crypto.models import CryptoAsset
+from .authentication import ClaimsJWTAuthentication
+from .blacklist import record_blacklisted
+from .hashing import acheck_password, aset_password
+from .mail import queue_email
+from .models import User, EmailVerificationCode, PasswordResetToken, Holding
+from .portfolio import load_positions, portfolio_summary
+from .premium import grant_premium, read_usernames
+from .tokens import EntitledRefreshToken, EntitledTokenRefreshSerializer, bump_entitlements
+from .watchlist import get_watchlist_symbols, update_watchlist
 from .serializers import (
     RegisterSerializer, VerifyEmailSerializer, LoginSerializer,
     ForgotPasswordSerializer, ResetPasswordSerializer, ChangePasswordSerializer,
-    ProfileUpdateSerializer, PremiumGrantSerializer, TestEmailSerializer,
+    ProfileUpdateSerializer, PremiumGrantSerializer, PremiumBulkGrantSerializer, TestEmailSerializer,
     TokenResponseSerializer, ProfileResponseSerializer, PremiumStatusResponseSerializer,
-    MessageResponseSerializer, TestEmailResponseSerializer
+    MessageResponseSerializer, TestEmailResponseSerializer, PremiumBulkGrantResponseSerializer,
+    HoldingSerializer, PortfolioResponseSerializer,
+    WatchlistSerializer, WatchlistResponseSerializer
 )
 
 
@@ -33,7 +49,8 @@ from .serializers import (
     summary="Register a new user",
     description="Register a new user account. Sends email verification code."
 )
-class RegisterView(APIView):
+class RegisterView(InstrumentedViewMixin, APIView):
+    metrics_name = 'register'
     permission_classes = [AllowAny]
     serializer_class = RegisterSerializer
 
@@ -49,18 +66,14 @@ class RegisterView(APIView):
         
         with transaction.atomic():
             user = User.objects.create_user(username=username, email=email, password=password, is_active=False)
-            code = f"{timezone.now().microsecond % 1000000:06d}"
+            code = f"{secrets.randbelow(1000000):06d}"
             EmailVerificationCode.create_for_user(user, code)
-            try:
-                send_mail(
-                    subject='Verify your email',
-                    message=f'Your verification code is: {code}',
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[email],
-                    fail_silently=True,
-                )
-            except Exception:
-                pass
+            queue_email(
+                subject='Verify your email',
+                body=f'Your verification code is: {code}',
+                to=[email],
+                dedup_key=f'verify:{user.pk}',
+            )
         return Response({'detail': 'Registered. Please verify email.'}, status=201)
 
 
@@ -74,8 +87,10 @@ class RegisterView(APIView):
     summary="Verify email address",
     description="Verify user email with verification code only (no username required)"
 )
-class VerifyEmailView(APIView):
+class VerifyEmailView(InstrumentedViewMixin, APIView):
+    metrics_name = 'verify_email'
     permission_classes = [AllowAny]
+    throttle_scope = 'verify_email'
     serializer_class = VerifyEmailSerializer
 
     def post(self, request):
@@ -84,17 +99,13 @@ class VerifyEmailView(APIView):
             return Response({'detail': serializer.errors}, status=400)
         
         code = serializer.validated_data['code']
-        
-        # Find user by verification code (assuming the code is unique enough)
-        # You may need to implement a method to find user by code
-        # For now, this is a placeholder that needs your specific implementation
-        try:
-            # This needs to be implemented based on your EmailVerificationCode model
-            # For example: verification = EmailVerificationCode.objects.get(code=code, is_used=False)
-            # user = verification.user
-            return Response({'detail': 'Code verification needs to be implemented based on your model structure'}, status=400)
-        except Exception:
-            return Response({'detail': 'Invalid code'}, status=400)
+        with transaction.atomic():
+            user_id = EmailVerificationCode.consume_code_by_code(code)
+            if user_id is None:
+                return Response({'detail': 'Invalid or expired code'}, status=400)
+            User.objects.filter(pk=user_id, is_active=False).update(is_active=True)
+            transaction.on_commit(lambda: bump_entitlements(user_id))
+        return Response({'detail': 'Email verified'})
 
 
 @extend_schema(
@@ -107,11 +118,13 @@ class VerifyEmailView(APIView):
     summary="Login user",
     description="Authenticate user with username or email and return JWT tokens"
 )
-class LoginView(APIView):
+class LoginView(InstrumentedViewMixin, AsyncAPIView):
+    metrics_name = 'login'
     permission_classes = [AllowAny]
+    throttle_scope = 'login'
     serializer_class = LoginSerializer
 
-    def post(self, request):
+    async def post(self, request):
         serializer = LoginSerializer(data=request.data)
         if not serializer.is_valid():
             return Response({'detail': serializer.errors}, status=400)
@@ -119,36 +132,18 @@ class LoginView(APIView):
         username_or_email = serializer.validated_data['username_or_email']
         password = serializer.validated_data['password']
         
-        # Try to find user by username or email
-        user = None
-        if '@' in username_or_email:
-            # Looks like an email
-            try:
-                user_obj = User.objects.get(email=username_or_email)
-                user = authenticate(request, username=user_obj.username, password=password)
-            except User.DoesNotExist:
-                pass
-        else:
-            # Treat as username
-            user = authenticate(request, username=username_or_email, password=password)
-        
-        # If username authentication failed, try email as fallback
-        if not user and '@' not in username_or_email:
-            try:
-                user_obj = User.objects.get(email=username_or_email)
-                user = authenticate(request, username=user_obj.username, password=password)
-            except User.DoesNotExist:
-                pass
-        
-        if not user or not user.is_active:
+        user = await aauthenticate(request, username=username_or_email, password=password)
+        if not user:
             return Response({'detail': 'Invalid credentials or inactive account'}, status=401)
         
-        refresh = RefreshToken.for_user(user)
+        refresh = await sync_to_async(EntitledRefreshToken.for_user)(user)
         return Response({'access': str(refresh.access_token), 'refresh': str(refresh)})
 
 
-class TokenRefreshView(SimpleJWTTokenRefreshView):
+class TokenRefreshView(InstrumentedViewMixin, SimpleJWTTokenRefreshView):
+    metrics_name = 'token_refresh'
     permission_classes = [AllowAny]
+    serializer_class = EntitledTokenRefreshSerializer
 
 
 @extend_schema(
@@ -159,9 +154,10 @@ class TokenRefreshView(SimpleJWTTokenRefreshView):
         400: MessageResponseSerializer,
     },
     summary="Logout user",
-    description="Logout user and blacklist refresh token"
+    description="Logout user, blacklist the refresh token and revoke the access token it was sent with"
 )
-class LogoutView(APIView):
+class LogoutView(InstrumentedViewMixin, APIView):
+    metrics_name = 'logout'
     permission_classes = [IsAuthenticated]
     serializer_class = None
 
@@ -170,8 +166,10 @@ class LogoutView(APIView):
         if not refresh_token:
             return Response({'detail': 'refresh token required'}, status=400)
         try:
-            token = RefreshToken(refresh_token)
+            token = EntitledRefreshToken(refresh_token)
             token.blacklist()
+            # Price sockets check the access token's JTI when they connect (see crypto.consumers)
+            record_blacklisted(request.auth['jti'])
             return Response({'detail': 'Logged out'})
         except Exception:
             return Response({'detail': 'Invalid refresh token'}, status=400)
@@ -186,8 +184,10 @@ class LogoutView(APIView):
     summary="Request password reset",
     description="Send password reset code to user email"
 )
-class ForgotPasswordView(APIView):
+class ForgotPasswordView(InstrumentedViewMixin, APIView):
+    metrics_name = 'password_forgot'
     permission_classes = [AllowAny]
+    throttle_scope = 'password'
     serializer_class = ForgotPasswordSerializer
 
     def post(self, request):
@@ -196,12 +196,11 @@ class ForgotPasswordView(APIView):
             try:
                 user = User.objects.get(email=email)
                 token = PasswordResetToken.create_for_user(user)
-                send_mail(
+                queue_email(
                     subject='Password reset',
-                    message=f'Your reset code is: {token.raw_code}',
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[email],
-                    fail_silently=True,
+                    body=f'Your reset code is: {token.raw_code}',
+                    to=[email],
+                    dedup_key=f'reset:{token.pk}',
                 )
             except User.DoesNotExist:
                 pass
@@ -218,11 +217,13 @@ class ForgotPasswordView(APIView):
     summary="Reset password",
     description="Reset user password with reset code"
 )
-class ResetPasswordView(APIView):
+class ResetPasswordView(InstrumentedViewMixin, AsyncAPIView):
+    metrics_name = 'password_reset'
     permission_classes = [AllowAny]
+    throttle_scope = 'password'
     serializer_class = ResetPasswordSerializer
 
-    def post(self, request):
+    async def post(self, request):
         serializer = ResetPasswordSerializer(data=request.data)
         if not serializer.is_valid():
             return Response({'detail': serializer.errors}, status=400)
@@ -236,12 +237,12 @@ class ResetPasswordView(APIView):
             return Response({'detail': e.messages}, status=400)
         
         # Find user by reset code and consume the code
-        success, user = PasswordResetToken.consume_code_by_code(code)
+        success, user = await sync_to_async(PasswordResetToken.consume_code_by_code)(code)
         if not success or not user:
             return Response({'detail': 'Invalid or expired code'}, status=400)
         
-        user.set_password(new_password)
-        user.save(update_fields=['password'])
+        await aset_password(user, new_password)
+        await user.asave(update_fields=['password'])
         return Response({'detail': 'Password reset successful'})
 
 
@@ -255,21 +256,23 @@ class ResetPasswordView(APIView):
     summary="Change password",
     description="Change user password (requires authentication)"
 )
-class ChangePasswordView(APIView):
+class ChangePasswordView(InstrumentedViewMixin, AsyncAPIView):
+    metrics_name = 'password_change'
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'password'
     serializer_class = ChangePasswordSerializer
 
-    def post(self, request):
+    async def post(self, request):
         old_password = request.data.get('old_password')
         new_password = request.data.get('new_password')
-        if not request.user.check_password(old_password or ''):
+        if not await acheck_password(request.user, old_password or ''):
             return Response({'detail': 'Invalid old password'}, status=400)
         try:
             validate_password(new_password)
         except ValidationError as e:
             return Response({'detail': e.messages}, status=400)
-        request.user.set_password(new_password)
-        request.user.save(update_fields=['password'])
+        await aset_password(request.user, new_password)
+        await request.user.asave(update_fields=['password'])
         return Response({'detail': 'Password changed'})
 
 
@@ -311,6 +314,7 @@ class ProfileView(APIView):
     description="Get user premium subscription status"
 )
 class PremiumStatusView(APIView):
+    authentication_classes = [ClaimsJWTAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = PremiumStatusResponseSerializer
 
@@ -354,15 +358,191 @@ class PremiumGrantView(APIView):
     serializer_class = PremiumGrantSerializer
 
     def post(self, request):
-        username = request.data.get('username')
-        days = int(request.data.get('days', 365))
-        user = User.objects.get(username=username)
-        user.is_premium = True
-        user.premium_expires_at = timezone.now() + timezone.timedelta(days=days)
-        user.save(update_fields=['is_premium', 'premium_expires_at'])
+        serializer = PremiumGrantSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        data = serializer.validated_data
+        if not grant_premium([data['username']], data['days'])['granted']:
+            return Response({'detail': 'User not found'}, status=404)
         return Response({'detail': 'Granted'})
 
 
+@extend_schema(
+    tags=['Premium'],
+    request={
+        'application/json': PremiumBulkGrantSerializer,
+        'multipart/form-data': PremiumBulkGrantSerializer,
+    },
+    responses={
+        200: PremiumBulkGrantResponseSerializer,
+        400: MessageResponseSerializer,
+    },
+    summary="Grant premium access in bulk",
+    description="Grant premium access to a list of usernames or to the usernames in an uploaded CSV (admin only). Unknown usernames are returned in `missing`."
+)
+class PremiumBulkGrantView(InstrumentedViewMixin, APIView):
+    metrics_name = 'premium_bulk_grant'
+    permission_classes = [IsAdminUser]
+    serializer_class = PremiumBulkGrantSerializer
+
+    def post(self, request):
+        serializer = PremiumBulkGrantSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        data = serializer.validated_data
+        usernames = list(data.get('usernames') or [])
+        if data.get('file'):
+            try:
+                usernames.extend(read_usernames(io.TextIOWrapper(data['file'], encoding='utf-8-sig')))
+            except (UnicodeDecodeError, csv.Error):
+                return Response({'detail': 'File must be a UTF-8 CSV'}, status=400)
+        return Response(grant_premium(usernames, data['days']))
+
+
+@extend_schema(
+    tags=['Portfolio'],
+    request=HoldingSerializer,
+    responses={
+        200: HoldingSerializer(many=True),
+        400: MessageResponseSerializer,
+    },
+    summary="List or set holdings",
+    description="List your holdings, or set the quantity and cost basis held for a symbol (replaces any existing position)."
+)
+class HoldingsView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = HoldingSerializer
+
+    def get(self, request):
+        rows = (
+            Holding.objects.filter(user=request.user)
+            .order_by('asset__symbol')
+            .values_list('asset__symbol', 'quantity', 'cost_basis_usd')
+        )
+        return Response([
+            {'symbol': symbol, 'quantity': quantity, 'cost_basis_usd': cost}
+            for symbol, quantity, cost in rows
+        ])
+
+    def post(self, request):
+        serializer = HoldingSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        data = serializer.validated_data
+        try:
+            asset = CryptoAsset.objects.get(symbol=data['symbol'].strip().upper())
+        except CryptoAsset.DoesNotExist:
+            return Response({'detail': 'Unknown symbol'}, status=400)
+        Holding.objects.update_or_create(
+            user=request.user,
+            asset=asset,
+            defaults={'quantity': data['quantity'], 'cost_basis_usd': data['cost_basis_usd']},
+        )
+        notify_portfolio_changed(request.user)
+        return Response({'detail': 'Saved'})
+
+
+@extend_schema(
+    tags=['Portfolio'],
+    request=None,
+    responses={
+        200: MessageResponseSerializer,
+        404: MessageResponseSerializer,
+    },
+    summary="Remove a holding",
+    description="Remove your position in a symbol"
+)
+class HoldingDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = None
+
+    def delete(self, request, symbol):
+        deleted, _ = Holding.objects.filter(user=request.user, asset__symbol=symbol.upper()).delete()
+        if not deleted:
+            return Response({'detail': 'Not found'}, status=404)
+        notify_portfolio_changed(request.user)
+        return Response({'detail': 'Removed'})
+
+
+@extend_schema(
+    tags=['Portfolio'],
+    responses={
+        200: PortfolioResponseSerializer,
+    },
+    summary="Get portfolio value",
+    description="Value all your holdings at the latest prices, with total value and PnL"
+)
+class PortfolioView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = PortfolioResponseSerializer
+
+    def get(self, request):
+        return Response(portfolio_summary(load_positions(request.user)))
+
+
+@extend_schema(
+    tags=['Portfolio'],
+    request=WatchlistSerializer,
+    responses={
+        200: WatchlistResponseSerializer,
+        400: MessageResponseSerializer,
+    },
+    summary="Get or edit watchlist",
+    description="GET returns your watchlist. POST adds symbols, PUT replaces the whole list. Open WebSocket connections are resubscribed automatically."
+)
+class WatchlistView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = WatchlistSerializer
+
+    def get(self, request):
+        return Response({'symbols': get_watchlist_symbols(request.user.pk)})
+
+    def post(self, request):
+        serializer = WatchlistSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        symbols, unknown = update_watchlist(request.user, add=serializer.validated_data['symbols'])
+        return Response({'symbols': symbols, 'unknown': unknown})
+
+    def put(self, request):
+        serializer = WatchlistSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'detail': serializer.errors}, status=400)
+        wanted = serializer.validated_data['symbols']
+        symbols, unknown = update_watchlist(
+            request.user,
+            add=wanted,
+            remove=get_watchlist_symbols(request.user.pk),
+        )
+        return Response({'symbols': symbols, 'unknown': unknown})
+
+
+@extend_schema(
+    tags=['Portfolio'],
+    request=None,
+    responses={
+        200: WatchlistResponseSerializer,
+    },
+    summary="Remove from watchlist",
+    description="Remove a symbol from your watchlist"
+)
+class WatchlistDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = None
+
+    def delete(self, request, symbol):
+        symbols, _ = update_watchlist(request.user, remove=[symbol])
+        return Response({'symbols': symbols})
+
+
+def notify_portfolio_changed(user):
+    """Tell the user's open sockets to reload their positions."""
+    try:
+        async_to_sync(get_channel_layer().group_send)(f'user_{user.pk}', {'type': 'portfolio.changed'})
+    except Exception:
+        pass
+
+
 @extend_schema(
     tags=['Testing'],
     request=TestEmailSerializer,
@@ -371,7 +551,7 @@ class PremiumGrantView(APIView):
         500: TestEmailResponseSerializer,
     },
     summary="Send test email",
-    description="Send a test email to verify email configuration"
+    description="Queue a test email to verify email configuration; delivery failures show up in the mail worker's log"
 )
 class TestEmailView(APIView):
     """Test view to verify Liara email configuration"""
@@ -388,15 +568,5 @@ class TestEmailView(APIView):
         message = "This is a test email sent using Liara SMTP service. If you receive this, the email configuration is working correctly!"
         headers = {"x-liara-tag": "test-email"}  # Custom headers for Liara
 
-        try:
-            email = EmailMessage(
-                subject=subject,
-                body=message,
-                from_email=None,  # Uses MAIL_FROM from settings.py
-                to=[recipient_email],
-                headers=headers,
-            )
-            email.send()
-            return Response({"status": "success", "message": f"Test email sent successfully to {recipient_email}!"})
-        except Exception as e:
-            return Response({"status": "error", "message": f"Failed to send email: {str(e)}"}, status=500)
+        queue_email(subject=subject, body=message, to=[recipient_email], headers=headers)
+        return Response({"status": "success", "message": f"Test email queued for {recipient_email}."})
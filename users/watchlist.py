@@ -0,0 +1,66 @@
+"""
+Per-user watchlists.
+
+The symbol list is cached so a WebSocket connect costs one cache read, and
+every change is pushed to the user's open sockets through their ``user_<id>``
+group so they resubscribe without reconnecting.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+
+from backend import metrics
+from crypto.models import CryptoAsset
+from .models import WatchlistItem
+
+WATCHLIST_CACHE_TTL = 60 * 60 * 24
+WATCHLIST_CACHE = metrics.counter('users_watchlist_cache_total', 'Watchlist cache lookups', ['result'])
+
+
+def watchlist_cache_key(user_id):
+    return f'users:watchlist:{user_id}'
+
+
+def get_watchlist_symbols(user_id):
+    key = watchlist_cache_key(user_id)
+    symbols = cache.get(key)
+    WATCHLIST_CACHE.labels('miss' if symbols is None else 'hit').inc()
+    if symbols is None:
+        symbols = sorted(
+            WatchlistItem.objects.filter(user_id=user_id).values_list('asset__symbol', flat=True)
+        )
+        cache.set(key, symbols, WATCHLIST_CACHE_TTL)
+    return symbols
+
+
+def update_watchlist(user, add=(), remove=()):
+    """
+    Add and remove symbols, refresh the cache and notify open sockets.
+    Returns ``(symbols, unknown)`` where ``unknown`` lists symbols that do not exist.
+    """
+    add = {s.strip().upper() for s in add if s.strip()}
+    remove = {s.strip().upper() for s in remove if s.strip()} - add
+    assets = dict(CryptoAsset.objects.filter(symbol__in=add).values_list('symbol', 'id'))
+    unknown = sorted(add - set(assets))
+    current = set(get_watchlist_symbols(user.pk))
+    added = sorted(set(assets) - current)
+    removed = sorted(remove & current)
+    if added:
+        WatchlistItem.objects.bulk_create(
+            [WatchlistItem(user=user, asset_id=assets[s]) for s in added],
+            ignore_conflicts=True,
+        )
+    if removed:
+        WatchlistItem.objects.filter(user=user, asset__symbol__in=removed).delete()
+    symbols = sorted((current | set(added)) - set(removed))
+    cache.set(watchlist_cache_key(user.pk), symbols, WATCHLIST_CACHE_TTL)
+    if added or removed:
+        try:
+            async_to_sync(get_channel_layer().group_send)(f'user_{user.pk}', {
+                'type': 'watchlist.changed',
+                'added': added,
+                'removed': removed,
+            })
+        except Exception:
+            pass
+    return symbols, unknown